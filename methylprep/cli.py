@@ -156,6 +156,41 @@ def cli_process(cmd_args):
         help='If specified, samples will be processed and saved in batches no greater than the specified batch size'
     )
 
+    parser.add_argument(
+        '--workers',
+        required=False,
+        type=int,
+        help='If specified, reads this many IDAT pairs at the same time on a pool of threads. Speeds up loading from network storage.'
+    )
+
+    parser.add_argument(
+        '--min_beads',
+        required=False,
+        type=int,
+        help='If specified, probes measured on fewer beads than this are masked to NaN before NOOB correction.'
+    )
+
+    parser.add_argument(
+        '--idat_archive',
+        required=False,
+        type=Path,
+        help='Path to a tar archive of IDAT files (such as a GEO _RAW.tar). IDATs are read from the archive without extracting them. The sample sheet must be in data_dir.'
+    )
+
+    parser.add_argument(
+        '--cache_dir',
+        required=False,
+        type=Path,
+        help='If specified, decoded IDAT files are cached in this folder, so that reprocessing the same samples with different options skips decoding them.'
+    )
+
+    parser.add_argument(
+        '--regions',
+        required=False,
+        type=Path,
+        help='Path to a BED file of genomic regions (such as the targets of a panel). Only probes in these regions are exported and saved in the output files.'
+    )
+
     parser.add_argument(
         '-u', '--uncorrected',
         required=False,
@@ -188,6 +223,22 @@ def cli_process(cmd_args):
         help="Change the processed beta or m_value data_type output from float64 to float16 or float32, to save disk space.",
     )
 
+    parser.add_argument(
+        '--precision',
+        required=False,
+        choices=['float64','float32'],
+        default='float64',
+        help="Float type of the NOOB computations. float32 halves their memory traffic; beta and m_values stay within a few units of their 3rd decimal.",
+    )
+
+    parser.add_argument(
+        '--quantile_normalize',
+        required=False,
+        action='store_true',
+        default=False,
+        help="If specified, NOOB corrected intensities are quantile normalized across all samples (within probe types) before beta and m_values are computed. Batches are kept on disk while the reference is built.",
+    )
+
     parser.add_argument(
         '-c', '--save_control',
         required=False,
@@ -251,10 +302,17 @@ def cli_process(cmd_args):
         betas=args.betas,
         m_value=args.m_value,
         batch_size=args.batch_size,
+        workers=args.workers,
+        min_beads=args.min_beads,
+        idat_archive=args.idat_archive,
+        cache_dir=args.cache_dir,
+        regions=args.regions,
         save_uncorrected=args.uncorrected,
         export=args.no_export, # flag flips here
         meta_data_frame=args.no_meta_export, # flag flips here
         bit=args.bit,
+        precision=args.precision,
+        quantile_normalize=args.quantile_normalize,
         save_control=args.save_control,
         poobah=args.poobah,
         export_poobah=args.export_poobah,
@@ -1,11 +1,21 @@
-from .idat import IdatDataset
-from .manifests import Manifest
+from .idat import IdatDataset, IdatHeader, IdatStack
+from .idat_cache import IdatCache
+from .manifests import Manifest, ManifestRegistry, MANIFEST_REGISTRY
+from .manifest_cache import ManifestCache
+from .archives import TarIdatReader
 from .sample_sheets import SampleSheet, get_sample_sheet, get_sample_sheet_s3, find_sample_sheet, create_sample_sheet
 
 
 __all__ = [
     'IdatDataset',
+    'IdatHeader',
+    'IdatStack',
+    'IdatCache',
     'Manifest',
+    'ManifestRegistry',
+    'MANIFEST_REGISTRY',
+    'ManifestCache',
+    'TarIdatReader',
     'SampleSheet',
     'get_sample_sheet',
     'get_sample_sheet_s3',
@@ -0,0 +1,83 @@
+# Lib
+import gzip
+import logging
+from io import BytesIO
+from pathlib import PurePath
+import tarfile
+# App
+from ..utils import is_file_like
+
+
+__all__ = ['TarIdatReader']
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TarIdatReader():
+    """Reads IDAT files straight out of an uncompressed tar archive, such as the
+    GSExxx_RAW.tar files published on GEO, without extracting them to disk.
+
+    The archive is scanned once to index where each member's bytes start. Every later
+    read opens its own handle, seeks to that byte range and decompresses `.gz` members
+    in memory, so one reader can be shared between threads.
+
+    This has the same interface as the zip_reader passed to get_raw_datasets(from_s3=...),
+    so it plugs into the same hook.
+
+    Arguments:
+        filepath {string or path-like} -- path to the .tar archive.
+
+    Raises:
+        ValueError: If the archive is compressed (.tar.gz), since members of a compressed
+            archive cannot be read without decompressing everything before them.
+    """
+
+    def __init__(self, filepath):
+        if is_file_like(filepath):
+            raise TypeError('TarIdatReader needs a path to the archive, not an open file object')
+        self.filepath = str(filepath)
+        self.members = {}
+        try:
+            with tarfile.open(self.filepath, mode='r:') as archive:
+                for member in archive:
+                    if member.isfile():
+                        self.members[member.name] = (member.offset_data, member.size)
+        except tarfile.ReadError as e:
+            raise ValueError(f'{self.filepath} is not an uncompressed tar archive: {e}')
+        LOGGER.info(f'Indexed {len(self.members)} files in {PurePath(self.filepath).name}')
+
+    @property
+    def file_names(self):
+        return list(self.members)
+
+    def get_file_info(self, file_name):
+        offset, size = self.members[file_name]
+        return f'{file_name} ({size} bytes at offset {offset} in {PurePath(self.filepath).name})'
+
+    def get_file(self, file_name, match_partial=False):
+        """Returns the contents of one archive member as an in-memory file object.
+        Gzipped members are decompressed on the fly as they are read.
+
+        Arguments:
+            file_name {string} -- name of the member, as listed in file_names.
+
+        Keyword Arguments:
+            match_partial {boolean} -- if True, returns the first member whose name
+                contains file_name. (default: {False})
+
+        Raises:
+            FileNotFoundError: If no member matches file_name.
+        """
+        if file_name not in self.members and match_partial:
+            file_name = next((name for name in self.members if file_name in name), file_name)
+        if file_name not in self.members:
+            raise FileNotFoundError(f'{file_name} not found in {self.filepath}')
+
+        offset, size = self.members[file_name]
+        with open(self.filepath, 'rb') as archive:
+            archive.seek(offset)
+            contents = BytesIO(archive.read(size))
+        if PurePath(file_name).suffix == '.gz':
+            return gzip.GzipFile(fileobj=contents, mode='rb')
+        return contents
@@ -1,9 +1,16 @@
 # Lib
 from enum import IntEnum, unique
+import hashlib
+import mmap
+import os
+from pathlib import PurePath
+import numpy as np
 import pandas as pd
 # App
+from ..models import Channel
 from ..utils import (
     get_file_object,
+    is_file_like,
     read_and_reset,
     read_byte,
     read_char,
@@ -16,7 +23,7 @@ from ..utils import (
 )
 
 
-__all__ = ['IdatDataset']
+__all__ = ['IdatDataset', 'IdatHeader', 'IdatStack']
 
 
 # Constants
@@ -105,6 +112,30 @@ class RunInfo():
         self.block_code = read_string(idat_file)
         self.code_version = read_string(idat_file)
 
+class IdatHeader():
+    """A dataclass holding what can be learned about an IDAT file without reading its
+    intensity arrays: enough to validate a sample sheet and group samples by array type.
+    Created by IdatDataset.scan_header().
+
+    barcode and chip_type are None if the scan skipped them (see scan_header).
+    """
+
+    __slots__ = [
+        'channel',
+        'section_offsets',
+        'n_snps_read',
+        'barcode',
+        'chip_type',
+    ]
+
+    def __init__(self, channel, section_offsets, n_snps_read, barcode=None, chip_type=None):
+        self.channel = channel
+        self.section_offsets = section_offsets
+        self.n_snps_read = n_snps_read
+        self.barcode = barcode
+        self.chip_type = chip_type
+
+
 class IdatDataset():
     """Validates and parses an Illumina IDAT file.
 
@@ -116,6 +147,23 @@ class IdatDataset():
     Keyword Arguments:
         idat_id {string} -- expected IDAT file identifier (default: {DEFAULT_IDAT_FILE_ID})
         idat_version {integer} -- expected IDAT version (default: {DEFAULT_IDAT_VERSION})
+        memmap {boolean} -- if True and filepath_or_buffer is an uncompressed .idat path,
+            the file is memory-mapped and the ILLUMINA_ID, MEAN, STD_DEV and NUM_BEADS sections
+            are exposed as read-only numpy views onto the file, without copying. Gzipped files
+            and open file objects fall back to the normal read. (default: {False})
+        read_bead_stats {boolean} -- read the STD_DEV and NUM_BEADS sections up front. Otherwise
+            they are read from the file on first access, which is not possible for open
+            file objects. (default: {False})
+        min_beads {integer} -- if set, probes measured on fewer beads are masked to NaN in
+            probe_means (which then holds float32 values). (default: {None})
+
+    Attributes:
+        illumina_ids {ndarray} -- int32 probe addresses, in file order.
+        means {ndarray} -- uint16 mean probe intensities, parallel to illumina_ids.
+        std_dev {ndarray} -- uint16 standard deviation of the bead intensities. Read on first access.
+        n_beads {ndarray} -- uint8 number of beads measured per probe. Read on first access.
+        probe_means {DataFrame} -- mean probe intensity values indexed by Illumina ID.
+            Only built on first access.
 
     Raises:
         ValueError: The IDAT file has an incorrect identifier or version specifier.
@@ -126,25 +174,232 @@ class IdatDataset():
         channel,
         idat_id=DEFAULT_IDAT_FILE_ID,
         idat_version=DEFAULT_IDAT_VERSION,
+        memmap=False,
+        read_bead_stats=False,
+        min_beads=None,
     ):
         """Initializes the IdatDataset, reads and parses the IDAT file."""
         self.channel = channel
         self.barcode = None
         self.chip_type = None
-        self.n_beads = 0
         self.n_snps_read = 0
         self.run_info = []
+        self.illumina_ids = None
+        self.means = None
+        self.min_beads = min_beads
+        self.__n_beads = None
+        self.__std_dev = None
+        self.__probe_means = None
+        self.__layout_key = None
+        self.__section_offsets = None
+        # where STD_DEV and NUM_BEADS are read from on first access: a path, a memory-map or None.
+        self.__source = None if is_file_like(filepath_or_buffer) else filepath_or_buffer
+
+        if memmap and self.can_memmap(filepath_or_buffer):
+            with open(filepath_or_buffer, 'rb') as raw_file:
+                # the mapping keeps its own handle on the file; the views returned by read()
+                # keep the mapping alive for as long as they are referenced.
+                idat_file = mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__source = idat_file
+            self.validate(idat_file, idat_id, idat_version)
+            self.read(idat_file, read_bead_stats=read_bead_stats)
+            return
 
         with get_file_object(filepath_or_buffer) as idat_file:
-            # assert file is indeed IDAT format
-            if not self.is_idat_file(idat_file, idat_id):
-                raise ValueError('Not an IDAT file. Unsupported file type.')
+            self.validate(idat_file, idat_id, idat_version)
+            self.read(idat_file, read_bead_stats=read_bead_stats)
+
+    @classmethod
+    def from_arrays(cls, channel, illumina_ids, means, section_offsets=None, source=None,
+                    barcode=None, chip_type=None, min_beads=None):
+        """Creates an IdatDataset from already decoded arrays (for example, from IdatCache)
+        without reading the IDAT file.
+
+        Arguments:
+            channel {Channel} -- the fluorescent channel of the IDAT.
+            illumina_ids {ndarray} -- int32 probe addresses, in file order.
+            means {ndarray} -- uint16 mean probe intensities, parallel to illumina_ids.
+
+        Keyword Arguments:
+            section_offsets {dict} -- the IDAT offset table. Together with source, lets
+                std_dev and n_beads still be read from the file on first access. (default: {None})
+            source {string or path-like} -- path to the original IDAT file. (default: {None})
+            barcode {string} -- (default: {None})
+            chip_type {string} -- (default: {None})
+            min_beads {integer} -- see IdatDataset. Needs source and section_offsets. (default: {None})
+        """
+        dataset = cls.__new__(cls)
+        dataset.channel = channel
+        dataset.barcode = barcode
+        dataset.chip_type = chip_type
+        dataset.n_snps_read = len(illumina_ids)
+        dataset.run_info = []
+        dataset.illumina_ids = illumina_ids
+        dataset.means = means
+        dataset.min_beads = min_beads
+        dataset.__n_beads = None
+        dataset.__std_dev = None
+        dataset.__probe_means = None
+        dataset.__layout_key = None
+        dataset.__section_offsets = section_offsets
+        dataset.__source = source if section_offsets is not None else None
+        return dataset
+
+    @property
+    def section_offsets(self):
+        """The byte offset of each section in the IDAT file, as read from its offset table."""
+        return self.__section_offsets
+
+    @classmethod
+    def scan_header(
+        cls,
+        filepath_or_buffer,
+        channel=None,
+        idat_id=DEFAULT_IDAT_FILE_ID,
+        idat_version=DEFAULT_IDAT_VERSION,
+        read_strings=None,
+    ):
+        """Validates an IDAT file and reads only its offset table and probe count,
+        without touching the intensity arrays.
+
+        Arguments:
+            filepath_or_buffer {file-like} -- the IDAT file to scan.
+
+        Keyword Arguments:
+            channel {Channel} -- the fluorescent channel of the file, stored on the header. (default: {None})
+            idat_id {string} -- expected IDAT file identifier (default: {DEFAULT_IDAT_FILE_ID})
+            idat_version {integer} -- expected IDAT version (default: {DEFAULT_IDAT_VERSION})
+            read_strings {boolean} -- also read the barcode and chip type. These are stored after
+                the intensity arrays, so for gzipped files they cost a full decompression.
+                The default (None) reads them only for uncompressed files.
+
+        Raises:
+            ValueError: The IDAT file has an incorrect identifier or version specifier.
+            EOFError: The file is shorter than its offset table says (uncompressed files only,
+                or any file when the strings are read).
+
+        Returns:
+            [IdatHeader] -- the header of the IDAT file.
+        """
+        compressed = not is_file_like(filepath_or_buffer) and PurePath(filepath_or_buffer).suffix == '.gz'
+        if read_strings is None:
+            read_strings = not compressed
 
-            # assert correct IDAT file version
-            if not self.is_correct_version(idat_file, idat_version):
+        with get_file_object(filepath_or_buffer) as idat_file:
+            if not cls.is_idat_file(idat_file, idat_id):
+                raise ValueError('Not an IDAT file. Unsupported file type.')
+            if not cls.is_correct_version(idat_file, idat_version):
                 raise ValueError('Not a version 3 IDAT file. Unsupported IDAT version.')
 
-            self.probe_means = self.read(idat_file)
+            section_offsets = cls.get_section_offsets(idat_file)
+            idat_file.seek(section_offsets[IdatSectionCode.NUM_SNPS_READ.value])
+            n_snps_read = read_int(idat_file)
+
+            if not is_file_like(filepath_or_buffer) and not compressed:
+                cls.check_file_size(os.path.getsize(filepath_or_buffer), section_offsets, n_snps_read)
+
+            header = IdatHeader(channel, section_offsets, n_snps_read)
+            if read_strings:
+                for section_code, attribute in sorted(
+                    [(IdatSectionCode.BARCODE, 'barcode'), (IdatSectionCode.CHIP_TYPE, 'chip_type')],
+                    key=lambda item: section_offsets[item[0].value],
+                ):
+                    idat_file.seek(section_offsets[section_code.value])
+                    value = read_string(idat_file)
+                    if value == '':
+                        raise EOFError(f'End of file reached before {section_code.name} section')
+                    setattr(header, attribute, value)
+
+        return header
+
+    @staticmethod
+    def check_file_size(file_size, section_offsets, n_snps_read):
+        """Raises EOFError if the array sections of an uncompressed IDAT file would run past
+        the end of the file, so truncated downloads are caught before any decoding."""
+        array_sections = {
+            IdatSectionCode.ILLUMINA_ID: 4,
+            IdatSectionCode.STD_DEV: 2,
+            IdatSectionCode.MEAN: 2,
+            IdatSectionCode.NUM_BEADS: 1,
+        }
+        for section_code, itemsize in array_sections.items():
+            offset = section_offsets.get(section_code.value)
+            if offset is not None and offset + itemsize * n_snps_read > file_size:
+                raise EOFError(f'IDAT file is truncated: {section_code.name} section ends past the end of the file ({file_size} bytes)')
+        for section_code in (IdatSectionCode.BARCODE, IdatSectionCode.CHIP_TYPE):
+            offset = section_offsets.get(section_code.value)
+            if offset is not None and offset >= file_size:
+                raise EOFError(f'IDAT file is truncated: {section_code.name} section starts past the end of the file ({file_size} bytes)')
+
+    @property
+    def n_beads(self):
+        """uint8 number of beads measured per probe, read from the NUM_BEADS section on first access."""
+        if self.__n_beads is None and self.__section_offsets is not None:
+            self.__n_beads = self.read_array_section(IdatSectionCode.NUM_BEADS, '<u1')
+        return self.__n_beads
+
+    @n_beads.setter
+    def n_beads(self, value):
+        self.__n_beads = value
+
+    @property
+    def std_dev(self):
+        """uint16 standard deviation of the bead intensities, read from the STD_DEV section on first access."""
+        if self.__std_dev is None and self.__section_offsets is not None:
+            self.__std_dev = self.read_array_section(IdatSectionCode.STD_DEV, '<u2')
+        return self.__std_dev
+
+    @std_dev.setter
+    def std_dev(self, value):
+        self.__std_dev = value
+
+    def read_array_section(self, section_code, dtype):
+        """Reads one per-probe array section from the source file, after the dataset was created.
+
+        Raises:
+            ValueError: If the IDAT was read from an open file object, which cannot be re-read.
+                Pass read_bead_stats=True to read these sections up front instead.
+        """
+        if self.__source is None:
+            raise ValueError(f'{section_code.name} was not read from this IDAT file object; use read_bead_stats=True')
+        if isinstance(self.__source, mmap.mmap):
+            self.__source.seek(self.__section_offsets[section_code.value])
+            return npread(self.__source, dtype, self.n_snps_read)
+        with get_file_object(self.__source) as idat_file:
+            idat_file.seek(self.__section_offsets[section_code.value])
+            return npread(idat_file, dtype, self.n_snps_read)
+
+    @property
+    def layout_key(self):
+        """Hash of the illumina_ids, in file order. IDATs with the same key have the same
+        address layout, so probe positions found for one apply to all of them."""
+        if self.__layout_key is None:
+            illumina_ids = np.ascontiguousarray(self.illumina_ids)
+            self.__layout_key = hashlib.blake2b(illumina_ids.tobytes(), digest_size=16).hexdigest()
+        return self.__layout_key
+
+    @property
+    def probe_means(self):
+        """DataFrame of mean probe intensity values indexed by Illumina ID, built on first access."""
+        if self.__probe_means is None:
+            self.__probe_means = self.build_probe_means()
+        return self.__probe_means
+
+    @staticmethod
+    def can_memmap(filepath_or_buffer):
+        """Only uncompressed files on disk can be memory-mapped."""
+        if is_file_like(filepath_or_buffer):
+            return False
+        return PurePath(filepath_or_buffer).suffix != '.gz'
+
+    def validate(self, idat_file, idat_id, idat_version):
+        # assert file is indeed IDAT format
+        if not self.is_idat_file(idat_file, idat_id):
+            raise ValueError('Not an IDAT file. Unsupported file type.')
+
+        # assert correct IDAT file version
+        if not self.is_correct_version(idat_file, idat_version):
+            raise ValueError('Not a version 3 IDAT file. Unsupported IDAT version.')
 
     @staticmethod
     @read_and_reset
@@ -202,49 +457,222 @@ class IdatDataset():
 
         return offsets
 
-    def read(self, idat_file):
-        """Reads the IDAT file and parses the appropriate sections. Joins the
-        mean probe intensity values with their Illumina probe ID.
+    def read(self, idat_file, read_bead_stats=False):
+        """Reads the IDAT file and parses the appropriate sections into numpy arrays.
+        On a memory-mapped file, the arrays are read-only views and nothing is copied.
+
+        Sections are visited in the order they are stored in the file, so the whole file
+        is read in a single forward pass. This matters for gzipped files, where every backward
+        seek restarts decompression from the first byte.
 
         Arguments:
             idat_file {file-like} -- the IDAT file to process.
 
-        Returns:
-            DataFrame -- mean probe intensity values indexed by Illumina ID.
+        Keyword Arguments:
+            read_bead_stats {boolean} -- also read the STD_DEV and NUM_BEADS sections. NUM_BEADS
+                is always read when min_beads is set. (default: {False})
         """
         section_offsets = self.get_section_offsets(idat_file)
+        self.__section_offsets = section_offsets
 
         def seek_to_section(section_code):
             offset = section_offsets[section_code.value]
-            idat_file.seek(offset)
-
-        seek_to_section(IdatSectionCode.BARCODE)
-        self.barcode = read_string(idat_file)
-
-        seek_to_section(IdatSectionCode.CHIP_TYPE)
-        self.chip_type = read_string(idat_file)
+            try:
+                idat_file.seek(offset)
+            except ValueError: # mmap refuses to seek past the end of a truncated file
+                raise EOFError(f'End of file reached before {section_code.name} section')
 
+        # every array section depends on the probe count, which is stored first in IDAT files.
         seek_to_section(IdatSectionCode.NUM_SNPS_READ)
         self.n_snps_read = read_int(idat_file)
 
-        seek_to_section(IdatSectionCode.NUM_BEADS)
-        self.n_beads = npread(idat_file, '<u1', self.n_snps_read)
+        section_readers = {
+            IdatSectionCode.BARCODE: ('barcode', lambda: read_string(idat_file)),
+            IdatSectionCode.CHIP_TYPE: ('chip_type', lambda: read_string(idat_file)),
+            IdatSectionCode.ILLUMINA_ID: ('illumina_ids', lambda: npread(idat_file, '<i4', self.n_snps_read)),
+            IdatSectionCode.MEAN: ('means', lambda: npread(idat_file, '<u2', self.n_snps_read)),
+        }
+        if read_bead_stats or self.min_beads:
+            section_readers[IdatSectionCode.NUM_BEADS] = ('n_beads', lambda: npread(idat_file, '<u1', self.n_snps_read))
+        if read_bead_stats:
+            section_readers[IdatSectionCode.STD_DEV] = ('std_dev', lambda: npread(idat_file, '<u2', self.n_snps_read))
+
+        for section_code in sorted(section_readers, key=lambda code: section_offsets[code.value]):
+            attribute, reader = section_readers[section_code]
+            seek_to_section(section_code)
+            setattr(self, attribute, reader())
+
+    def build_probe_means(self):
+        """Joins the mean probe intensity values with their Illumina probe ID.
+        If min_beads is set, probes with fewer beads are masked to NaN here, in one vectorized step.
 
-        seek_to_section(IdatSectionCode.ILLUMINA_ID)
-        illumina_ids = npread(idat_file, '<i4', self.n_snps_read)
+        Returns:
+            DataFrame -- mean probe intensity values indexed by Illumina ID.
+        """
+        if self.min_beads:
+            means = np.where(self.n_beads < self.min_beads, np.float32(np.nan), self.means.astype('float32'))
+            dtype = 'float32'
+        else:
+            means = self.means
+            dtype = 'uint16' # native IDAT type; kernels convert to float (int16 would overflow above 32767)
+        data_frame = pd.DataFrame(
+            data={'mean_value': means},
+            index=pd.Index(self.illumina_ids, name='illumina_id'),
+            dtype=dtype,
+        )
+        return data_frame
 
-        seek_to_section(IdatSectionCode.MEAN)
-        probe_means = npread(idat_file, '<u2', self.n_snps_read)
 
-        probe_records = dict(zip(illumina_ids, probe_means))
+class IdatStack():
+    """Reads the green and red IDAT files of many samples into two contiguous
+    (samples x addresses) uint16 matrices that share one sorted address vector.
 
-        data_frame = pd.DataFrame.from_dict(
-            data=probe_records,
-            orient='index',
-            columns=['mean_value'],
-            dtype='float32', # int16 could work, and reduce memory by 1/2, but some raw values were > 32127 -- without prenormalization, you get negative values back, which breaks stuff.
-        )
+    Every file must have exactly the same address layout, which lets whole batches be
+    processed as matrix operations instead of per-sample DataFrame joins (see preprocess_noob_batch).
+    IDATs read with min_beads keep their bead-count mask, which take() applies.
 
-        data_frame.index.name = 'illumina_id'
+    Arguments:
+        green_filepaths {list(file-like or IdatDataset)} -- the GREEN channel IDAT file of each sample,
+            or its already read IdatDataset.
+        red_filepaths {list(file-like or IdatDataset)} -- the RED channel IDAT file of each sample, in the same order.
 
-        return data_frame
+    Keyword Arguments:
+        sample_names {list(string)} -- a name for each sample (default: {None}, numbered from 0)
+        memmap {boolean} -- memory-map uncompressed IDAT files while reading (default: {True})
+
+    Attributes:
+        addresses {ndarray} -- sorted int32 illumina_ids shared by every sample.
+        file_positions {ndarray} -- the position of each address in the IDAT files.
+        green {ndarray} -- uint16 GREEN channel means, shape (samples, addresses).
+        red {ndarray} -- uint16 RED channel means, shape (samples, addresses).
+
+    Raises:
+        ValueError: If the files differ in number or address layout.
+    """
+
+    def __init__(self, green_filepaths, red_filepaths, sample_names=None, memmap=True):
+        green_filepaths = list(green_filepaths)
+        red_filepaths = list(red_filepaths)
+        if len(green_filepaths) != len(red_filepaths):
+            raise ValueError(f'Expected one red IDAT per green IDAT ({len(green_filepaths)} green, {len(red_filepaths)} red)')
+        if sample_names is None:
+            sample_names = [str(idx) for idx in range(len(green_filepaths))]
+        self.sample_names = list(sample_names)
+        if len(self.sample_names) != len(green_filepaths):
+            raise ValueError('Expected one sample name per IDAT pair')
+
+        self.addresses = None
+        self.file_positions = None
+        self.green = None
+        self.red = None
+        self.__masks = {Channel.GREEN: None, Channel.RED: None} # probes on fewer than min_beads beads
+        self.__file_order = None # illumina_ids as stored in the first file
+        self.__sort_order = None # None if files are already sorted by address
+
+        for idx, (green_filepath, red_filepath) in enumerate(zip(green_filepaths, red_filepaths)):
+            green_idat = green_filepath if isinstance(green_filepath, IdatDataset) else \
+                IdatDataset(green_filepath, channel=Channel.GREEN, memmap=memmap)
+            red_idat = red_filepath if isinstance(red_filepath, IdatDataset) else \
+                IdatDataset(red_filepath, channel=Channel.RED, memmap=memmap)
+            self.set_sample(idx, green_idat, red_idat)
+
+    @classmethod
+    def from_samples(cls, samples, memmap=True):
+        """Builds an IdatStack from Sample objects parsed from a sample sheet."""
+        green_filepaths = [sample.get_filepath('idat', Channel.GREEN) for sample in samples]
+        red_filepaths = [sample.get_filepath('idat', Channel.RED) for sample in samples]
+        sample_names = [str(sample) for sample in samples]
+        return cls(green_filepaths, red_filepaths, sample_names=sample_names, memmap=memmap)
+
+    def __len__(self):
+        return len(self.sample_names)
+
+    def set_sample(self, idx, green_idat, red_idat):
+        """Copies one sample's IdatDatasets into row idx of the stacked matrices."""
+        if self.__file_order is None:
+            self.allocate(green_idat.illumina_ids)
+
+        for idat in (green_idat, red_idat):
+            if not np.array_equal(idat.illumina_ids, self.__file_order):
+                raise ValueError(f'IDAT address layout of sample {self.sample_names[idx]} ({idat.channel}) '
+                    f'does not match the first sample ({idat.n_snps_read} vs {len(self.__file_order)} probes)')
+
+        for idat, matrix in ((green_idat, self.green), (red_idat, self.red)):
+            if self.__sort_order is None:
+                matrix[idx] = idat.means
+            else:
+                np.take(idat.means, self.__sort_order, out=matrix[idx])
+            if idat.min_beads:
+                channel = Channel.GREEN if matrix is self.green else Channel.RED
+                if self.__masks[channel] is None:
+                    self.__masks[channel] = np.zeros(matrix.shape, dtype=bool)
+                masked = idat.n_beads < idat.min_beads
+                self.__masks[channel][idx] = masked if self.__sort_order is None else masked[self.__sort_order]
+
+    def allocate(self, illumina_ids):
+        n_samples = len(self.sample_names)
+        self.__file_order = np.array(illumina_ids)
+        if np.any(self.__file_order[1:] < self.__file_order[:-1]):
+            self.__sort_order = np.argsort(self.__file_order, kind='stable')
+            self.addresses = self.__file_order[self.__sort_order]
+            self.file_positions = self.__sort_order
+        else:
+            self.addresses = self.__file_order
+            self.file_positions = np.arange(len(self.addresses))
+        self.addresses.flags.writeable = False
+        self.file_positions.flags.writeable = False
+        self.green = np.empty((n_samples, len(self.addresses)), dtype=np.uint16)
+        self.red = np.empty((n_samples, len(self.addresses)), dtype=np.uint16)
+
+    def get_channel(self, channel):
+        """Returns the (samples x addresses) matrix for a Channel."""
+        if not isinstance(channel, Channel):
+            raise TypeError('channel is not a valid Channel')
+        if channel is Channel.GREEN:
+            return self.green
+        return self.red
+
+    def get_sample_means(self, sample, channel):
+        """Returns a view of one sample's means for a Channel, aligned to self.addresses.
+
+        Arguments:
+            sample {int or string} -- row number or sample name.
+            channel {Channel} -- Channel.RED or Channel.GREEN
+        """
+        idx = sample if isinstance(sample, (int, np.integer)) else self.sample_names.index(str(sample))
+        return self.get_channel(channel)[idx]
+
+    def get_positions(self, addresses):
+        """Returns the column position of each address in the stacked matrices,
+        or -1 for addresses not found in the IDATs."""
+        addresses = np.asarray(addresses)
+        positions = np.searchsorted(self.addresses, addresses)
+        positions[positions == len(self.addresses)] = 0
+        found = self.addresses[positions] == addresses
+        return np.where(found, positions, -1)
+
+    def take(self, channel, positions, dtype=np.float64):
+        """Returns the (samples x positions) float matrix of a Channel's means at these columns,
+        with NaN for probes masked by min_beads.
+
+        Arguments:
+            channel {Channel} -- Channel.RED or Channel.GREEN
+            positions {ndarray} -- column positions, as returned by get_positions (without the -1s).
+
+        Keyword Arguments:
+            dtype {numpy dtype} -- float type of the result (default: {np.float64})
+        """
+        values = self.get_channel(channel).take(positions, axis=1).astype(dtype)
+        mask = self.__masks[channel]
+        if mask is not None:
+            values[mask.take(positions, axis=1)] = np.nan
+        return values
+
+    def to_data_frame(self, channel):
+        """Returns a (samples x addresses) DataFrame of means for a Channel."""
+        return pd.DataFrame(
+            self.get_channel(channel),
+            index=pd.Index(self.sample_names, name='sample'),
+            columns=pd.Index(self.addresses, name='illumina_id'),
+            copy=False,
+        )
@@ -0,0 +1,201 @@
+# Lib
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import numpy as np
+# App
+from .idat import IdatDataset
+from ..utils import is_file_like
+
+
+__all__ = ['IdatCache']
+
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 20 * 1024 ** 3 # bytes
+CACHE_FORMAT_VERSION = 1
+HASH_BLOCK_SIZE = 1024 ** 2 # bytes hashed from each end of an IDAT file
+
+
+class IdatCache():
+    """An on-disk cache of decoded IDAT files, so reprocessing the same samples with
+    different options skips decoding them again.
+
+    Each IDAT file is stored as two .npy arrays (illumina_ids and means) plus a small JSON
+    file with its offset table, barcode and chip type. Cache hits are memory-mapped.
+    Entries are keyed by the IDAT's size, modification time and a hash of its first and
+    last megabyte, so a replaced or re-downloaded file is decoded again.
+
+    When the cache grows past max_size, the least recently used entries are removed. The size
+    is tracked as a running total, so the directory is only scanned on the first store and each
+    time the total crosses max_size. get_idat can be called from several threads (workers=).
+
+    Arguments:
+        cache_dir {string or path-like} -- directory holding the cache. Created if missing.
+
+    Keyword Arguments:
+        max_size {int} -- maximum total size of the cache in bytes (default: {DEFAULT_CACHE_SIZE}, 20 GB)
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = DEFAULT_CACHE_SIZE if max_size is None else max_size
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__size = None # running total of the bytes in cache_dir; scanned on first store
+
+    @staticmethod
+    def get_key(filepath):
+        """Returns the cache key for an IDAT file: a hash of its size, mtime and the
+        bytes at both ends of the file. Reads at most 2 MB."""
+        stat = os.stat(filepath)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f'{CACHE_FORMAT_VERSION}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        with open(filepath, 'rb') as idat_file:
+            digest.update(idat_file.read(HASH_BLOCK_SIZE))
+            if stat.st_size > 2 * HASH_BLOCK_SIZE:
+                idat_file.seek(-HASH_BLOCK_SIZE, os.SEEK_END)
+                digest.update(idat_file.read(HASH_BLOCK_SIZE))
+        return digest.hexdigest()
+
+    def get_entry_paths(self, key):
+        return {
+            'illumina_ids': self.cache_dir.joinpath(f'{key}.illumina_ids.npy'),
+            'means': self.cache_dir.joinpath(f'{key}.means.npy'),
+            'meta': self.cache_dir.joinpath(f'{key}.json'),
+        }
+
+    def get_idat(self, filepath, channel, min_beads=None):
+        """Returns the IdatDataset for an IDAT file, from the cache if possible.
+        On a miss, the file is decoded and stored in the cache.
+
+        Arguments:
+            filepath {string or path-like} -- path to the IDAT file.
+            channel {Channel} -- the fluorescent channel of the IDAT.
+
+        Keyword Arguments:
+            min_beads {integer} -- see IdatDataset. (default: {None})
+        """
+        if is_file_like(filepath):
+            return IdatDataset(filepath, channel=channel, min_beads=min_beads)
+
+        key = self.get_key(filepath)
+        idat = self.load(key, filepath, channel, min_beads=min_beads)
+        if idat is not None:
+            with self.__lock:
+                self.hits += 1
+            return idat
+
+        with self.__lock:
+            self.misses += 1
+        idat = IdatDataset(filepath, channel=channel, min_beads=min_beads)
+        try:
+            self.store(key, idat)
+        except OSError as e:
+            LOGGER.warning(f'Could not write {filepath} to the IDAT cache: {e}')
+        return idat
+
+    def load(self, key, filepath, channel, min_beads=None):
+        """Returns a cached IdatDataset, with memory-mapped arrays, or None on a miss."""
+        paths = self.get_entry_paths(key)
+        try:
+            with open(paths['meta'], 'r') as meta_file:
+                meta = json.load(meta_file)
+            illumina_ids = np.load(paths['illumina_ids'], mmap_mode='r')
+            means = np.load(paths['means'], mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if len(illumina_ids) != meta['n_snps_read'] or len(means) != meta['n_snps_read']:
+            return None
+
+        # touching the entry keeps it at the end of the LRU order.
+        for path in paths.values():
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+        return IdatDataset.from_arrays(
+            channel,
+            illumina_ids,
+            means,
+            section_offsets={int(code): offset for code, offset in meta['section_offsets'].items()},
+            source=filepath,
+            barcode=meta['barcode'],
+            chip_type=meta['chip_type'],
+            min_beads=min_beads,
+        )
+
+    def store(self, key, idat):
+        """Writes the decoded arrays of an IdatDataset to the cache, then evicts old entries if the
+        cache has grown past max_size. Files are written under temporary names and renamed, so readers
+        never see partial entries."""
+        paths = self.get_entry_paths(key)
+        meta = {
+            'version': CACHE_FORMAT_VERSION,
+            'n_snps_read': int(idat.n_snps_read),
+            'barcode': idat.barcode,
+            'chip_type': idat.chip_type,
+            'section_offsets': {str(code): int(offset) for code, offset in idat.section_offsets.items()},
+        }
+        temp_suffix = f'{os.getpid()}.{threading.get_ident()}.tmp'
+        entry_size = 0
+        for name, array in (('illumina_ids', idat.illumina_ids), ('means', idat.means)):
+            temp_path = paths[name].with_name(f'{paths[name].name}.{temp_suffix}')
+            with open(temp_path, 'wb') as array_file:
+                np.save(array_file, np.ascontiguousarray(array))
+            entry_size += temp_path.stat().st_size
+            os.replace(temp_path, paths[name])
+        # the meta file is written last: an entry only counts once it exists.
+        temp_path = paths['meta'].with_name(f'{paths["meta"].name}.{temp_suffix}')
+        with open(temp_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        entry_size += temp_path.stat().st_size
+        os.replace(temp_path, paths['meta'])
+
+        with self.__lock:
+            if self.__size is None:
+                self.__size = self.get_size()
+            else:
+                self.__size += entry_size
+            if self.__size > self.max_size:
+                self.__size = self.evict()
+
+    def get_size(self):
+        return sum(path.stat().st_size for path in self.cache_dir.glob('*') if path.is_file())
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_size.
+
+        Returns:
+            [int] -- the total size of the entries left, in bytes.
+        """
+        entries = []
+        total_size = 0
+        for meta_path in self.cache_dir.glob('*.json'):
+            key = meta_path.name[:-len('.json')]
+            try:
+                files = [path for path in self.get_entry_paths(key).values() if path.exists()]
+                size = sum(path.stat().st_size for path in files)
+                last_used = meta_path.stat().st_mtime
+            except FileNotFoundError: # removed by another process
+                continue
+            entries.append((last_used, size, files))
+            total_size += size
+
+        for _last_used, size, files in sorted(entries, key=lambda entry: entry[0]):
+            if total_size <= self.max_size:
+                break
+            for path in files:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+        return total_size
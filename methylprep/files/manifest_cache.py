@@ -0,0 +1,184 @@
+# Lib
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+
+
+__all__ = ['ManifestCache']
+
+
+LOGGER = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+CACHE_DIR_SUFFIX = '.parsed'
+
+
+class ManifestCache():
+    """A compiled, binary copy of a parsed manifest, stored next to the manifest CSV.
+
+    Each DataFrame of the manifest (probes, controls, snp and mouse probes) is stored one
+    column per .npy file: numeric and address columns as typed arrays (memory-mapped on
+    load), and text columns (channel, probe type, chromosome...) as integer codes plus
+    their categories. A meta.json file records the dtypes, so loaded DataFrames are
+    identical to freshly parsed ones.
+
+    The cache is invalidated when the hash of the manifest file changes, or when the
+    array type (and so the number of probes to read) is different.
+
+    Arguments:
+        manifest_path {string or path-like} -- path to the manifest CSV (or .csv.gz).
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = Path(manifest_path)
+        self.cache_dir = self.manifest_path.with_name(self.manifest_path.name + CACHE_DIR_SUFFIX)
+        self.__source_hash = None
+
+    @property
+    def source_hash(self):
+        """blake2b hash of the manifest file, computed once."""
+        if self.__source_hash is None:
+            digest = hashlib.blake2b(digest_size=16)
+            with open(self.manifest_path, 'rb') as manifest_file:
+                for block in iter(lambda: manifest_file.read(1024 ** 2), b''):
+                    digest.update(block)
+            self.__source_hash = digest.hexdigest()
+        return self.__source_hash
+
+    def get_key(self, array_type):
+        return {
+            'version': CACHE_FORMAT_VERSION,
+            'source_hash': self.source_hash,
+            'array_type': str(array_type),
+            'num_probes': array_type.num_probes,
+            'num_controls': array_type.num_controls,
+        }
+
+    def load(self, array_type, names=None, categorical_columns=()):
+        """Returns a dict of the cached DataFrames, or None if the cache is missing or stale.
+        Only the frames in names are read, if given; frames that were never cached (the mouse
+        probes of other arrays) are left out of the dict. Text columns named in categorical_columns
+        are returned as categoricals, straight from their stored codes, instead of being expanded to strings."""
+        try:
+            with open(self.cache_dir.joinpath('meta.json'), 'r') as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+        if meta.get('key') != self.get_key(array_type):
+            LOGGER.info(f'Manifest cache for {self.manifest_path.name} is out of date')
+            return None
+
+        try:
+            return {
+                name: self.read_frame(name, frame_meta, categorical_columns)
+                for name, frame_meta in meta['frames'].items()
+                if names is None or name in names
+            }
+        except (OSError, ValueError, KeyError) as e:
+            LOGGER.warning(f'Could not load manifest cache {self.cache_dir}: {e}')
+            return None
+
+    def save(self, array_type, frames):
+        """Writes the DataFrames of a parsed manifest to the cache. The cache is built in a
+        temporary folder and moved into place, so readers never see a partial cache.
+
+        Returns:
+            [boolean] -- False if the cache could not be written (read-only folder, or
+                columns that cannot be stored), in which case the manifest is simply re-parsed next time.
+        """
+        temp_dir = self.cache_dir.with_name(f'{self.cache_dir.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            temp_dir.mkdir(parents=True, exist_ok=True)
+            meta = {
+                'key': self.get_key(array_type),
+                'frames': {
+                    name: self.write_frame(temp_dir, name, data_frame)
+                    for name, data_frame in frames.items()
+                },
+            }
+            with open(temp_dir.joinpath('meta.json'), 'w') as meta_file:
+                json.dump(meta, meta_file)
+            if self.cache_dir.exists():
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.rename(temp_dir, self.cache_dir)
+        except (OSError, TypeError) as e:
+            LOGGER.info(f'Manifest cache not written for {self.manifest_path.name}: {e}')
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return False
+        return True
+
+    def write_frame(self, cache_dir, name, data_frame):
+        columns = []
+        for idx, column in enumerate(data_frame.columns):
+            columns.append(self.write_values(cache_dir, f'{name}.{idx}', data_frame[column]))
+            columns[-1]['name'] = column
+        index = self.write_values(cache_dir, f'{name}.index', data_frame.index)
+        index['name'] = data_frame.index.name
+        return {'columns': columns, 'index': index}
+
+    def read_frame(self, name, frame_meta, categorical_columns=()):
+        data = {}
+        for idx, column_meta in enumerate(frame_meta['columns']):
+            as_categorical = column_meta['name'] in categorical_columns
+            data[column_meta['name']] = self.read_values(f'{name}.{idx}', column_meta, as_categorical)
+        index_meta = frame_meta['index']
+        index = pd.Index(self.read_values(f'{name}.index', index_meta), name=index_meta['name'])
+        columns = [column_meta['name'] for column_meta in frame_meta['columns']]
+        return pd.DataFrame(data, index=index, columns=columns)
+
+    @staticmethod
+    def write_values(cache_dir, prefix, values):
+        """Stores one column (or index) and returns its meta data.
+
+        Raises:
+            TypeError: For columns of mixed python objects, which are not cached.
+        """
+        dtype = values.dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            categories = np.asarray(dtype.categories)
+            if categories.dtype == object:
+                categories = categories.astype(str)
+            np.save(cache_dir.joinpath(f'{prefix}.codes.npy'), np.asarray(values.cat.codes if hasattr(values, 'cat') else values.codes))
+            np.save(cache_dir.joinpath(f'{prefix}.categories.npy'), categories)
+            return {'kind': 'categorical', 'ordered': bool(dtype.ordered)}
+        if isinstance(dtype, np.dtype) and dtype.kind in 'biuf':
+            np.save(cache_dir.joinpath(f'{prefix}.npy'), np.asarray(values))
+            return {'kind': 'numpy'}
+        if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+            # nullable extension types, such as the Int64 address columns
+            array = pd.array(values)
+            np.save(cache_dir.joinpath(f'{prefix}.npy'), array.to_numpy(dtype=array.dtype.numpy_dtype, na_value=0))
+            np.save(cache_dir.joinpath(f'{prefix}.mask.npy'), np.asarray(array.isna()))
+            return {'kind': 'masked', 'dtype': str(dtype)}
+
+        # text: stored as codes into a table of unique strings
+        codes, categories = pd.factorize(values, use_na_sentinel=True)
+        if not all(isinstance(category, str) for category in categories):
+            raise TypeError(f'cannot cache column {prefix} of mixed types')
+        np.save(cache_dir.joinpath(f'{prefix}.codes.npy'), codes.astype(np.int32))
+        np.save(cache_dir.joinpath(f'{prefix}.categories.npy'), np.asarray(categories, dtype=str))
+        return {'kind': 'strings', 'dtype': str(dtype)}
+
+    def read_values(self, prefix, meta, as_categorical=False):
+        path = lambda suffix: self.cache_dir.joinpath(f'{prefix}{suffix}')
+        kind = meta['kind']
+        if kind == 'numpy':
+            return np.load(path('.npy'), mmap_mode='r')
+        if kind == 'masked':
+            values = pd.array(np.load(path('.npy')), dtype=meta['dtype'])
+            values[np.load(path('.mask.npy'))] = pd.NA
+            return values
+        codes = np.load(path('.codes.npy'))
+        categories = np.load(path('.categories.npy'))
+        if kind == 'categorical' or as_categorical:
+            dtype = pd.CategoricalDtype(categories.astype(object), ordered=meta.get('ordered', False))
+            return pd.Categorical.from_codes(codes, dtype=dtype)
+        # missing values have code -1, which takes the NaN appended to the categories.
+        values = np.append(categories.astype(object), np.nan).take(codes)
+        return pd.array(values, dtype=meta['dtype'], copy=False)
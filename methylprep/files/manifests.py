@@ -1,10 +1,15 @@
 # Lib
+from collections import OrderedDict, namedtuple
+from io import BytesIO
 import logging
 from pathlib import Path
+import re
+import threading
 from urllib.parse import urljoin
 import numpy as np
 import pandas as pd
 # App
+from .manifest_cache import ManifestCache
 from ..models import ArrayType, Channel, ProbeType
 from ..utils import (
     download_file,
@@ -15,7 +20,7 @@ from ..utils import (
 )
 
 
-__all__ = ['Manifest']
+__all__ = ['Manifest', 'ManifestRegistry', 'MANIFEST_REGISTRY', 'ProbeSubsetIndex', 'ChromosomeIndex']
 
 
 LOGGER = logging.getLogger(__name__)
@@ -25,6 +30,7 @@ MANIFEST_DIR_PATH = f'~/{MANIFEST_DIR_NAME}'
 MANIFEST_DIR_PATH_LAMBDA = f'/tmp/{MANIFEST_DIR_NAME}'
 MANIFEST_BUCKET_NAME = 'array-manifest-files'
 MANIFEST_REMOTE_PATH = f'https://s3.amazonaws.com/{MANIFEST_BUCKET_NAME}/'
+MANIFEST_REGISTRY_SIZE = 2 # manifests kept in memory; an EPIC manifest takes a few hundred MB
 
 ARRAY_TYPE_MANIFEST_FILENAMES = {
     ArrayType.ILLUMINA_27K: 'hm27.hg19.manifest.csv.gz', #'humanmethylation27_270596_v1-2.csv.gz',
@@ -65,6 +71,25 @@ MOUSE_MANIFEST_COLUMNS = (
     'Probe_Type', # additional, needed to identify mouse-specific probes (mu) | and control probe sub_types
 )
 
+# compact=True manifests: low-cardinality text columns become categoricals, and these
+# integer columns are int32, with MISSING_VALUE in place of missing values.
+COMPACT_CATEGORY_COLUMNS = ('Infinium_Design_Type', 'Color_Channel', 'Genome_Build', 'CHR', 'Strand', 'Probe_Type')
+COMPACT_INTEGER_COLUMNS = ('AddressA_ID', 'AddressB_ID', 'MAPINFO')
+MISSING_VALUE = -1
+
+# sections of a manifest: the probes are always loaded, the others on first use.
+MANIFEST_SECTIONS = ('probes', 'controls', 'snp', 'mouse')
+LAZY_SECTIONS = ('controls', 'snp', 'mouse')
+
+IDAT_LAYOUTS_KEPT = 2 # IDAT address layouts, per manifest, whose probe positions are kept
+
+# row positions (in a manifest data frame) of one set of probes, and the address of each
+# of those rows. Both arrays are read-only, and shared by every sample using the manifest.
+ProbeSubsetIndex = namedtuple('ProbeSubsetIndex', ['key', 'positions', 'addresses'])
+
+# the probes on one chromosome, sorted by MAPINFO position (read-only arrays).
+ChromosomeIndex = namedtuple('ChromosomeIndex', ['positions', 'probes'])
+
 CONTROL_COLUMNS = (
     'Address_ID',
     'Control_Type',
@@ -84,29 +109,116 @@ class Manifest():
 
     Keyword Arguments:
         filepath_or_buffer {file-like} -- a pre-existing manifest filepath (default: {None})
+        use_cache {boolean} -- when reading from a path, load the parsed manifest from (or save it to)
+            a compiled cache folder next to the file, named <manifest filename>.parsed.
+            The cache is rebuilt whenever the manifest file changes. (default: {True})
+        compact {boolean} -- store the probe data frame in a compact form, several times smaller in memory:
+            Infinium_Design_Type, Color_Channel, Genome_Build, CHR, Strand, Probe_Type and probe_type are
+            categoricals (probe_type with int8 codes), while MAPINFO and the address columns are int32, with
+            MISSING_VALUE (-1) instead of NaN/pd.NA. Useful when many processes each hold a manifest. (default: {False})
 
     Raises:
         ValueError: The sample sheet is not formatted properly or a sample cannot be found.
     """
 
     __genome_df = None
+    __genomic_index = None
     __probe_type_subsets = None # apparently not used anywhere in methylprep
 
-    def __init__(self, array_type, filepath_or_buffer=None, on_lambda=False):
+    def __init__(self, array_type, filepath_or_buffer=None, on_lambda=False, use_cache=True, compact=False):
         self.array_type = array_type
         self.on_lambda = on_lambda # changes filepath to /tmp for the read-only file system
+        self.compact = compact
+        # probe selections are computed once per manifest, then reused for every sample.
+        self.__probe_details = {}
+        self.__subset_indexes = {}
+        self.__idat_positions = OrderedDict()
 
         if filepath_or_buffer is None:
             filepath_or_buffer = self.download_default(array_type, self.on_lambda)
 
+        # the control, snp and mouse sections are only loaded when first used (see get_section)
+        self.__source = filepath_or_buffer
+        self.__sections = {}
+        self.__sections_lock = threading.Lock()
+
+        # a compiled copy of the parsed manifest is kept next to the CSV (see ManifestCache)
+        self.__cache = None
+        if use_cache and not is_file_like(filepath_or_buffer):
+            self.__cache = ManifestCache(filepath_or_buffer)
+            frames = self.__cache.load(array_type, names=('probes',),
+                categorical_columns=COMPACT_CATEGORY_COLUMNS + ('probe_type',) if compact else ())
+            if frames is not None:
+                LOGGER.info(f'Loaded parsed manifest from {self.__cache.cache_dir.name}')
+                self.__set_probes(frames['probes'])
+                return
+
+        # the (gzipped) file is read and decompressed once; each section is then parsed from memory.
         with get_file_object(filepath_or_buffer) as manifest_file:
-            self.__data_frame = self.read_probes(manifest_file)
-            self.__control_data_frame = self.read_control_probes(manifest_file)
-            self.__snp_data_frame = self.read_snp_probes(manifest_file)
-            if self.array_type == ArrayType.ILLUMINA_MOUSE:
-                self.__mouse_data_frame = self.read_mouse_probes(manifest_file)
-            else:
-                self.__mouse_data_frame = pd.DataFrame()
+            manifest_data = self.read_manifest_data(manifest_file)
+
+        if self.__cache is None and not is_file_like(filepath_or_buffer):
+            # the file can be read again, if another section is needed
+            self.__set_probes(self.read_probes(manifest_data))
+            return
+
+        # file-like inputs cannot be read twice, and the cache is written with every section.
+        frames = self.read_sections(manifest_data, MANIFEST_SECTIONS)
+        self.__set_probes(frames['probes'])
+        self.__sections.update((name, frames.get(name, pd.DataFrame())) for name in LAZY_SECTIONS)
+        if self.__cache is not None:
+            self.__cache.save(array_type, frames)
+
+    def __set_probes(self, data_frame):
+        if self.compact:
+            data_frame = self.compact_data_frame(data_frame)
+        self.__data_frame = data_frame
+
+    def get_section(self, name):
+        """Returns one of the LAZY_SECTIONS of the manifest ('controls', 'snp' or 'mouse'), loading
+        it on first use: from the manifest cache if there is one, otherwise by reading the manifest
+        file again (parsing every section not yet loaded, so the file is read at most twice).
+
+        Arguments:
+            name {string} -- one of LAZY_SECTIONS.
+
+        Returns:
+            [DataFrame] -- the section; empty for the mouse section of other arrays.
+        """
+        if name not in LAZY_SECTIONS:
+            raise ValueError(f'{name} is not one of {LAZY_SECTIONS}')
+        with self.__sections_lock:
+            if name not in self.__sections:
+                frames = None
+                if self.__cache is not None:
+                    names = [name]
+                    frames = self.__cache.load(self.array_type, names=names)
+                if frames is None:
+                    names = [section for section in LAZY_SECTIONS if section not in self.__sections]
+                    with get_file_object(self.__source) as manifest_file:
+                        manifest_data = self.read_manifest_data(manifest_file)
+                    frames = self.read_sections(manifest_data, names)
+                for section in names:
+                    self.__sections[section] = frames.get(section, pd.DataFrame())
+            return self.__sections[name]
+
+    def read_sections(self, manifest_data, names):
+        """Parses the named sections of the manifest data. The mouse section is only read for mouse arrays.
+
+        Returns:
+            [dict] -- DataFrames keyed by section name ('probes', 'controls', 'snp', 'mouse').
+        """
+        readers = {
+            'probes': self.read_probes,
+            'controls': self.read_control_probes,
+            'snp': self.read_snp_probes,
+            'mouse': self.read_mouse_probes,
+        }
+        return {
+            name: readers[name](manifest_data)
+            for name in names
+            if name != 'mouse' or self.array_type == ArrayType.ILLUMINA_MOUSE
+        }
 
     @property
     def columns(self):
@@ -121,15 +233,15 @@ class Manifest():
 
     @property
     def control_data_frame(self):
-        return self.__control_data_frame
+        return self.get_section('controls')
 
     @property
     def snp_data_frame(self):
-        return self.__snp_data_frame
+        return self.get_section('snp')
 
     @property
     def mouse_data_frame(self):
-        return self.__mouse_data_frame
+        return self.get_section('mouse')
 
     @staticmethod
     def download_default(array_type, on_lambda=False):
@@ -152,6 +264,8 @@ class Manifest():
 
         LOGGER.info('Downloading manifest: %s', filename)
         src_url = urljoin(MANIFEST_REMOTE_PATH, filename)
+        # safe when several processes start at once: one downloads, the others wait for it.
+        # (no published digests: the gzipped manifests are verified by their gzip CRC, see download_file)
         download_file(filename, src_url, dir_path)
 
         return filepath
@@ -173,15 +287,50 @@ class Manifest():
         else:
             manifest_file.seek(current_pos - 1)
 
-    def read_probes(self, manifest_file):
-        LOGGER.info(f'Reading manifest file: {Path(manifest_file.name).stem}')
-
+    def read_manifest_data(self, manifest_file):
+        """Returns the bytes of the manifest, from the line before the "IlmnID" header to the end.
+        Every section of the manifest is parsed from this, so the file is only read once."""
+        if hasattr(manifest_file, 'name'):
+            LOGGER.info(f'Reading manifest file: {Path(manifest_file.name).stem}')
         self.seek_to_start(manifest_file)
+        return manifest_file.read()
+
+    @staticmethod
+    def get_line_starts(manifest_data):
+        """Returns the byte offset of every line in the manifest data."""
+        newlines = np.flatnonzero(np.frombuffer(manifest_data, dtype=np.uint8) == ord('\n'))
+        return np.concatenate(([0], newlines + 1))
+
+    def read_matching_rows(self, manifest_data, pattern):
+        """Parses only the rows of the manifest that match a regular expression (applied to
+        each line, with the header line always kept), instead of parsing the whole file and
+        filtering the DataFrame. The index is the row number the row would have in a
+        read_csv of the whole file."""
+        line_starts = self.get_line_starts(manifest_data)
+        line_ends = np.append(line_starts[1:] - 1, len(manifest_data))
+        data = np.frombuffer(manifest_data, dtype=np.uint8)
+        line_lengths = line_ends - line_starts
+        has_cr = (line_lengths > 0) & (data[np.maximum(line_ends - 1, 0)] == ord('\r'))
+        # read_csv skips blank lines, so they do not count towards the row numbers.
+        row_numbers = np.cumsum((line_lengths - has_cr) > 0) - 2
+
+        header_start = manifest_data.index(b'IlmnID')
+        header_line = manifest_data[header_start:manifest_data.index(b'\n', header_start)]
+        matches = [match for match in re.finditer(pattern, manifest_data, flags=re.MULTILINE) if match.start() > header_start]
+        match_lines = np.searchsorted(line_starts, [match.start() for match in matches], side='right') - 1
 
+        data_frame = pd.read_csv(
+            BytesIO(b'\n'.join([header_line] + [manifest_data[line_starts[line]:line_ends[line]] for line in match_lines])),
+            low_memory=False,
+        )
+        data_frame.index = pd.Index(row_numbers[match_lines], dtype='int64')
+        return data_frame
+
+    def read_probes(self, manifest_data):
         #print(f"DEBUG read_probes {self.get_data_types()}")
         #print(f"{self.columns}, {self.array_type.num_probes - 1}")
         data_frame = pd.read_csv(
-            manifest_file,
+            BytesIO(manifest_data),
             comment='[',
             dtype=self.get_data_types(),
             usecols=self.columns,
@@ -196,20 +345,9 @@ class Manifest():
         #LOGGER.info('AddressB_ID')
         #LOGGER.info(f"{data_frame['AddressB_ID']}")
 
-        def get_probe_type(name, infinium_type):
-            """what:
-        returns one of (I, II, SnpI, SnpII, Control)
-
-        how:
-            .from_manifest_values() returns probe type using either
-            the Infinium_Design_Type (I or II) or the name (starts with 'rs' == SnpI)
-            and 'Control' is none of the above."""
-            probe_type = ProbeType.from_manifest_values(name, infinium_type)
-            return probe_type.value
-
-        vectorized_get_type = np.vectorize(get_probe_type)
-
-        data_frame['probe_type'] = vectorized_get_type(
+        # one of (I, II, SnpI, SnpII, Control), from the Infinium_Design_Type (I or II) or
+        # the name (starts with 'rs' == SnpI); see ProbeType.from_manifest_values.
+        data_frame['probe_type'] = ProbeType.from_manifest_columns(
             data_frame.index.values,
             data_frame['Infinium_Design_Type'].values,
         )
@@ -220,50 +358,66 @@ class Manifest():
 
         return data_frame
 
-    def read_control_probes(self, manifest_file):
+    def read_control_probes(self, manifest_data):
         """ Unlike other probes, control probes have no IlmnID because they're not locus-specific.
         they also use arbitrary columns, ignoring the header at start of manifest file. """
         #LOGGER.info(f'Reading control probes: {Path(manifest_file.name).stem}')
 
-        self.seek_to_start(manifest_file)
-
         #num_headers = 4 -- removed on Jan 21 2020.
         # Steve Byerly added this =4, but the manifests seem to start controls at the point specified, with no extra columns based on .num_probes stored.
         num_headers = 0
 
         #print(f"CONTROLS nrows {self.array_type.num_controls} SKIP {self.array_type.num_probes + num_headers} usecols {range(len(CONTROL_COLUMNS))}")
+        # jump straight to the first control line (skipping num_probes physical lines, like skiprows did)
+        # instead of making read_csv tokenize the whole probe section again.
+        line_starts = self.get_line_starts(manifest_data)
+        skip_lines = self.array_type.num_probes + num_headers
+        control_start = line_starts[skip_lines] if skip_lines < len(line_starts) else len(manifest_data)
         return pd.read_csv(
-            manifest_file,
+            BytesIO(manifest_data[control_start:]),
             comment='[',
             header=None,
             index_col=0, # illumina_id, not IlmnID here
             names=CONTROL_COLUMNS, # this gives these columns new names, because they have none. loading stuff at end of CSV after probes end.
             nrows=self.array_type.num_controls,
-            skiprows=self.array_type.num_probes + num_headers,
             usecols=range(len(CONTROL_COLUMNS)),
         )
 
-    def read_snp_probes(self, manifest_file):
+    def read_snp_probes(self, manifest_data):
         """ Unlike cpg and control probes, these rs probes are NOT sequential in all arrays. """
         #LOGGER.info(f'Reading snp probes: {Path(manifest_file.name).stem} --> {snp_df.shape[0]} found')
-        self.seek_to_start(manifest_file)
-        # since these are not sequential, loading everything and filtering by IlmnID.
-        snp_df = pd.read_csv(
-            manifest_file,
-            low_memory=False)
-        snp_df = snp_df[snp_df['IlmnID'].str.match('rs', na=False)]
-        return snp_df
-
-    def read_mouse_probes(self, manifest_file):
+        # since these are not sequential, only the lines starting with 'rs' are parsed.
+        return self.read_matching_rows(manifest_data, rb'^rs')
+
+    def read_mouse_probes(self, manifest_data):
         """ ILLUMINA_MOUSE contains unique probes whose names begin with 'mu' and 'rp'
         for 'murine' and 'repeat', respectively. This creates a dataframe of these probes,
         which are not processed like normal cg/ch probes. """
-        self.seek_to_start(manifest_file)
-        mouse_df = pd.read_csv(
-            manifest_file,
-            low_memory=False) # low_memory=Fase is required because control probes create mixed-types in columns.
-        mouse_df = mouse_df[(mouse_df['Probe_Type'] == 'rp') | (mouse_df['IlmnID'].str.startswith('uk', na=False)) | (mouse_df['Probe_Type'] == 'mu')] # 'mu' probes now start with 'cg' instead and have 'mu' in another column
-        return mouse_df
+        # 'mu' probes now start with 'cg' instead and have 'mu' in the Probe_Type column.
+        # (assumes no quoted commas before Probe_Type, which holds for the mouse manifest columns)
+        header_start = manifest_data.index(b'IlmnID')
+        header = manifest_data[header_start:manifest_data.index(b'\n', header_start)].rstrip(b'\r').split(b',')
+        probe_type_field = header.index(b'Probe_Type')
+        pattern = rb'^(?:uk|(?:[^,\n]*,){%d}(?:rp|mu)(?:,|\r?$))' % probe_type_field
+        return self.read_matching_rows(manifest_data, pattern)
+
+    @staticmethod
+    def compact_data_frame(data_frame):
+        """Returns the probe data frame with categorical and int32 columns (see compact in Manifest)."""
+        columns = {}
+        for column in COMPACT_CATEGORY_COLUMNS:
+            if column in data_frame.columns:
+                values = data_frame[column].astype('category')
+                # columns loaded as categoricals from the cache keep the order values were seen in
+                columns[column] = values.cat.reorder_categories(sorted(values.cat.categories))
+        for column in COMPACT_INTEGER_COLUMNS:
+            if column in data_frame.columns:
+                values = pd.to_numeric(data_frame[column], errors='coerce')
+                columns[column] = values.fillna(MISSING_VALUE).astype(np.int32)
+        if 'probe_type' in data_frame.columns:
+            # fixed categories (fewer than 128), so the codes are int8 and the same for every manifest
+            columns['probe_type'] = pd.Categorical(data_frame['probe_type'], categories=[probe_type.value for probe_type in ProbeType])
+        return data_frame.assign(**columns)
 
     def map_to_genome(self, data_frame):
         genome_df = self.get_genome_data()
@@ -286,6 +440,120 @@ class Manifest():
         self.__genome_df = self.data_frame[genome_columns]
         return self.__genome_df
 
+    @staticmethod
+    def normalize_chromosome(chromosome):
+        """Chromosome names without any 'chr' prefix, so '1', 'chr1' and 1 match the same CHR values."""
+        chromosome = str(chromosome).strip()
+        if chromosome[:3].lower() == 'chr':
+            chromosome = chromosome[3:]
+        return chromosome.upper()
+
+    def get_genomic_index(self):
+        """Returns the probes of the manifest grouped by chromosome and sorted by position, built
+        once per manifest. Probes without a CHR or MAPINFO value are left out.
+
+        Returns:
+            [dict] -- a ChromosomeIndex (positions, probes) per chromosome name (see normalize_chromosome).
+        """
+        if self.__genomic_index is not None:
+            return self.__genomic_index
+
+        positions = pd.to_numeric(self.data_frame['MAPINFO'], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        chromosomes = self.data_frame['CHR'].astype(object).to_numpy()
+        has_position = (positions > 0) & pd.notna(chromosomes)
+        rows = np.flatnonzero(has_position)
+
+        # names are normalized once per distinct CHR value, then 'chr1' and '1' share a code
+        chromosome_codes, chromosome_values = pd.factorize(chromosomes[rows])
+        normalized_codes, chromosome_names = pd.factorize(np.array([self.normalize_chromosome(value) for value in chromosome_values], dtype=object))
+        chromosome_codes = normalized_codes[chromosome_codes]
+        order = np.lexsort((positions[rows], chromosome_codes))
+        rows = rows[order]
+        chromosome_codes = chromosome_codes[order]
+        starts = np.flatnonzero(np.diff(chromosome_codes, prepend=-1))
+        ends = np.append(starts[1:], len(rows))
+
+        probe_names = self.data_frame.index.to_numpy(dtype=object)
+        genomic_index = {}
+        for start, end in zip(starts, ends):
+            chromosome_positions = positions[rows[start:end]].astype(np.int64)
+            chromosome_probes = probe_names[rows[start:end]]
+            chromosome_positions.flags.writeable = False
+            chromosome_probes.flags.writeable = False
+            genomic_index[chromosome_names[chromosome_codes[start]]] = ChromosomeIndex(chromosome_positions, chromosome_probes)
+        self.__genomic_index = genomic_index
+        return self.__genomic_index
+
+    def probes_in_region(self, chromosome, start, end):
+        """Returns the probes between two positions on a chromosome, found by binary search in the
+        genomic index (see get_genomic_index).
+
+        Arguments:
+            chromosome {string or int} -- chromosome name, with or without a 'chr' prefix (e.g. 'chr7', '7' or 7).
+            start {int} -- first position of the region, in manifest (MAPINFO, 1-based) coordinates.
+            end {int} -- last position of the region, included.
+
+        Returns:
+            [Index] -- IlmnIDs of the probes in the region, in position order.
+        """
+        chromosome_index = self.get_genomic_index().get(self.normalize_chromosome(chromosome))
+        if chromosome_index is None:
+            return pd.Index([], dtype=object, name=self.data_frame.index.name)
+        first = np.searchsorted(chromosome_index.positions, start, side='left')
+        last = np.searchsorted(chromosome_index.positions, end, side='right')
+        return pd.Index(chromosome_index.probes[first:last], name=self.data_frame.index.name)
+
+    @staticmethod
+    def read_regions(regions):
+        """Reads regions into a DataFrame with chromosome, start and end columns, in manifest
+        (1-based, end included) coordinates.
+
+        Arguments:
+            regions -- one of:
+                a path to a BED file (tab separated chromosome, start and end; 0-based, end excluded);
+                a DataFrame whose first three columns are chromosome, start and end (1-based, end included);
+                a list of (chromosome, start, end) tuples (1-based, end included).
+        """
+        if isinstance(regions, (str, Path)):
+            bed = pd.read_csv(regions, sep='\t', header=None, usecols=[0, 1, 2], comment='#',
+                names=['chromosome', 'start', 'end'], dtype={0: str})
+            bed = bed[~bed['chromosome'].str.startswith(('track', 'browser'))]
+            return bed.assign(start=bed['start'].astype(np.int64) + 1, end=bed['end'].astype(np.int64))
+        if isinstance(regions, pd.DataFrame):
+            regions = regions.iloc[:, :3].itertuples(index=False, name=None)
+        return pd.DataFrame(list(regions), columns=['chromosome', 'start', 'end'])
+
+    def probes_in_regions(self, regions):
+        """Returns the probes in any of several regions, such as the targets of a panel.
+
+        Arguments:
+            regions -- a BED file path, a DataFrame or a list of (chromosome, start, end) tuples; see read_regions.
+
+        Returns:
+            [Index] -- unique IlmnIDs of the probes in the regions, by chromosome (in the order the
+                regions list them), then by position.
+        """
+        regions = self.read_regions(regions)
+        genomic_index = self.get_genomic_index()
+        probes = []
+        chromosomes = regions['chromosome'].map(self.normalize_chromosome)
+        for chromosome, chromosome_regions in regions.groupby(chromosomes, sort=False):
+            chromosome_index = genomic_index.get(chromosome)
+            if chromosome_index is None:
+                continue
+            # a mask of the probes covered by any region, so overlapping regions count each probe once
+            firsts = np.searchsorted(chromosome_index.positions, chromosome_regions['start'].to_numpy(np.int64), side='left')
+            lasts = np.searchsorted(chromosome_index.positions, chromosome_regions['end'].to_numpy(np.int64), side='right')
+            covered = firsts < lasts
+            firsts, lasts = firsts[covered], lasts[covered]
+            coverage = np.zeros(len(chromosome_index.positions) + 1, dtype=np.int64)
+            np.add.at(coverage, firsts, 1)
+            np.add.at(coverage, lasts, -1)
+            probes.append(chromosome_index.probes[np.cumsum(coverage[:-1]) > 0])
+        if not probes:
+            return pd.Index([], dtype=object, name=self.data_frame.index.name)
+        return pd.Index(np.concatenate(probes), name=self.data_frame.index.name)
+
     def get_data_types(self):
         data_types = {
             key: str for key in self.columns
@@ -307,18 +575,200 @@ class Manifest():
     def get_probe_details(self, probe_type, channel=None):
         """given a probe type (I, II, SnpI, SnpII, Control) and a channel (Channel.RED | Channel.GREEN),
         This will return info needed to map probes to their names (e.g. cg0031313 or rs00542420),
-        which are NOT in the idat files."""
+        which are NOT in the idat files.
+        The selection is computed once per manifest; treat the returned DataFrame as read-only."""
         if not isinstance(probe_type, ProbeType):
             raise Exception('probe_type is not a valid ProbeType')
 
         if channel and not isinstance(channel, Channel):
             raise Exception('channel not a valid Channel')
 
-        data_frame = self.data_frame
-        probe_type_mask = data_frame['probe_type'].values == probe_type.value
+        key = (probe_type, channel)
+        if key not in self.__probe_details:
+            data_frame = self.data_frame
+            mask = data_frame['probe_type'].values == probe_type.value
+            if channel:
+                mask &= data_frame['Color_Channel'].values == channel.value
+            self.__probe_details[key] = data_frame[mask]
+        return self.__probe_details[key]
+
+    def get_subset_index(self, probe_type, channel, probe_address):
+        """Returns the ProbeSubsetIndex of the probes of one type and channel that have a value
+        in the probe_address column (AddressA_ID or AddressB_ID): their row positions in
+        data_frame, and the addresses to read from the IDAT files. Computed once per manifest.
+
+        Arguments:
+            probe_type {ProbeType} -- as in get_probe_details.
+            channel {Channel or None} -- as in get_probe_details.
+            probe_address {ProbeAddress} -- which address column to use.
+        """
+        key = (probe_type, channel, probe_address)
+        if key not in self.__subset_indexes:
+            data_frame = self.data_frame
+            mask = data_frame['probe_type'].values == probe_type.value
+            if channel:
+                mask &= data_frame['Color_Channel'].values == channel.value
+            addresses = data_frame[probe_address.header_name]
+            if self.compact:
+                missing = mask & (addresses.values == MISSING_VALUE)
+            else:
+                missing = mask & addresses.isna().values
+            if missing.any():
+                LOGGER.warning(f'{missing.sum()} {probe_type} probes have no {probe_address.header_name} in the manifest '
+                    f'and are left out; these probes are probably incorrect in your manifest: {list(data_frame.index[missing][:10])}')
+            positions = np.flatnonzero(mask & ~missing)
+            self.__subset_indexes[key] = self.__read_only_index(
+                key, positions, addresses.values[positions].astype(np.int64))
+        return self.__subset_indexes[key]
+
+    def get_control_index(self):
+        """Returns the ProbeSubsetIndex of the control probes (rows of control_data_frame)."""
+        key = 'controls'
+        if key not in self.__subset_indexes:
+            # rows whose address is not a number cannot match an IDAT address, so they are left out
+            addresses = pd.to_numeric(pd.Series(self.control_data_frame.index), errors='coerce').values
+            positions = np.flatnonzero(~np.isnan(addresses))
+            self.__subset_indexes[key] = self.__read_only_index(key, positions, addresses[positions].astype(np.int64))
+        return self.__subset_indexes[key]
+
+    @staticmethod
+    def __read_only_index(key, positions, addresses):
+        positions.flags.writeable = False
+        addresses.flags.writeable = False
+        return ProbeSubsetIndex(key, positions, addresses)
 
-        if not channel:
-            return data_frame[probe_type_mask]
+    def get_idat_positions(self, subset_index, idat_dataset):
+        """Returns the position of each address of a ProbeSubsetIndex in an IDAT's illumina_ids
+        (and means), or -1 for addresses the IDAT does not have. Samples from the same array share
+        one address layout, so positions are computed once per layout and reused for every sample.
 
-        channel_mask = data_frame['Color_Channel'].values == channel.value
-        return data_frame[probe_type_mask & channel_mask]
+        Arguments:
+            subset_index {ProbeSubsetIndex} -- from get_subset_index or get_control_index.
+            idat_dataset {IdatDataset} -- the IDAT to read values from.
+        """
+        layout_key = idat_dataset.layout_key
+        if layout_key not in self.__idat_positions:
+            illumina_ids = np.asarray(idat_dataset.illumina_ids)
+            sorter = np.argsort(illumina_ids, kind='stable')
+            self.__idat_positions[layout_key] = {'sorted_ids': illumina_ids[sorter], 'sorter': sorter}
+            while len(self.__idat_positions) > IDAT_LAYOUTS_KEPT:
+                self.__idat_positions.popitem(last=False)
+        self.__idat_positions.move_to_end(layout_key)
+        layout = self.__idat_positions[layout_key]
+
+        key = subset_index.key
+        if key not in layout:
+            sorted_ids = layout['sorted_ids']
+            addresses = subset_index.addresses
+            sorted_positions = np.minimum(np.searchsorted(sorted_ids, addresses), max(len(sorted_ids) - 1, 0))
+            found = (sorted_ids[sorted_positions] == addresses) if len(sorted_ids) else np.zeros(len(addresses), dtype=bool)
+            positions = np.where(found, layout['sorter'][sorted_positions], -1)
+            positions.flags.writeable = False
+            layout[key] = positions
+        return layout[key]
+
+    def get_subset_means(self, subset_index, idat_dataset, idat_order=False):
+        """Gathers the mean intensities of a ProbeSubsetIndex's probes from one IDAT, with np.take
+        instead of a DataFrame merge.
+
+        Arguments:
+            subset_index {ProbeSubsetIndex} -- from get_subset_index or get_control_index.
+            idat_dataset {IdatDataset} -- the IDAT to read values from.
+
+        Keyword Arguments:
+            idat_order {boolean} -- if True, probes are returned in the order of the IDAT file
+                instead of the order of the manifest. (default: {False})
+
+        Returns:
+            [tuple(ndarray, ndarray)] -- which probes of subset_index the IDAT has (as positions into
+                subset_index.positions and .addresses), and their mean values.
+        """
+        idat_positions = self.get_idat_positions(subset_index, idat_dataset)
+        found = np.flatnonzero(idat_positions >= 0)
+        if idat_order:
+            found = found[np.argsort(idat_positions[found], kind='stable')]
+        positions = idat_positions[found]
+        # straight from the IDAT arrays, without building its probe_means DataFrame
+        means = idat_dataset.means.take(positions)
+        if idat_dataset.min_beads:
+            # as in IdatDataset.build_probe_means: probes on fewer beads are NaN, in float32
+            masked = idat_dataset.n_beads.take(positions) < idat_dataset.min_beads
+            means = np.where(masked, np.float32(np.nan), means.astype('float32'))
+        return found, means
+
+    def get_design_index(self, infinium_type, channel=None):
+        """Returns the probe names (IlmnID) with the given Infinium_Design_Type (and Color_Channel),
+        as used by the pOOBah p-value method. Computed once per manifest."""
+        key = ('design', infinium_type, channel)
+        if key not in self.__subset_indexes:
+            data_frame = self.data_frame
+            mask = data_frame['Infinium_Design_Type'].values == infinium_type
+            if channel:
+                mask &= data_frame['Color_Channel'].values == channel.value
+            self.__subset_indexes[key] = data_frame.index[mask]
+        return self.__subset_indexes[key]
+
+class ManifestRegistry():
+    """Keeps recently used Manifest instances in memory, so that every batch of run_pipeline
+    (and every series processed in the same session) shares one parsed manifest.
+
+    Manifests are keyed by (array_type, manifest path, hash of the manifest file), so an
+    edited manifest file is loaded again. The returned Manifest is shared: treat its
+    data frames as read-only. When more than max_size manifests are held, the least
+    recently used one is dropped.
+
+    Keyword Arguments:
+        max_size {int} -- number of manifests to keep (default: {MANIFEST_REGISTRY_SIZE})
+    """
+
+    def __init__(self, max_size=MANIFEST_REGISTRY_SIZE):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.max_size = max_size
+        self.__manifests = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__manifests)
+
+    @staticmethod
+    def get_key(array_type, filepath, compact=False):
+        filepath = Path(filepath).expanduser().resolve()
+        return (str(array_type), str(filepath), ManifestCache(filepath).source_hash, compact)
+
+    def get(self, array_type, filepath=None, on_lambda=False, compact=False):
+        """Returns the Manifest for an array type (and optional custom manifest file),
+        loading it only if it is not already held.
+
+        Arguments:
+            array_type {ArrayType} -- The type of array to process.
+
+        Keyword Arguments:
+            filepath {path-like} -- a custom manifest file. If not provided, the default
+                manifest of the array_type is used, and downloaded if necessary. (default: {None})
+            on_lambda {boolean} -- see Manifest (default: {False})
+            compact {boolean} -- see Manifest (default: {False})
+        """
+        if is_file_like(filepath):
+            return Manifest(array_type, filepath, on_lambda=on_lambda, compact=compact)
+        if filepath is None:
+            filepath = Manifest.download_default(array_type, on_lambda)
+
+        key = self.get_key(array_type, filepath, compact)
+        # held while loading, so concurrent callers wait for one load instead of each parsing the file.
+        with self.__lock:
+            if key in self.__manifests:
+                self.__manifests.move_to_end(key)
+                return self.__manifests[key]
+            manifest = Manifest(array_type, filepath, on_lambda=on_lambda, compact=compact)
+            self.__manifests[key] = manifest
+            while len(self.__manifests) > self.max_size:
+                self.__manifests.popitem(last=False)
+        return manifest
+
+    def clear(self):
+        with self.__lock:
+            self.__manifests.clear()
+
+
+MANIFEST_REGISTRY = ManifestRegistry()
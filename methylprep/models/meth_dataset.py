@@ -1,8 +1,10 @@
 # Lib
 import logging
+import numpy as np
 import pandas as pd
 # App
 from ..models import (
+    Channel,
     METHYLATED_PROBE_SUBSETS,
     UNMETHYLATED_PROBE_SUBSETS,
     METHYLATED_SNP_PROBES,
@@ -22,6 +24,11 @@ class MethylationDataset():
     """Wrapper for a collection of methylated or unmethylated probes and their mean intensity values,
     providing common functionality for the subset of probes.
 
+    Values are stored column-wise: the probes of every ProbeSubset, one subset after another, share
+    one fixed order, and each value (address, channel, mean_value, then bg_corrected and noob once
+    set) is a numpy array in that order, filled in by position. data_frame (and data_frames, one
+    frame per ProbeSubset) are built from these arrays, with the probes' manifest columns, when used.
+
     Arguments:
         raw_dataset {RawDataset} -- A sample's RawDataset for a single well on the processed array.
         manifest {Manifest} -- The Manifest for the correlated RawDataset's array type.
@@ -37,12 +44,39 @@ class MethylationDataset():
         self.probe_subsets = probe_subsets
         self.raw_dataset = raw_dataset # __init__ uses red_idat and green_idat IdatDatasets
 
-        self.data_frames = {
-            probe_subset: self._get_subset_means(manifest, probe_subset)
-            for probe_subset in probe_subsets
-        }
-
-        self.data_frame = self.build_data_frame()
+        # the manifest rows and IDAT positions of each subset are computed once per manifest;
+        # here they are only gathered. Probes with no address in the manifest are left out (with a warning).
+        positions, addresses, channels, mean_values = [], [], [], []
+        self.subset_rows = {}
+        start = 0
+        for probe_subset in probe_subsets:
+            subset_index = manifest.get_subset_index(probe_subset.probe_type, probe_subset.probe_channel, probe_subset.probe_address)
+            idat_dataset = raw_dataset.get_channel_idat(probe_subset.data_channel)
+            found, subset_means = manifest.get_subset_means(subset_index, idat_dataset)
+            positions.append(subset_index.positions[found])
+            addresses.append(subset_index.addresses[found])
+            channels.append(np.full(len(found), probe_subset.data_channel.value))
+            mean_values.append(subset_means)
+            self.subset_rows[probe_subset] = slice(start, start + len(found))
+            start += len(found)
+
+        self.positions = np.concatenate(positions) # rows in the manifest data_frame
+        self.address = np.concatenate(addresses)
+        self.channel = np.concatenate(channels)
+        self.mean_value = np.concatenate(mean_values)
+        self.bg_corrected = None
+        self.noob = None
+        self.__manifest_data_frame = manifest.data_frame
+        self.index = manifest.data_frame.index.take(self.positions)
+        self.__data_frame = None
+
+    def __getstate__(self):
+        # only the manifest rows of these probes are pickled, not the whole manifest
+        state = self.__dict__.copy()
+        state['_MethylationDataset__manifest_data_frame'] = self.__manifest_data_frame.take(self.positions)
+        state['positions'] = np.arange(len(self.positions))
+        state['_MethylationDataset__data_frame'] = None
+        return state
 
     @classmethod
     def methylated(cls, raw_dataset, manifest):
@@ -74,70 +108,66 @@ class MethylationDataset():
     #    """ convenience method that feeds in a pre-defined list of UNmethylated MOUSE specific probes """
     #    return cls(raw_dataset, manifest, UNMETHYLATED_MOUSE_PROBES)
 
-    def build_data_frame(self):
-        return pd.concat(self.data_frames.values())
-
-    def _get_subset_means(self, manifest, probe_subset):
-        channel_means = self.raw_dataset.get_channel_means(probe_subset.data_channel)
-        channel_means = channel_means.assign(Channel=probe_subset.data_channel.value)
-
-        probe_details = probe_subset.get_probe_details(manifest)
-
-        # check here for probes that are missing data in manifest, and drop them if they are (better to be imperfect with warnings)
-        if probe_details[probe_subset.probe_address.header_name].isna().sum() > 0:
-            print('These probes are probably incorrect in your manifest; processing cannot continue.')
-            print( probe_details.loc[ probe_details[probe_subset.probe_address.header_name].isna() ].index )
-            pre_shape = probe_details.shape
-            probe_details = probe_details.drop( probe_details[ probe_details[probe_subset.probe_address.header_name].isna() ].index )
-            print(f"{pre_shape[0] - probe_details.shape[0]} removed; {probe_details[probe_subset.probe_address.header_name].isna().sum()} nan remaining; but downstream steps will not work.")
-            # this still won't fix it, because OOB also does some filtering.
+    @property
+    def data_frame(self):
+        """All probes, with their manifest columns and values, in one DataFrame. Built when first used
+        (and again after the values change)."""
+        if self.__data_frame is None:
+            self.__data_frame = self.build_data_frame()
+        return self.__data_frame
+
+    @property
+    def data_frames(self):
+        """One DataFrame per ProbeSubset, as in data_frame."""
+        return {
+            probe_subset: self.build_data_frame(rows)
+            for probe_subset, rows in self.subset_rows.items()
+        }
 
-        return probe_details.merge(
-            channel_means,
-            how='inner',
-            left_on=probe_subset.probe_address.header_name,
-            right_index=True,
-            suffixes=(False, False),
-        )
+    def build_data_frame(self, rows=slice(None)):
+        columns = {'mean_value': self.mean_value[rows], 'Channel': self.channel[rows]}
+        if self.bg_corrected is not None:
+            columns['bg_corrected'] = self.bg_corrected[rows]
+        if self.noob is not None:
+            columns['noob'] = self.noob[rows]
+        return self.__manifest_data_frame.take(self.positions[rows]).assign(**columns)
+
+    def get_column(self, column):
+        """Returns one value column ('mean_value', 'bg_corrected' or 'noob') as a Series indexed by
+        probe name, without building the whole data_frame."""
+        values = getattr(self, column) if column in ('mean_value', 'bg_corrected', 'noob') else None
+        if values is None:
+            raise KeyError(f'{column} is not set for this MethylationDataset')
+        return pd.Series(values, index=self.index, name=column)
 
     def set_bg_corrected(self, green_corrected, red_corrected):
-        for probe_subset in self.data_frames:
-            if probe_subset.is_red:
-                corrected_values = red_corrected
-            elif probe_subset.is_green:
-                corrected_values = green_corrected
-            else:
-                raise ValueError('No data_channel for probe_subset')
-
-            self._set_subset_bg_corrected(probe_subset, corrected_values)
-
-        self.data_frame = self.build_data_frame()
+        """Sets bg_corrected for every probe, from the values of its address in the channel it is read from.
+
+        Arguments:
+            green_corrected, red_corrected {DataFrame} -- foreground probes with a bg_corrected column,
+                indexed by address (illumina_id), as returned by normexp_bg_corrected.
+        """
+        # kept in the precision the values were corrected in (float64, or float32)
+        bg_corrected = np.full(len(self.index), np.nan, dtype=np.result_type(green_corrected['bg_corrected'], red_corrected['bg_corrected']))
+        for channel, corrected_values in ((Channel.GREEN, green_corrected), (Channel.RED, red_corrected)):
+            rows = self.channel == channel.value
+            indexer = corrected_values.index.get_indexer(self.address[rows])
+            if (indexer < 0).any():
+                missing = self.address[rows][indexer < 0]
+                raise KeyError(f'{len(missing)} {channel} probe addresses have no bg_corrected value: {list(missing[:10])}')
+            bg_corrected[rows] = corrected_values['bg_corrected'].to_numpy(dtype=bg_corrected.dtype).take(indexer)
+        self.set_bg_corrected_values(bg_corrected)
+
+    def set_bg_corrected_values(self, bg_corrected):
+        """Sets bg_corrected from an array that is already in probe order (as preprocess_noob_batch computes it)."""
+        if len(bg_corrected) != len(self.index):
+            raise ValueError(f'Expected {len(self.index)} bg_corrected values, got {len(bg_corrected)}')
+        self.bg_corrected = bg_corrected
+        self.__data_frame = None
         self.__bg_corrected = True
 
-    def _set_subset_bg_corrected(self, probe_subset, corrected_values):
-        original = self.data_frames[probe_subset]
-        column = probe_subset.column_name
-
-        filtered_corrected = corrected_values.loc[original[column]]
-        
-        updated = original.merge(
-            filtered_corrected[['bg_corrected']],
-            how='inner',
-            left_on=column,
-            right_index=True,
-            suffixes=(False, False),
-        )
-
-        self.data_frames[probe_subset] = updated
-
     def set_noob(self, red_factor):
-        for probe_subset, data_frame in self.data_frames.items():
-            if probe_subset.is_red:
-                data_frame = data_frame.assign(noob=data_frame['bg_corrected'] * red_factor)
-            else:
-                data_frame = data_frame.assign(noob=data_frame['bg_corrected'])
-
-            self.data_frames[probe_subset] = data_frame
-
-        self.data_frame = self.build_data_frame()
+        red_factor = self.bg_corrected.dtype.type(red_factor)
+        self.noob = np.where(self.channel == Channel.RED.value, self.bg_corrected * red_factor, self.bg_corrected)
+        self.__data_frame = None
         self.__preprocessed = True
@@ -1,5 +1,6 @@
 # Lib
 from enum import Enum, unique
+import numpy as np
 
 
 @unique
@@ -97,6 +98,41 @@ class ProbeType(Enum):
 
         return ProbeType.CONTROL
 
+    @staticmethod
+    def from_manifest_columns(names, infinium_types):
+        """Vectorized from_manifest_values(), for whole manifest columns at once: classifies
+        every probe with prefix masks instead of one python call per row.
+
+        Arguments:
+            names {array-like} -- the probe names (IlmnID).
+            infinium_types {array-like} -- the Infinium_Design_Type values, same length.
+
+        Returns:
+            [ndarray] -- the ProbeType value ('I', 'II', 'SnpI', 'SnpII' or 'Control') of each probe."""
+        # truncating to fixed-width numpy strings gives the prefixes of every name in one pass.
+        prefixes = np.asarray(names, dtype=object).astype('U3')
+        infinium_types = np.asarray(infinium_types, dtype=object)
+        is_snp = prefixes.astype('U2') == 'rs'
+        is_control = is_snp | np.isin(prefixes, ['ctl', 'neg', 'BSC', 'NON'])
+        is_type_one = infinium_types == 'I'
+        is_type_two = infinium_types == 'II'
+        # same order of precedence as from_manifest_values
+        conditions = [
+            is_snp & is_type_one,
+            is_snp & is_type_two,
+            is_control,
+            is_type_one | (infinium_types == 'IR') | (infinium_types == 'IG'), # IR/IG: mouse type I probes
+            is_type_two,
+        ]
+        choices = [
+            ProbeType.SNP_ONE.value,
+            ProbeType.SNP_TWO.value,
+            ProbeType.CONTROL.value,
+            ProbeType.ONE.value,
+            ProbeType.TWO.value,
+        ]
+        return np.select(conditions, choices, default=ProbeType.CONTROL.value)
+
 
 class Probe():
     """ this doesn't appear to be instantiated anywhere in methylprep """
@@ -120,19 +120,23 @@ Keyword Arguments:
     def get_file_s3(self, zip_reader, extension, suffix=None):
         """ replaces get_filepath, but for `s3` context. Since these files
         are compressed within a single zipfile in the bucket, they don't
-        resolve to PurePaths."""
+        resolve to PurePaths.
+
+        Also used for other archive readers with the same interface, such as
+        methylprep.files.TarIdatReader for GEO _RAW.tar files, where IDATs are stored as `.idat.gz`."""
         _suffix = ''
         if suffix is not None:
             _suffix = f'_{suffix}'
 
         filename_to_match = f'{self.base_filename}{_suffix}.{extension}'
         for zip_filename in zip_reader.file_names:
-            if not zip_filename.endswith('.idat'):
+            if not (zip_filename.endswith('.idat') or zip_filename.endswith('.idat.gz')):
                 continue
             if filename_to_match in zip_filename:
                 # this is packed within the zipfile still, but zip_reader can fetch it.
                 LOGGER.info(zip_reader.get_file_info(zip_filename))
                 return zip_reader.get_file(zip_filename, match_partial=False)
+        raise FileNotFoundError(f'No files in archive match this sample id: {filename_to_match}')
 
     def _build_and_verify_path(self, filename, alt_filename=None, allow_compressed=False):
         """
@@ -1,6 +1,7 @@
 from .pipeline import SampleDataContainer, get_manifest, run_pipeline
-from .preprocess import preprocess_noob
-from .raw_dataset import RawDataset, get_raw_datasets, get_array_type
+from .preprocess import preprocess_noob, preprocess_noob_batch
+from .quantile_normalization import QuantileReference
+from .raw_dataset import RawDataset, get_raw_datasets, get_raw_meta_datasets, get_array_type
 from .postprocess import consolidate_values_for_sheet
 from .read_geo_processed import read_geo, detect_header_pattern
 
@@ -9,7 +10,10 @@ __all__ = [
     'SampleDataContainer',
     'get_manifest',
     'get_raw_datasets',
+    'get_raw_meta_datasets',
     'preprocess_noob',
+    'preprocess_noob_batch',
+    'QuantileReference',
     'run_pipeline',
     'consolidate_values_for_sheet',
     'get_array_type',
@@ -7,6 +7,8 @@ from scipy import stats
 from statsmodels.distributions.empirical_distribution import ECDF
 import pandas as pd
 import numpy as np
+# App
+from ..models import Channel
 
 
 def _pval_minfi(data_containers):
@@ -131,37 +133,39 @@ def _pval_sesame_preprocess(data_container, column='mean_value'):
     - this will be saved to the csv output, so it can be used to drop probes at later step.
     - output: index are probes (IlmnID or illumina_id); one column [poobah_pval] contains the sample p-values.
     - called by pipeline CLI --poobah option."""
-    meth = data_container.methylated.data_frame
-    unmeth = data_container.unmethylated.data_frame
-    manifest = data_container.manifest.data_frame[['Infinium_Design_Type','Color_Channel']]
+    meth = data_container.methylated.get_column(column).to_frame()
+    unmeth = data_container.unmethylated.get_column(column).to_frame()
+    manifest = data_container.manifest
     #print(f"DEBUG meth {meth.head()}")
     #print(f"DEBUG unmeth {unmeth.head()}")
-    #print(f"DEBUG manifest {manifest.head()}")
-    if manifest.index.name != meth.index.name or manifest.index.name != unmeth.index.name:
-        raise KeyError(f"manifest probe_column ({manifest.dataframe.index.name}) does not match meth/unmeth probe names from idats ({meth.index.name}).")
-    probe_column = manifest.index.name
+    #print(f"DEBUG manifest {manifest.data_frame.head()}")
+    if manifest.data_frame.index.name != meth.index.name or manifest.data_frame.index.name != unmeth.index.name:
+        raise KeyError(f"manifest probe_column ({manifest.data_frame.index.name}) does not match meth/unmeth probe names from idats ({meth.index.name}).")
+    probe_column = manifest.data_frame.index.name
 
-    IG = manifest[(manifest['Color_Channel']=='Grn') & (manifest['Infinium_Design_Type']=='I')]
-    IR = manifest[(manifest['Color_Channel']=='Red') & (manifest['Infinium_Design_Type']=='I')]
-    II = manifest[manifest['Infinium_Design_Type']=='II']
+    # probe names of each design type, computed once per manifest
+    IG = manifest.get_design_index('I', Channel.GREEN)
+    IR = manifest.get_design_index('I', Channel.RED)
+    II = manifest.get_design_index('II')
 
     #print(f"DEBUG II {II.shape} --- {II.index.duplicated().sum()}")
 
     # merge with meth and unmeth dataframes; reindex is preferred (no warning) way of .loc[slice] now
     try:
-        IG_meth = meth.reindex(IG.index)
-        IG_unmeth = unmeth.reindex(IG.index)
-        IR_meth = meth.reindex(IR.index)
-        IR_unmeth = unmeth.reindex(IR.index)
-        II_meth = meth.reindex(II.index)
-        II_unmeth = unmeth.reindex(II.index)
+        IG_meth = meth.reindex(IG)
+        IG_unmeth = unmeth.reindex(IG)
+        IR_meth = meth.reindex(IR)
+        IR_unmeth = unmeth.reindex(IR)
+        II_meth = meth.reindex(II)
+        II_unmeth = unmeth.reindex(II)
     except ValueError as e:
         print(f"ValueError: {e} (duplicated meth indexes: {meth[~meth.index.duplicated()]})")
         print(f"Trying to reindex another way.")
         import pdb;pdb.set_trace()
 
-    funcG = ECDF(data_container.oob_green['mean_value'].values)
-    funcR = ECDF(data_container.oob_red['mean_value'].values)
+    # probes masked to NaN by min_beads are left out of the background distribution
+    funcG = ECDF(data_container.oob_green['mean_value'].dropna().values)
+    funcR = ECDF(data_container.oob_red['mean_value'].dropna().values)
     pIR = pd.DataFrame(index=IR_meth.index, data=1-np.maximum(funcR(IR_meth[column]), funcR(IR_unmeth[column])), columns=[column])
     pIG = pd.DataFrame(index=IG_meth.index, data=1-np.maximum(funcG(IG_meth[column]), funcG(IG_unmeth[column])), columns=[column])
     pII = pd.DataFrame(index=II_meth.index, data=1-np.maximum(funcG(II_meth[column]), funcR(II_unmeth[column])), columns=[column])
@@ -7,7 +7,7 @@ from collections import Counter
 from pathlib import Path
 import pickle
 # App
-from ..files import Manifest, get_sample_sheet, create_sample_sheet
+from ..files import Manifest, MANIFEST_REGISTRY, IdatCache, TarIdatReader, get_sample_sheet, create_sample_sheet
 from ..models import Channel, MethylationDataset, ArrayType
 from ..utils import ensure_directory_exists, is_file_like
 from .postprocess import (
@@ -20,14 +20,18 @@ from .postprocess import (
     consolidate_mouse_probes,
     merge_batches,
 )
-from .preprocess import preprocess_noob
-from .raw_dataset import get_raw_datasets
+from .preprocess import preprocess_noob, preprocess_noob_batch, PRECISIONS
+from .raw_dataset import get_raw_datasets, get_raw_meta_datasets, get_array_type
 from .p_value_probe_detection import _pval_sesame_preprocess
+from .quantile_normalization import QuantileReference
 
 __all__ = ['SampleDataContainer', 'get_manifest', 'run_pipeline', 'consolidate_values_for_sheet']
 
 LOGGER = logging.getLogger(__name__)
 
+# samples background-corrected together by run_pipeline; their containers are held in memory at once.
+NOOB_BATCH_SIZE = 16
+
 
 def get_manifest(raw_datasets, array_type=None, manifest_filepath=None):
     """Return a Manifest, given a list of raw_datasets (from idats).
@@ -43,7 +47,8 @@ def get_manifest(raw_datasets, array_type=None, manifest_filepath=None):
             it will be inferred from the array_type and downloaded if necessary (default: {None})
 
     Returns:
-        [Manifest] -- A Manifest instance.
+        [Manifest] -- A Manifest instance. Manifests are shared through MANIFEST_REGISTRY,
+            so repeated calls for the same array type and file return the same (read-only) instance.
     """
     if array_type is None:
         array_types = {dataset.array_type for dataset in raw_datasets}
@@ -54,7 +59,7 @@ def get_manifest(raw_datasets, array_type=None, manifest_filepath=None):
 
         array_type = array_types.pop()
 
-    return Manifest(array_type, manifest_filepath)
+    return MANIFEST_REGISTRY.get(array_type, manifest_filepath)
 
 
 def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None,
@@ -62,7 +67,9 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
                  betas=False, m_value=False, make_sample_sheet=False, batch_size=None,
                  save_uncorrected=False, save_control=False, meta_data_frame=True,
                  bit='float32', poobah=False, export_poobah=False,
-                 poobah_decimals=3, poobah_sig=0.05):
+                 poobah_decimals=3, poobah_sig=0.05, workers=None, min_beads=None,
+                 idat_archive=None, cache_dir=None, manifest=None, regions=None, precision='float64',
+                 quantile_normalize=False):
     """The main CLI processing pipeline. This does every processing step and returns a data set.
 
     Arguments:
@@ -119,6 +126,38 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
             the p-value level of significance, above which, will exclude probes from output (typical range of 0.001 to 0.1)
         poobah_decimals [default: 3]
             The number of decimal places to round p-value column in the processed CSV output files.
+        workers [optional]
+            if set to an integer greater than 1, IDAT pairs in each batch are read concurrently
+            on this many threads. Reading is mostly I/O and gzip decompression, which release the GIL.
+        min_beads [optional]
+            if set to an integer, probes measured on fewer beads than this (the NUM_BEADS section of each IDAT)
+            are masked to NaN before NOOB, so they come out as NaN in beta and m_value output.
+            The bead counts are only read from the IDAT files when this is set.
+        idat_archive [optional]
+            path to an uncompressed tar archive of IDAT files (such as a GEO GSExxx_RAW.tar with .idat.gz members).
+            IDATs are read straight out of the archive, without extracting them to disk.
+            The sample sheet is still read from data_dir (or sample_sheet_filepath), and outputs are saved in data_dir.
+        cache_dir [optional]
+            a directory for caching decoded IDAT files between runs. Rerunning the pipeline on the same samples
+            with other options then loads the intensities from the cache instead of decoding every IDAT again.
+            Entries are checked against each IDAT's size, mtime and contents; the cache is kept under 20 GB.
+        manifest [optional]
+            an already loaded Manifest to use for every batch, instead of loading one from manifest_filepath
+            or the default manifest of the array_type. Otherwise the manifest is loaded once per run,
+            and reused by later runs in the same session (see MANIFEST_REGISTRY).
+        regions [optional]
+            genomic regions to keep, such as the targets of a panel: a path to a BED file, a DataFrame or a list of
+            (chromosome, start, end) tuples (see Manifest.probes_in_regions). Samples are still NOOB corrected
+            (and poobah tested) on every probe, but only probes in these regions are exported, saved and returned.
+        precision [default: float64]
+            the float type of the NOOB computations and of the corrected intensities held in memory: float64, or float32
+            to halve their memory traffic. float32 results stay within the tolerance checked by tests/processing/test_precision.py
+            (beta and m_values differ from float64 by a few units of their 3rd decimal at most). The output type is set by bit.
+        quantile_normalize [default: False]
+            if True, the NOOB corrected intensities of every sample are quantile normalized (within type I red, type I green
+            and type II probes) to their mean distribution over the whole run, before beta and m_values are computed.
+            The reference distribution is accumulated batch by batch (see QuantileReference), and every output file is
+            written in a second pass over the batches, once all samples were added to it.
 
     Returns:
         By default, if called as a function, a list of SampleDataContainer objects is returned.
@@ -139,9 +178,19 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
     LOGGER.info('Running pipeline in: %s', data_dir)
     if bit not in ('float64','float32','float16'):
         raise ValueError("Input 'bit' must be one of ('float64','float32','float16') or ommitted.")
+    if precision not in PRECISIONS:
+        raise ValueError(f"Input 'precision' must be one of {PRECISIONS}")
     if sample_name:
         LOGGER.info('Sample names: {0}'.format(sample_name))
 
+    idat_reader = None
+    if idat_archive:
+        if make_sample_sheet:
+            raise ValueError('make_sample_sheet does not work with idat_archive; provide a sample sheet in data_dir')
+        idat_reader = TarIdatReader(idat_archive)
+
+    idat_cache = IdatCache(cache_dir) if cache_dir else None
+
     if make_sample_sheet:
         create_sample_sheet(data_dir)
     sample_sheet = get_sample_sheet(data_dir, filepath=sample_sheet_filepath)
@@ -199,41 +248,64 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
             batch.append(sample.name)
         batches.append(batch)
 
+    # validate every IDAT pair up front, reading only file headers, so that missing, truncated or
+    # mixed-array files fail in seconds instead of after decoding the batches before them.
+    meta_datasets = get_raw_meta_datasets(sample_sheet, sample_name=[name for batch in batches for name in batch], from_s3=idat_reader)
+    if array_type is None and meta_datasets:
+        array_type = get_array_type(meta_datasets)
+    if manifest is not None:
+        if array_type is not None and ArrayType(array_type) != manifest.array_type:
+            raise ValueError(f'the manifest provided is for {manifest.array_type} arrays, but the samples are {array_type}')
+    elif array_type is not None:
+        manifest = get_manifest([], array_type, manifest_filepath)
+
+    region_probes = None
+    if regions is not None and manifest is not None:
+        region_probes = manifest.probes_in_regions(regions)
+        LOGGER.info(f'{len(region_probes)} probes are in the regions selected')
+
     temp_data_pickles = []
     control_snps = {}
     #data_containers = [] # returned when this runs in interpreter, and < 200 samples
     # v1.3.0 memory fix: save each batch_data_containers object to disk as temp, then load and combine at end.
     # 200 samples still uses 4.8GB of memory/disk space (float64)
     missing_probe_errors = {'noob': [], 'raw':[]}
+    quantile_reference = None
+    output_kwargs = dict(
+        data_dir=data_dir, batch_size=batch_size, export=export, betas=betas, m_value=m_value,
+        save_uncorrected=save_uncorrected, export_poobah=export_poobah, bit=bit, poobah=poobah,
+        poobah_sig=poobah_sig, missing_probe_errors=missing_probe_errors,
+    )
 
     for batch_num, batch in enumerate(batches, 1):
-        raw_datasets = get_raw_datasets(sample_sheet, sample_name=batch)
-        manifest = get_manifest(raw_datasets, array_type, manifest_filepath) # this allows each batch to be a different array type; but not implemented yet. common with older GEO sets.
+        raw_datasets = get_raw_datasets(sample_sheet, sample_name=batch, from_s3=idat_reader, workers=workers, min_beads=min_beads,
+            idat_cache=idat_cache)
+        if manifest is None: # array type not known before reading the batch
+            manifest = get_manifest(raw_datasets, array_type, manifest_filepath)
+        if regions is not None and region_probes is None:
+            region_probes = manifest.probes_in_regions(regions)
+            LOGGER.info(f'{len(region_probes)} probes are in the regions selected')
 
-        batch_data_containers = []
-        export_paths = set() # inform CLI user where to look
-        for raw_dataset in tqdm(raw_datasets, total=len(raw_datasets), desc="Processing samples"):
-            data_container = SampleDataContainer(
-                raw_dataset=raw_dataset,
-                manifest=manifest,
-                retain_uncorrected_probe_intensities=save_uncorrected,
-                bit=bit,
-                pval=poobah,
-                poobah_decimals=poobah_decimals,
-            )
+        if quantile_normalize and quantile_reference is None:
+            quantile_reference = QuantileReference(manifest)
 
-            # data_frame['noob'] doesn't exist at this point.
+        batch_data_containers = []
+        noob_corrected = get_noob_data_containers(
+            raw_datasets,
+            manifest,
+            retain_uncorrected_probe_intensities=save_uncorrected,
+            bit=bit,
+            pval=poobah,
+            poobah_decimals=poobah_decimals,
+            precision=precision,
+        )
+        for data_container in tqdm(noob_corrected, total=len(raw_datasets), desc="Processing samples"):
+            # NOOB is applied; the processed data_frame doesn't exist at this point.
             data_container.process_all()
-
-            if export:
-                output_path = data_container.sample.get_export_filepath()
-                data_container.export(output_path)
-                export_paths.add(output_path)
-                # this tidies-up the tqdm by moving errors to end of batch warning.
-                if data_container.noob_processing_missing_probe_errors != []:
-                    missing_probe_errors['noob'].extend(data_container.noob_processing_missing_probe_errors)
-                if data_container.raw_processing_missing_probe_errors != []:
-                    missing_probe_errors['raw'].extend(data_container.raw_processing_missing_probe_errors)
+            if quantile_reference is not None:
+                data_container.add_to_quantile_reference(quantile_reference)
+            if region_probes is not None:
+                data_container.select_probes(region_probes)
 
             if save_control: # Process and consolidate now. Keep in memory. These files are small.
                 sample_id = f"{data_container.sample.sentrix_id}_{data_container.sample.sentrix_position}"
@@ -250,99 +322,9 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
 
         LOGGER.info('[finished SampleDataContainer processing]')
 
-        if betas:
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='beta_value', bit=bit, poobah=poobah)
-            if not batch_size:
-                pkl_name = 'beta_values.pkl'
-            else:
-                pkl_name = f'beta_values_{batch_num}.pkl'
-            if df.shape[1] > df.shape[0]:
-                df = df.transpose() # put probes as columns for faster loading.
-            df = df.astype('float32')
-            pd.to_pickle(df, Path(data_dir,pkl_name))
-            LOGGER.info(f"saved {pkl_name}")
-        if m_value:
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='m_value', bit=bit, poobah=poobah)
-            if not batch_size:
-                pkl_name = 'm_values.pkl'
-            else:
-                pkl_name = f'm_values_{batch_num}.pkl'
-            if df.shape[1] > df.shape[0]:
-                df = df.transpose() # put probes as columns for faster loading.
-            df = df.astype('float32')
-            pd.to_pickle(df, Path(data_dir,pkl_name))
-            LOGGER.info(f"saved {pkl_name}")
-        if betas or m_value:
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='noob_meth', bit=bit)
-            if not batch_size:
-                pkl_name = 'noob_meth_values.pkl'
-            else:
-                pkl_name = f'noob_meth_values_{batch_num}.pkl'
-            if df.shape[1] > df.shape[0]:
-                df = df.transpose() # put probes as columns for faster loading.
-            df = df.astype('float32') if df.isna().sum().sum() > 0 else df.astype('int16')
-            pd.to_pickle(df, Path(data_dir,pkl_name))
-            LOGGER.info(f"saved {pkl_name}")
-            # TWO PARTS
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='noob_unmeth', bit=bit)
-            if not batch_size:
-                pkl_name = 'noob_unmeth_values.pkl'
-            else:
-                pkl_name = f'noob_unmeth_values_{batch_num}.pkl'
-            if df.shape[1] > df.shape[0]:
-                df = df.transpose() # put probes as columns for faster loading.
-            df = df.astype('float32') if df.isna().sum().sum() > 0 else df.astype('int16')
-            pd.to_pickle(df, Path(data_dir,pkl_name))
-            LOGGER.info(f"saved {pkl_name}")
-
-        if (betas or m_value) and save_uncorrected:
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='meth', bit=bit)
-            if not batch_size:
-                pkl_name = 'meth_values.pkl'
-            else:
-                pkl_name = f'meth_values_{batch_num}.pkl'
-            if df.shape[1] > df.shape[0]:
-                df = df.transpose() # put probes as columns for faster loading.
-            df = df.astype('float32') if df.isna().sum().sum() > 0 else df.astype('int16')
-            pd.to_pickle(df, Path(data_dir,pkl_name))
-            LOGGER.info(f"saved {pkl_name}")
-            # TWO PARTS
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='unmeth', bit=bit)
-            if not batch_size:
-                pkl_name = 'unmeth_values.pkl'
-            else:
-                pkl_name = f'unmeth_values_{batch_num}.pkl'
-            if df.shape[1] > df.shape[0]:
-                df = df.transpose() # put probes as columns for faster loading.
-            df = df.astype('float32') if df.isna().sum().sum() > 0 else df.astype('int16')
-            pd.to_pickle(df, Path(data_dir,pkl_name))
-            LOGGER.info(f"saved {pkl_name}")
-
-        if manifest.array_type == ArrayType.ILLUMINA_MOUSE:
-            # save mouse specific probes
-            if not batch_size:
-                mouse_probe_filename = f'mouse_probes.pkl'
-            else:
-                mouse_probe_filename = f'mouse_probes_{batch_num}.pkl'
-            consolidate_mouse_probes(batch_data_containers, Path(data_dir, mouse_probe_filename))
-            LOGGER.info(f"saved {mouse_probe_filename}")
-
-        if export:
-            export_path_parents = list(set([str(Path(e).parent) for e in export_paths]))
-            LOGGER.info(f"[!] Exported results (csv) to: {export_path_parents}")
-
-        if export_poobah:
-            # this option will save a pickled dataframe of the pvalues for all samples, with sample_ids in the column headings and probe names in index.
-            # this sets poobah to false in kwargs, otherwise some pvalues would be NaN I think.
-            df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='poobah_pval', bit=bit, poobah=False, poobah_sig=poobah_sig)
-            if not batch_size:
-                pkl_name = 'poobah_values.pkl'
-            else:
-                pkl_name = f'poobah_values_{batch_num}.pkl'
-            if df.shape[1] > df.shape[0]:
-                df = df.transpose() # put probes as columns for faster loading.
-            pd.to_pickle(df, Path(data_dir,pkl_name))
-            LOGGER.info(f"saved {pkl_name}")
+        # with quantile normalization, outputs are saved once every sample is in the reference, below.
+        if quantile_reference is None:
+            save_batch_outputs(batch_data_containers, batch_num, mouse=(manifest.array_type == ArrayType.ILLUMINA_MOUSE), **output_kwargs)
 
         # v1.3.0 fixing mem probs: pickling each batch_data_containers object then reloading it later.
         # consolidating data_containers this will break with really large sample sets, so skip here.
@@ -357,6 +339,18 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
 
     del batch_data_containers
 
+    if quantile_reference is not None:
+        # second pass, one batch at a time: samples are normalized to the reference of the whole run, then saved.
+        for batch_num, pkl_name in enumerate(temp_data_pickles, 1):
+            with open(Path(data_dir,pkl_name), 'rb') as temp_data:
+                batch_data_containers = pickle.load(temp_data)
+            for data_container in tqdm(batch_data_containers, total=len(batch_data_containers), desc="Quantile normalizing samples"):
+                data_container.quantile_normalize(quantile_reference)
+            save_batch_outputs(batch_data_containers, batch_num, mouse=(manifest.array_type == ArrayType.ILLUMINA_MOUSE), **output_kwargs)
+            with open(Path(data_dir,pkl_name), 'wb') as temp_data:
+                pickle.dump(batch_data_containers, temp_data)
+            del batch_data_containers
+
     if meta_data_frame == True:
         #sample_sheet.fields is a complete mapping of original and renamed_fields
         cols = list(sample_sheet.fields.values()) + ['Sample_ID']
@@ -455,6 +449,147 @@ def run_pipeline(data_dir, array_type=None, export=False, manifest_filepath=None
         return data_containers
 
 
+def save_batch_outputs(batch_data_containers, batch_num, data_dir, batch_size=None, export=False, betas=False,
+                       m_value=False, save_uncorrected=False, export_poobah=False, bit='float32', poobah=False,
+                       poobah_sig=0.05, mouse=False, missing_probe_errors=None):
+    """Saves the processed data of a batch of samples, as run_pipeline() does: a processed CSV per sample (if export),
+    and one pickled DataFrame per output value, named beta_values_<batch_num>.pkl etc. (or beta_values.pkl etc.
+    when batch_size is not set). The keyword arguments are those of run_pipeline.
+
+    Keyword Arguments:
+        mouse {bool} -- also save the mouse probes (ILLUMINA_MOUSE arrays). (default: {False})
+        missing_probe_errors {dict} -- collects the samples with missing NOOB ('noob') and raw ('raw') values. (default: {None})
+    """
+    if missing_probe_errors is None:
+        missing_probe_errors = {'noob': [], 'raw': []}
+    export_paths = set() # inform CLI user where to look
+    if export:
+        for data_container in batch_data_containers:
+            output_path = data_container.sample.get_export_filepath()
+            data_container.export(output_path)
+            export_paths.add(output_path)
+            # this tidies-up the tqdm by moving errors to end of batch warning.
+            if data_container.noob_processing_missing_probe_errors != []:
+                missing_probe_errors['noob'].extend(data_container.noob_processing_missing_probe_errors)
+            if data_container.raw_processing_missing_probe_errors != []:
+                missing_probe_errors['raw'].extend(data_container.raw_processing_missing_probe_errors)
+
+    if betas:
+        df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='beta_value', bit=bit, poobah=poobah)
+        if not batch_size:
+            pkl_name = 'beta_values.pkl'
+        else:
+            pkl_name = f'beta_values_{batch_num}.pkl'
+        if df.shape[1] > df.shape[0]:
+            df = df.transpose() # put probes as columns for faster loading.
+        df = df.astype('float32')
+        pd.to_pickle(df, Path(data_dir,pkl_name))
+        LOGGER.info(f"saved {pkl_name}")
+    if m_value:
+        df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='m_value', bit=bit, poobah=poobah)
+        if not batch_size:
+            pkl_name = 'm_values.pkl'
+        else:
+            pkl_name = f'm_values_{batch_num}.pkl'
+        if df.shape[1] > df.shape[0]:
+            df = df.transpose() # put probes as columns for faster loading.
+        df = df.astype('float32')
+        pd.to_pickle(df, Path(data_dir,pkl_name))
+        LOGGER.info(f"saved {pkl_name}")
+    if betas or m_value:
+        df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='noob_meth', bit=bit)
+        if not batch_size:
+            pkl_name = 'noob_meth_values.pkl'
+        else:
+            pkl_name = f'noob_meth_values_{batch_num}.pkl'
+        if df.shape[1] > df.shape[0]:
+            df = df.transpose() # put probes as columns for faster loading.
+        df = df.astype('float32') # noob values are floats; red ones are scaled by the dye bias factor.
+        pd.to_pickle(df, Path(data_dir,pkl_name))
+        LOGGER.info(f"saved {pkl_name}")
+        # TWO PARTS
+        df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='noob_unmeth', bit=bit)
+        if not batch_size:
+            pkl_name = 'noob_unmeth_values.pkl'
+        else:
+            pkl_name = f'noob_unmeth_values_{batch_num}.pkl'
+        if df.shape[1] > df.shape[0]:
+            df = df.transpose() # put probes as columns for faster loading.
+        df = df.astype('float32') # noob values are floats; red ones are scaled by the dye bias factor.
+        pd.to_pickle(df, Path(data_dir,pkl_name))
+        LOGGER.info(f"saved {pkl_name}")
+
+    if (betas or m_value) and save_uncorrected:
+        df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='meth')
+        if not batch_size:
+            pkl_name = 'meth_values.pkl'
+        else:
+            pkl_name = f'meth_values_{batch_num}.pkl'
+        if df.shape[1] > df.shape[0]:
+            df = df.transpose() # put probes as columns for faster loading.
+        df = df.astype('float32') if df.isna().sum().sum() > 0 else df.astype('uint16') # raw IDAT intensities reach 65535
+        pd.to_pickle(df, Path(data_dir,pkl_name))
+        LOGGER.info(f"saved {pkl_name}")
+        # TWO PARTS
+        df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='unmeth')
+        if not batch_size:
+            pkl_name = 'unmeth_values.pkl'
+        else:
+            pkl_name = f'unmeth_values_{batch_num}.pkl'
+        if df.shape[1] > df.shape[0]:
+            df = df.transpose() # put probes as columns for faster loading.
+        df = df.astype('float32') if df.isna().sum().sum() > 0 else df.astype('uint16') # raw IDAT intensities reach 65535
+        pd.to_pickle(df, Path(data_dir,pkl_name))
+        LOGGER.info(f"saved {pkl_name}")
+
+    if mouse:
+        # save mouse specific probes
+        if not batch_size:
+            mouse_probe_filename = f'mouse_probes.pkl'
+        else:
+            mouse_probe_filename = f'mouse_probes_{batch_num}.pkl'
+        consolidate_mouse_probes(batch_data_containers, Path(data_dir, mouse_probe_filename))
+        LOGGER.info(f"saved {mouse_probe_filename}")
+
+    if export:
+        export_path_parents = list(set([str(Path(e).parent) for e in export_paths]))
+        LOGGER.info(f"[!] Exported results (csv) to: {export_path_parents}")
+
+    if export_poobah:
+        # this option will save a pickled dataframe of the pvalues for all samples, with sample_ids in the column headings and probe names in index.
+        # this sets poobah to false in kwargs, otherwise some pvalues would be NaN I think.
+        df = consolidate_values_for_sheet(batch_data_containers, postprocess_func_colname='poobah_pval', bit=bit, poobah=False, poobah_sig=poobah_sig)
+        if not batch_size:
+            pkl_name = 'poobah_values.pkl'
+        else:
+            pkl_name = f'poobah_values_{batch_num}.pkl'
+        if df.shape[1] > df.shape[0]:
+            df = df.transpose() # put probes as columns for faster loading.
+        pd.to_pickle(df, Path(data_dir,pkl_name))
+        LOGGER.info(f"saved {pkl_name}")
+
+
+def get_noob_data_containers(raw_datasets, manifest, noob_batch_size=NOOB_BATCH_SIZE, **kwargs):
+    """Yields a SampleDataContainer for each RawDataset, with NOOB already applied. Samples are corrected
+    noob_batch_size at a time (preprocess_noob_batch), so only that many containers are built ahead.
+
+    Arguments:
+        raw_datasets {list(RawDataset)} -- samples of the batch.
+        manifest {Manifest} -- the Manifest of their array type.
+
+    Keyword Arguments:
+        noob_batch_size {int} -- samples corrected together (default: {NOOB_BATCH_SIZE})
+        other keyword arguments are passed to SampleDataContainer.
+    """
+    for start in range(0, len(raw_datasets), noob_batch_size):
+        data_containers = [
+            SampleDataContainer(raw_dataset=raw_dataset, manifest=manifest, **kwargs)
+            for raw_dataset in raw_datasets[start:start + noob_batch_size]
+        ]
+        preprocess_noob_batch(data_containers)
+        yield from data_containers
+
+
 class SampleDataContainer():
     """Wrapper that provides easy access to slices of data for a Sample,
     its RawDataset, and the pre-configured MethylationDataset subsets of probes.
@@ -463,6 +598,7 @@ class SampleDataContainer():
         raw_dataset {RawDataset} -- A sample's RawDataset for a single well on the processed array.
         manifest {Manifest} -- The Manifest for the correlated RawDataset's array type.
         bit (default: float64) -- option to store data as float16 or float32 to save space.
+        precision (default: float64) -- float type of the NOOB computations and corrected intensities, float64 or float32.
         pval (default: False) -- whether to apply p-value-detection algorithm to remove
             unreliable probes (based on signal/noise ratio of fluoresence)
             uses the sesame method (pOOBah) based on out of band background levels
@@ -470,6 +606,11 @@ class SampleDataContainer():
     Jan 2020: added .snp_(un)methylated property. used in postprocess.consolidate_crontrol_snp()
     Mar 2020: added p-value detection option
     Mar 2020: added mouse probe post-processing separation
+
+    fg_green, fg_red, ctrl_green and ctrl_red are built from the raw_dataset once, on first use, and
+    then shared by NOOB, poobah and the control/snp export; treat them as read-only. They are released
+    with the raw_dataset (del container.raw_dataset). view_hits and view_misses count, per view,
+    how often a view was reused or built.
     """
 
     __data_frame = None
@@ -477,7 +618,10 @@ class SampleDataContainer():
     raw_processing_missing_probe_errors = []
 
     def __init__(self, raw_dataset, manifest, retain_uncorrected_probe_intensities=False,
-                 bit='float32', pval=False, poobah_decimals=3):
+                 bit='float32', pval=False, poobah_decimals=3, precision='float64'):
+        self.__views = {}
+        self.view_hits = Counter()
+        self.view_misses = Counter()
         self.manifest = manifest
         self.pval = pval
         self.poobah_decimals = poobah_decimals
@@ -499,22 +643,52 @@ class SampleDataContainer():
             self.data_type = 'float32'
         if self.data_type not in ('float64','float32','float16'):
             raise ValueError(f"invalid data_type: {self.data_type} should be one of ('float64','float32','float16')")
+        if precision not in PRECISIONS:
+            raise ValueError(f"invalid precision: {precision} should be one of {PRECISIONS}")
+        self.precision = precision
+
+    @property
+    def raw_dataset(self):
+        return self.__raw_dataset
+
+    @raw_dataset.setter
+    def raw_dataset(self, raw_dataset):
+        self.__raw_dataset = raw_dataset
+        self.clear_views()
+
+    @raw_dataset.deleter
+    def raw_dataset(self):
+        del self.__raw_dataset
+        self.clear_views()
+
+    def get_view(self, name, build):
+        """Returns a table derived from the raw_dataset, building it only on first use."""
+        if name in self.__views:
+            self.view_hits[name] += 1
+        else:
+            self.view_misses[name] += 1
+            self.__views[name] = build()
+        return self.__views[name]
+
+    def clear_views(self):
+        """Releases the cached views; they are built again, from the current raw_dataset, if used."""
+        self.__views = {}
 
     @property
     def fg_green(self):
-        return self.raw_dataset.get_fg_values(self.manifest, Channel.GREEN)
+        return self.get_view('fg_green', lambda: self.raw_dataset.get_fg_values(self.manifest, Channel.GREEN))
 
     @property
     def fg_red(self):
-        return self.raw_dataset.get_fg_values(self.manifest, Channel.RED)
+        return self.get_view('fg_red', lambda: self.raw_dataset.get_fg_values(self.manifest, Channel.RED))
 
     @property
     def ctrl_green(self):
-        return self.raw_dataset.get_fg_controls(self.manifest, Channel.GREEN)
+        return self.get_view('ctrl_green', lambda: self.raw_dataset.get_fg_controls(self.manifest, Channel.GREEN))
 
     @property
     def ctrl_red(self):
-        return self.raw_dataset.get_fg_controls(self.manifest, Channel.RED)
+        return self.get_view('ctrl_red', lambda: self.raw_dataset.get_fg_controls(self.manifest, Channel.RED))
 
     @property
     def oob_green(self):
@@ -528,21 +702,19 @@ class SampleDataContainer():
         """ combines the methylated and unmethylated columns from the SampleDataContainer. """
         if not self.__data_frame:
             if self.retain_uncorrected_probe_intensities == True:
-                uncorrected_meth = self.methylated.data_frame.copy()['mean_value'].astype('float32')
-                uncorrected_unmeth = self.unmethylated.data_frame.copy()['mean_value'].astype('float32')
-                # could be int16, if missing values didn't happen (cuts file size in half)
-                if uncorrected_meth.isna().sum() == 0 and uncorrected_unmeth.isna().sum() == 0:
-                    uncorrected_meth = uncorrected_meth.astype('int16')
-                    uncorrected_unmeth = uncorrected_unmeth.astype('int16')
+                # raw IDAT means stay uint16; missing probes make these float32 instead.
+                uncorrected_meth = self.methylated.get_column('mean_value')
+                uncorrected_unmeth = self.unmethylated.get_column('mean_value')
 
             if self.pval == True:
                 pval_probes_df = _pval_sesame_preprocess(self)
                 # output: df with one column named 'poobah_pval'
 
-            preprocess_noob(self) # apply corrections: bg subtract, then noob (in preprocess.py)
+            if self.methylated.noob is None or self.unmethylated.noob is None: # unless preprocess_noob_batch ran
+                preprocess_noob(self) # apply corrections: bg subtract, then noob (in preprocess.py)
 
-            methylated = self.methylated.data_frame[['noob']]
-            unmethylated = self.unmethylated.data_frame[['noob']]
+            methylated = self.methylated.get_column('noob').to_frame()
+            unmethylated = self.unmethylated.get_column('noob').to_frame()
 
             self.__data_frame = methylated.join(
                 unmethylated,
@@ -558,7 +730,11 @@ class SampleDataContainer():
                 self.__data_frame['unmeth'] = uncorrected_unmeth
 
             # reduce to float32 during processing. final output may be 16,32,64 in _postprocess() + export()
-            self.__data_frame = self.__data_frame.astype('float32')
+            # uncorrected meth/unmeth keep their raw uint16 type, unless probes were missing.
+            self.__data_frame = self.__data_frame.astype({
+                column: ('float32' if column not in ('meth', 'unmeth') or self.__data_frame[column].isna().any() else 'uint16')
+                for column in self.__data_frame.columns
+            })
             if self.poobah_decimals != 3 and 'poobah_pval' in self.__data_frame.columns:
                 other_columns = list(self.__data_frame.columns)
                 other_columns.remove('poobah_pval')
@@ -617,6 +793,32 @@ class SampleDataContainer():
 
         return data_frame
 
+    def select_probes(self, probes):
+        """Keeps only these probes in the processed data (and mouse probes, for mouse arrays),
+        so only they are exported and consolidated. Used after process_all().
+
+        Arguments:
+            probes {list-like} -- IlmnIDs to keep, such as the result of Manifest.probes_in_regions().
+        """
+        self.__data_frame = self.__data_frame[self.__data_frame.index.isin(probes)]
+        if getattr(self, 'mouse_data_frame', None) is not None:
+            self.mouse_data_frame = self.mouse_data_frame[self.mouse_data_frame.index.isin(probes)]
+        return self.__data_frame
+
+    def add_to_quantile_reference(self, reference):
+        """Adds this sample to a QuantileReference, keeping its ranks for quantile_normalize(). Used after process_all(),
+        on all probes: the ranks are kept for any probes select_probes() leaves."""
+        self.quantile_ranks = reference.add(self.__data_frame)
+
+    def quantile_normalize(self, reference):
+        """Replaces noob_meth and noob_unmeth with the reference values at this sample's ranks, once every sample was added
+        to the QuantileReference, and computes beta and m values again from them."""
+        data_frame = reference.normalize(self.__data_frame, self.quantile_ranks)
+        data_frame = self.process_beta_value(data_frame)
+        self.__data_frame = self.process_m_value(data_frame)
+        del self.quantile_ranks
+        return self.__data_frame
+
     def export(self, output_path):
         ensure_directory_exists(output_path)
         # ensure smallest possible csv files
@@ -632,8 +834,8 @@ class SampleDataContainer():
         # these are the raw, uncorrected values
         if 'meth' in self.__data_frame.columns and 'unmeth' in self.__data_frame.columns:
             try:
-                self.__data_frame['meth'] = self.__data_frame['meth'].astype('float16', copy=False)
-                self.__data_frame['unmeth'] = self.__data_frame['unmeth'].astype('float16', copy=False)
+                self.__data_frame['meth'] = self.__data_frame['meth'].astype('uint16', copy=False)
+                self.__data_frame['unmeth'] = self.__data_frame['unmeth'].astype('uint16', copy=False)
             except ValueError as e:
                 num_missing = self.__data_frame['meth'].isna().sum() + self.__data_frame['unmeth'].isna().sum()
                 #LOGGER.warning(f'{output_path} contains {num_missing} missing/infinite RAW meth/unmeth probe values')
@@ -653,7 +855,7 @@ class SampleDataContainer():
                 input_dataframe[header] = input_dataframe[header].astype(self.data_type)
             except Exception as e:
                 LOGGER.warning(f'._postprocess: {e}')
-                LOGGER.info('%s failed for %s, using float64 instead: %s', self.data_type, header, self.raw_dataset.sample)
+                LOGGER.info('%s failed for %s, using float64 instead: %s', self.data_type, header, self.sample)
                 input_dataframe[header] = input_dataframe[header].astype('float64')
 
         return input_dataframe
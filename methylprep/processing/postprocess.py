@@ -6,7 +6,7 @@ import pickle
 from pathlib import Path
 import logging
 # app
-from ..utils import is_file_like
+from ..utils import is_file_like, as_float
 #from ..utils.progress_bar import * # context tqdm
 
 os.environ['NUMEXPR_MAX_THREADS'] = "8" # suppresses warning
@@ -20,8 +20,8 @@ LOGGER = logging.getLogger(__name__)
 def calculate_beta_value(methylated_noob, unmethylated_noob, offset=100):
     """ the ratio of (methylated_intensity / total_intensity)
     where total_intensity is (meth + unmeth + 100) -- to give a score in range of 0 to 1.0"""
-    methylated = np.clip(methylated_noob, 0, None)
-    unmethylated = np.clip(unmethylated_noob, 0, None)
+    methylated = np.clip(as_float(methylated_noob), 0, None)
+    unmethylated = np.clip(as_float(unmethylated_noob), 0, None)
 
     total_intensity = methylated + unmethylated + offset
     with np.errstate(all='raise'):
@@ -31,8 +31,8 @@ def calculate_beta_value(methylated_noob, unmethylated_noob, offset=100):
 
 def calculate_m_value(methylated_noob, unmethylated_noob, offset=1):
     """ the log(base 2) (1+meth / (1+unmeth_ intensities (with an offset to avoid divide-by-zero-errors)"""
-    methylated = methylated_noob + offset
-    unmethylated = unmethylated_noob + offset
+    methylated = as_float(methylated_noob) + offset
+    unmethylated = as_float(unmethylated_noob) + offset
 
     with np.errstate(all='raise'):
         intensity_ratio = np.true_divide(methylated, unmethylated)
@@ -41,7 +41,7 @@ def calculate_m_value(methylated_noob, unmethylated_noob, offset=1):
 
 def calculate_copy_number(methylated_noob, unmethylated_noob):
     """ the log(base 2) of the combined (meth + unmeth AKA green and red) intensities """
-    total_intensity = methylated_noob + unmethylated_noob
+    total_intensity = as_float(methylated_noob) + as_float(unmethylated_noob)
     copy_number = np.log2(total_intensity)
     return copy_number
 
@@ -136,14 +136,15 @@ Notes:
             SNP['snp_unmeth'].values,
         )
         SNP = SNP[['snp_beta','snp_meth','snp_unmeth']]
+        intensity_dtype = get_intensity_dtype(sample)
         SNP = SNP.astype({
-            'snp_meth': 'int32',
-            'snp_unmeth': 'int32'})
+            'snp_meth': intensity_dtype,
+            'snp_unmeth': intensity_dtype})
 
         merged = pd.merge(RED, GREEN, left_index=True, right_index=True, how='outer')
         merged = merged.astype({
-            'Mean_Value_Green': 'int32',
-            'Mean_Value_Red': 'int32'})
+            'Mean_Value_Green': intensity_dtype,
+            'Mean_Value_Red': intensity_dtype})
         merged = pd.merge(merged, SNP, left_index=True, right_index=True, how='outer')
         merged = merged.round({'snp_beta':3})
         out[sample_id] = merged
@@ -155,6 +156,12 @@ Notes:
             pickle.dump(out, f)
     return
 
+def get_intensity_dtype(sample):
+    """The dtype of the raw control and SNP intensities saved for a SampleDataContainer: int32, or the
+    nullable Int32 if its IDATs were read with min_beads, which masks probes on too few beads to NaN."""
+    return 'Int32' if sample.raw_dataset.green_idat.min_beads else 'int32'
+
+
 def one_sample_control_snp(sample):
     """A memory-friendly version of consolidate_control_snp()
 Unlike all the other postprocessing functions, this uses a lot of SampleDataContainer objects that get removed to same memory,
@@ -202,16 +209,17 @@ Notes:
         SNP['snp_unmeth'].values,
     )
     SNP = SNP[['snp_beta','snp_meth','snp_unmeth']]
-    if SNP[['snp_meth','snp_unmeth']].isna().sum().sum() == 0: # space saving, but catches NaN bugs without breaking.
+    intensity_dtype = get_intensity_dtype(sample)
+    if intensity_dtype == 'Int32' or SNP[['snp_meth','snp_unmeth']].isna().sum().sum() == 0: # space saving, but catches NaN bugs without breaking.
         SNP = SNP.astype({
-            'snp_meth': 'int32',
-            'snp_unmeth': 'int32'})
+            'snp_meth': intensity_dtype,
+            'snp_unmeth': intensity_dtype})
 
     merged = pd.merge(RED, GREEN, left_index=True, right_index=True, how='outer')
-    if merged[['Mean_Value_Green','Mean_Value_Red']].isna().sum().sum() == 0:
+    if intensity_dtype == 'Int32' or merged[['Mean_Value_Green','Mean_Value_Red']].isna().sum().sum() == 0:
         merged = merged.astype({
-            'Mean_Value_Green': 'int32',
-            'Mean_Value_Red': 'int32'})
+            'Mean_Value_Green': intensity_dtype,
+            'Mean_Value_Red': intensity_dtype})
     merged = pd.merge(merged, SNP, left_index=True, right_index=True, how='outer')
     merged = merged.round({'snp_beta':3})
     # finally, copy Probe_Type from manifest, if exists
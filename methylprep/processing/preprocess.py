@@ -5,17 +5,32 @@
 # Lib
 import logging
 import numpy as np
-from statsmodels import robust
+from scipy import special
 from scipy.stats import norm
 # App
-from ..models import ControlType
+from ..models import Channel, ControlType, ProbeAddress, ProbeType, FG_PROBE_SUBSETS
+from ..files import IdatStack
+from ..utils import as_float
 
 
-__all__ = ['preprocess_noob']
+__all__ = ['preprocess_noob', 'preprocess_noob_batch']
 
 
 LOGGER = logging.getLogger(__name__)
 
+# precisions of the NOOB kernels (SampleDataContainer precision): float64, or float32 to halve their memory traffic.
+# huber estimates always sum in float64; everything else, down to the stored bg_corrected and noob values, uses the precision.
+PRECISIONS = ('float64', 'float32')
+# the accuracy budget of float32: largest absolute difference from the float64 results (tests/processing/test_precision.py)
+FLOAT32_TOLERANCE = {'beta_value': 1e-4, 'm_value': 1e-3}
+
+# scales the median absolute deviation to the standard deviation of normal data, as in statsmodels' robust.mad
+MAD_CONSTANT = norm.ppf(0.75)
+SQRT_HALF = np.sqrt(0.5)
+SQRT_2_OVER_PI = np.sqrt(2 / np.pi)
+# below this z, normexp signals computed in float32 are recomputed in float64 (see normexp_signal)
+LOWER_TAIL_Z = -1.0
+
 
 class BackgroundCorrectionParams():
     __slots__ = (
@@ -34,17 +49,19 @@ class BackgroundCorrectionParams():
 
 def preprocess_noob(data_container):
     """ the main preprocessing function. Applies background-subtraction and
-    NOOB. Sets data_container.methylated and unmethylated values for sample."""
+    NOOB. Sets data_container.methylated and unmethylated values for sample,
+    computed in data_container.precision."""
     #LOGGER.info('NOOB: %s', data_container.sample)
+    dtype = data_container.precision
 
-    bg_correct_green, params_green = normexp_bg_corrected(data_container.fg_green, data_container.oob_green)
-    bg_correct_red, params_red = normexp_bg_corrected(data_container.fg_red, data_container.oob_red)
+    bg_correct_green, params_green = normexp_bg_corrected(data_container.fg_green, data_container.oob_green, dtype=dtype)
+    bg_correct_red, params_red = normexp_bg_corrected(data_container.fg_red, data_container.oob_red, dtype=dtype)
 
     data_container.methylated.set_bg_corrected(bg_correct_green, bg_correct_red)
     data_container.unmethylated.set_bg_corrected(bg_correct_green, bg_correct_red)
 
-    ctrl_green = normexp_bg_correct_control(data_container.ctrl_green, params_green)
-    ctrl_red = normexp_bg_correct_control(data_container.ctrl_red, params_red)
+    ctrl_green = normexp_bg_correct_control(data_container.ctrl_green, params_green, dtype=dtype)
+    ctrl_red = normexp_bg_correct_control(data_container.ctrl_red, params_red, dtype=dtype)
 
     mask_green = ctrl_green['Control_Type'].isin(ControlType.normalization_green())
     mask_red = ctrl_red['Control_Type'].isin(ControlType.normalization_red())
@@ -60,85 +77,264 @@ def preprocess_noob(data_container):
     data_container.unmethylated.set_noob(red_factor)
 
 
-def normexp_bg_corrected(fg_probes, ctrl_probes):
-    fg_means = fg_probes['mean_value']
-    fg_mean, _fg_mad = huber(fg_means)
-    bg_mean, bg_mad = huber(ctrl_probes['mean_value'])
+def preprocess_noob_batch(data_containers):
+    """NOOB for a batch of samples at once: the same corrections as preprocess_noob, applied to
+    (samples x probes) matrices. Samples that share an IDAT address layout are read into one IdatStack,
+    and the foreground, out-of-band and control columns are located in it once for all of them. The
+    normexp parameters and the red/green dye bias factors are estimated as one vector per batch, and
+    the background correction is one broadcast operation. Samples whose IDATs cannot be stacked are
+    corrected one at a time (preprocess_noob).
+    Sets data_container.methylated and unmethylated values for every sample.
+
+    Arguments:
+        data_containers {list(SampleDataContainer)} -- samples of the same array type.
+    """
+    groups = {}
+    for data_container in data_containers:
+        key = (id(data_container.manifest), data_container.precision, data_container.raw_dataset.green_idat.layout_key)
+        groups.setdefault(key, []).append(data_container)
+
+    for group in groups.values():
+        try:
+            stack = IdatStack(
+                [data_container.raw_dataset.green_idat for data_container in group],
+                [data_container.raw_dataset.red_idat for data_container in group],
+                sample_names=[str(data_container.sample) for data_container in group],
+            )
+        except ValueError as e:
+            LOGGER.warning(f'NOOB: correcting {len(group)} samples one at a time: {e}')
+            for data_container in group:
+                preprocess_noob(data_container)
+            continue
+        preprocess_noob_stack(stack, group)
+
+
+def preprocess_noob_stack(stack, data_containers):
+    """preprocess_noob_batch for the samples of one IdatStack, in the same order as its rows."""
+    manifest = data_containers[0].manifest
+    dtype = data_containers[0].precision
+    params = {}
+    controls = {}
+    for channel, control_types in ((Channel.GREEN, ControlType.normalization_green()), (Channel.RED, ControlType.normalization_red())):
+        # IDAT means are corrected as float32, like as_float() in preprocess_noob
+        fg_matrix = stack.take(channel, get_fg_columns(stack, manifest, channel), dtype=np.float32)
+        oob_matrix = stack.take(channel, get_oob_columns(stack, manifest, channel), dtype=np.float32)
+        params[channel] = get_bg_correction_params_batch(fg_matrix, oob_matrix, dtype=dtype)
+        controls[channel] = stack.take(channel, get_control_columns(stack, manifest, control_types), dtype=np.float32)
+
+    red_factors = dye_bias_factors_batch(
+        controls[Channel.GREEN], controls[Channel.RED], params[Channel.GREEN], params[Channel.RED], dtype=dtype)
+
+    for dataset_name in ('methylated', 'unmethylated'):
+        meth_dataset = getattr(data_containers[0], dataset_name)
+        columns = stack.get_positions(meth_dataset.address)
+        if (columns < 0).any():
+            raise KeyError(f'{(columns < 0).sum()} {dataset_name} probe addresses are not in the IDATs: {list(meth_dataset.address[columns < 0][:10])}')
+        bg_corrected = np.empty((len(stack), len(columns)), dtype=dtype)
+        for channel in (Channel.GREEN, Channel.RED):
+            rows = meth_dataset.channel == channel.value
+            bg_corrected[:, rows] = apply_bg_correction(
+                stack.take(channel, columns[rows], dtype=np.float32), params[channel], dtype=dtype)
+        for idx, data_container in enumerate(data_containers):
+            meth_dataset = getattr(data_container, dataset_name)
+            meth_dataset.set_bg_corrected_values(bg_corrected[idx])
+            meth_dataset.set_noob(red_factors[idx])
+
+
+def get_fg_columns(stack, manifest, channel):
+    """IdatStack columns of the foreground probes of a channel, in the order of
+    RawDataset.get_fg_values: subset by subset, each in IDAT file order."""
+    columns = []
+    for probe_subset in FG_PROBE_SUBSETS[channel]:
+        subset_index = manifest.get_subset_index(probe_subset.probe_type, probe_subset.probe_channel, probe_subset.probe_address)
+        subset_columns = stack.get_positions(subset_index.addresses)
+        subset_columns = subset_columns[subset_columns >= 0]
+        columns.append(subset_columns[np.argsort(stack.file_positions[subset_columns], kind='stable')])
+    return np.concatenate(columns)
+
+
+def get_oob_columns(stack, manifest, channel):
+    """IdatStack columns of the out-of-band probes of a channel: the type I probes of the other
+    channel, address A then B, in manifest order (as RawDataset.filter_oob_probes)."""
+    probe_channel = Channel.RED if channel is Channel.GREEN else Channel.GREEN
+    columns = [
+        stack.get_positions(manifest.get_subset_index(ProbeType.ONE, probe_channel, probe_address).addresses)
+        for probe_address in (ProbeAddress.A, ProbeAddress.B)
+    ]
+    columns = np.concatenate(columns)
+    return columns[columns >= 0]
+
+
+def get_control_columns(stack, manifest, control_types):
+    """IdatStack columns of the control probes of the given Control_Types, in manifest order."""
+    control_index = manifest.get_control_index()
+    columns = stack.get_positions(control_index.addresses)
+    found = columns >= 0
+    control_type = manifest.control_data_frame['Control_Type'].to_numpy().take(control_index.positions[found])
+    return columns[found][np.isin(control_type, control_types)]
+
+
+def get_bg_correction_params_batch(fg_matrix, oob_matrix, dtype=np.float64):
+    """The normexp parameters of each sample (row) of a (samples x probes) matrix of foreground intensities,
+    with the out-of-band intensities of the same samples as background. NaN values (probes masked by
+    min_beads) are left out.
+
+    Returns:
+        [BackgroundCorrectionParams] -- one column vector per parameter.
+    """
+    fg_mean, _fg_mad = huber(fg_matrix, dtype=dtype)
+    bg_mean, bg_mad = huber(oob_matrix, dtype=dtype)
+    mean_signal = np.maximum(fg_mean - bg_mean, 10)
+    return BackgroundCorrectionParams(bg_mean[:, None], bg_mad[:, None], mean_signal[:, None])
+
+
+def dye_bias_factors_batch(ctrl_green_matrix, ctrl_red_matrix, params_green, params_red, dtype=np.float64):
+    """The red channel factor of each sample: average green over average red normalization control,
+    after background correction. NaN values (probes masked by min_beads) are left out of the averages."""
+    corrected_green = apply_bg_correction(ctrl_green_matrix, params_green, dtype=dtype)
+    corrected_red = apply_bg_correction(ctrl_red_matrix, params_red, dtype=dtype)
+    # like pandas .mean(), samples without normalization controls get NaN (without a warning)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg_green = np.nansum(corrected_green, axis=1) / np.sum(~np.isnan(corrected_green), axis=1)
+        avg_red = np.nansum(corrected_red, axis=1) / np.sum(~np.isnan(corrected_red), axis=1)
+        rg_ratios = avg_red / avg_green
+        return 1 / rg_ratios
+
+
+def normexp_bg_corrected(fg_probes, ctrl_probes, dtype=np.float64):
+    fg_means = as_float(fg_probes['mean_value'])
+    fg_mean, _fg_mad = huber(fg_means, dtype=dtype)
+    bg_mean, bg_mad = huber(ctrl_probes['mean_value'], dtype=dtype)
     mean_signal = np.maximum(fg_mean - bg_mean, 10)
 
     params = BackgroundCorrectionParams(bg_mean, bg_mad, mean_signal)
 
-    corrected_signals = apply_bg_correction(fg_means, params)
-    fg_probes['bg_corrected'] = corrected_signals
-    return fg_probes, params
+    corrected_signals = apply_bg_correction(fg_means, params, dtype=dtype)
+    # a new frame: fg_probes is a cached view of the SampleDataContainer
+    return fg_probes.assign(bg_corrected=corrected_signals), params
 
 
-def normexp_bg_correct_control(control_probes, params):
+def normexp_bg_correct_control(control_probes, params, dtype=np.float64):
     """Function for getting xcs controls for preprocessNoob"""
-    control_means = control_probes['mean_value']
-    corrected_signals = apply_bg_correction(control_means, params)
-    control_probes['bg_corrected'] = corrected_signals
-    return control_probes
+    control_means = as_float(control_probes['mean_value'])
+    corrected_signals = apply_bg_correction(control_means, params, dtype=dtype)
+    return control_probes.assign(bg_corrected=corrected_signals)
+
 
+def apply_bg_correction(mean_values, params, out=None, dtype=np.float64):
+    """Background-corrected signal of each intensity (normexp_signal), with the parameters of its sample.
 
-def apply_bg_correction(mean_values, params):
-    """ this function won't work with float16 in practice. limits use to float32 """
+    Arguments:
+        mean_values {array or Series} -- intensities of one sample, or a (samples x probes) matrix.
+        params {BackgroundCorrectionParams} -- scalars, or one value per row as column vectors.
+
+    Keyword Arguments:
+        out {ndarray} -- preallocated array for the result, which sets the precision (default: {None})
+        dtype {numpy dtype} -- precision of the computation when out is not given (default: {np.float64})
+
+    Returns:
+        [ndarray] -- the corrected signals, shaped like mean_values.
+    """
     if not isinstance(params, BackgroundCorrectionParams):
         raise ValueError('params is not a BackgroundCorrectionParams instance')
+    return normexp_signal(
+        mean_values, params.bg_mean, params.bg_mad, params.mean_signal, params.offset, out=out, dtype=dtype)
 
-    bg_mean = params.bg_mean
-    bg_mad = params.bg_mad
-    mean_signal = params.mean_signal
-    offset = params.offset
 
-    mu_sf = mean_values - bg_mean - (bg_mad ** 2) / mean_signal
+def normexp_signal(mean_values, bg_mean, bg_mad, mean_signal, offset=15, out=None, work=None, dtype=np.float64):
+    """The normal-exponential convolution model: the expected true signal of each observed intensity,
 
-    signal = mu_sf + (bg_mad ** 2) * \
-        np.exp(norm(mu_sf, bg_mad).logpdf(0) - norm(mu_sf, bg_mad).logsf(0))
+        signal = mu_sf + sigma * phi(z) / Phi(z),  with mu_sf = x - bg_mean - sigma^2 / mean_signal and z = mu_sf / sigma
 
-    signal = np.maximum(signal, 1e-6)
-    true_signal = signal + offset
+    floored at 1e-6, plus offset. phi(z) / Phi(z) is computed as sqrt(2 / pi) / erfcx(-z / sqrt(2)), which stays
+    finite in both tails. Only the result and one work array (both preallocated if given) are written to.
+    Parameters can be scalars, or column vectors to correct a (samples x probes) matrix in one pass.
 
-    return true_signal
+    float32 halves the memory used, and stays within a few float32 ulps of the float64 result: below z = LOWER_TAIL_Z,
+    z + phi(z) / Phi(z) loses the precision of z to cancellation (the signal tends to sigma / -z), so those few
+    values are recomputed in float64.
 
-
-def huber(vector):
+    Keyword Arguments:
+        out {ndarray} -- array for the result, shaped like mean_values; sets the precision (default: {None})
+        work {ndarray} -- scratch array like out (default: {None})
+        dtype {numpy dtype} -- precision of the computation when out is not given (default: {np.float64})
+    """
+    mean_values = np.asarray(mean_values)
+    if out is None:
+        out = np.empty(mean_values.shape, dtype=dtype)
+    if work is None:
+        work = np.empty_like(out)
+    sigma = np.asarray(bg_mad, dtype=np.float64)
+
+    z = work
+    np.subtract(mean_values, bg_mean + sigma ** 2 / mean_signal, out=z, casting='unsafe')
+    np.divide(z, sigma, out=z, casting='unsafe')
+    # the inverse Mills ratio, phi(z) / Phi(z)
+    np.multiply(z, -SQRT_HALF, out=out, casting='unsafe')
+    special.erfcx(out, out=out)
+    np.divide(SQRT_2_OVER_PI, out, out=out, casting='unsafe')
+    out += z
+    np.multiply(out, sigma, out=out, casting='unsafe')
+
+    np.maximum(out, 1e-6, out=out)
+    out += offset
+
+    if out.dtype != np.float64:
+        tail = z < LOWER_TAIL_Z
+        if tail.any():
+            tail_values = lambda values: np.broadcast_to(values, out.shape)[tail]
+            out[tail] = normexp_signal(tail_values(mean_values), tail_values(bg_mean), tail_values(sigma),
+                tail_values(mean_signal), offset, dtype=np.float64)
+    return out
+
+
+def huber(values, positive_factor=1.5, convergence_tol=1.0e-6, dtype=np.float64):
     """Huber function. Designed to mirror MASS huber function in R
 
+    All rows of a matrix are estimated together: each iteration clips and averages the rows that
+    have not converged yet. Like MASS, the estimates are computed in float64; with dtype float32
+    only the values are clipped in float32 (sums are still float64), which moves mu by up to
+    convergence_tol * s.
+
     Parameters
     ----------
-    vector: list
-        list of float values
+    values: list, 1-D array or 2-D (samples x values) array
+        float values; NaN values (probes masked by min_beads, or padding) are ignored.
+    dtype: numpy dtype
+        precision of the clipped values, float64 (default) or float32.
 
     Returns
     -------
-    local_median: float
+    local_median: float, or array with one value per row
         calculated mu value
-    mad_scale: float
+    mad_scale: float, or array with one value per row
         calculated s value
     """
-    num_values = len(vector)
-    positive_factor = 1.5
-    convergence_tol = 1.0e-6
-    mad_scale = robust.mad(vector)
-    local_median = np.median(vector)
-    init_local_median = local_median
-
-    if not (local_median or mad_scale):
-        return local_median, mad_scale
-
-    while True:
-        yy = np.minimum(
-            np.maximum(
-                local_median - positive_factor * mad_scale,
-                vector,
-            ),
-            local_median + positive_factor * mad_scale,
-        )
-
-        init_local_median = sum(yy) / num_values
-
-        if abs(local_median - init_local_median) < convergence_tol * mad_scale:
-            return local_median, mad_scale
-
-        local_median = init_local_median
+    matrix = np.atleast_2d(np.asarray(values, dtype=dtype))
+    is_vector = np.ndim(values) == 1
+    nan_mask = np.isnan(matrix)
+    if not nan_mask.any():
+        nan_mask = None
+    num_values = matrix.shape[1] - (nan_mask.sum(axis=1) if nan_mask is not None else 0)
+
+    local_median = np.nanmedian(matrix, axis=1).astype(np.float64)
+    mad_scale = np.nanmedian(np.abs(matrix - local_median[:, None].astype(matrix.dtype)), axis=1) / MAD_CONSTANT
+
+    # rows with a zero MAD are their median already (clipping leaves nothing else); empty rows are NaN.
+    active = np.flatnonzero((mad_scale > 0) & (num_values > 0))
+    while active.size:
+        rows = matrix[active]
+        lower = local_median[active] - positive_factor * mad_scale[active]
+        upper = local_median[active] + positive_factor * mad_scale[active]
+        yy = np.clip(rows, lower[:, None].astype(matrix.dtype), upper[:, None].astype(matrix.dtype), out=rows)
+        if nan_mask is not None:
+            yy[nan_mask[active]] = 0
+        init_local_median = yy.sum(axis=1, dtype=np.float64) / (num_values[active] if nan_mask is not None else num_values)
+
+        converged = np.abs(local_median[active] - init_local_median) < convergence_tol * mad_scale[active]
+        local_median[active[~converged]] = init_local_median[~converged]
+        active = active[~converged]
+
+    if is_vector:
+        return local_median[0], mad_scale[0]
+    return local_median, mad_scale
@@ -0,0 +1,105 @@
+# Lib
+import logging
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+# App
+from ..models import Channel, ProbeType
+
+
+__all__ = ['QuantileReference']
+
+
+LOGGER = logging.getLogger(__name__)
+
+# probes are normalized within their design type (and color, for type I): their intensity distributions differ.
+QUANTILE_GROUPS = (
+    ('I-Red', ProbeType.ONE, Channel.RED),
+    ('I-Grn', ProbeType.ONE, Channel.GREEN),
+    ('II', ProbeType.TWO, None),
+)
+QUANTILE_COLUMNS = ('noob_meth', 'noob_unmeth')
+
+
+class QuantileReference():
+    """The reference distribution of a quantile normalization between arrays, accumulated one sample at a time.
+
+    Each sample's noob_meth and noob_unmeth values are sorted within each probe group (type I red, type I green,
+    type II), and the sorted values are added to a running sum, so the reference (their mean at every quantile) is
+    built in memory proportional to the number of probes, however many samples there are. Samples with missing
+    probes are interpolated to the length of the group. The rank of every probe is kept, as the sample's
+    quantile_ranks, and normalize() later replaces each value by the reference value at its rank.
+
+    Arguments:
+        manifest {Manifest} -- the Manifest of the samples' array type.
+    """
+
+    def __init__(self, manifest):
+        self.groups = {
+            name: manifest.get_probe_details(probe_type, channel).index
+            for name, probe_type, channel in QUANTILE_GROUPS
+        }
+        self.sums = {
+            (name, column): np.zeros(len(probes))
+            for name, probes in self.groups.items()
+            for column in QUANTILE_COLUMNS
+        }
+        self.num_samples = 0
+
+    def add(self, data_frame):
+        """Adds a sample's sorted values to the reference.
+
+        Arguments:
+            data_frame {DataFrame} -- the sample's processed data, with noob_meth and noob_unmeth columns, indexed by probe name.
+
+        Returns:
+            [DataFrame] -- the quantile (0 to 1) of each value within its group, NaN for missing values and
+                probes outside the groups. Ties share their average rank.
+        """
+        ranks = pd.DataFrame(np.nan, index=data_frame.index, columns=list(QUANTILE_COLUMNS))
+        for name, probes in self.groups.items():
+            positions = data_frame.index.get_indexer(probes)
+            positions = positions[positions >= 0]
+            for column in QUANTILE_COLUMNS:
+                values = data_frame[column].to_numpy(dtype=np.float64)[positions]
+                found = ~np.isnan(values)
+                if not found.any():
+                    continue
+                values = values[found]
+                group_ranks = (rankdata(values) - 1) / (len(values) - 1) if len(values) > 1 else get_quantiles(1)
+                ranks.iloc[positions[found], ranks.columns.get_loc(column)] = group_ranks
+                self.sums[name, column] += np.interp(get_quantiles(len(self.groups[name])), get_quantiles(len(values)), np.sort(values))
+        self.num_samples += 1
+        return ranks
+
+    def get_reference(self, name, column):
+        """The mean of the samples' sorted values of one probe group and column, at evenly spaced quantiles."""
+        if not self.num_samples:
+            raise ValueError('no samples have been added to the QuantileReference')
+        return self.sums[name, column] / self.num_samples
+
+    def normalize(self, data_frame, ranks):
+        """Returns a copy of data_frame where noob_meth and noob_unmeth are replaced by the reference values at their ranks.
+
+        Arguments:
+            data_frame {DataFrame} -- processed data of a sample, possibly a subset of the probes it was add()ed with.
+            ranks {DataFrame} -- the quantile_ranks add() returned for this sample.
+        """
+        ranks = ranks.reindex(data_frame.index)
+        data_frame = data_frame.copy()
+        for column in QUANTILE_COLUMNS:
+            normalized = np.array(data_frame[column], dtype=np.float64)
+            column_ranks = ranks[column].to_numpy()
+            for name, probes in self.groups.items():
+                positions = data_frame.index.get_indexer(probes)
+                positions = positions[positions >= 0]
+                positions = positions[~np.isnan(column_ranks[positions])]
+                reference = self.get_reference(name, column)
+                normalized[positions] = np.interp(column_ranks[positions], get_quantiles(len(reference)), reference)
+            data_frame[column] = normalized.astype('float32').round(3)
+        return data_frame
+
+
+def get_quantiles(length):
+    """length evenly spaced quantiles, from 0 to 1"""
+    return np.linspace(0, 1, length) if length > 1 else np.full(length, 0.5)
@@ -1,15 +1,16 @@
 # Lib
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 # App
 from ..models import (
     FG_PROBE_SUBSETS,
     ArrayType,
     Channel,
+    ProbeAddress,
     ProbeType,
 )
 from ..files import IdatDataset
-from ..utils import inner_join_data
 from ..utils.progress_bar import * # checks environment and imports tqdm appropriately.
 from collections import Counter
 
@@ -19,7 +20,8 @@ __all__ = ['RawDataset', 'RawMetaDataset', 'get_raw_datasets', 'get_raw_meta_dat
 LOGGER = logging.getLogger(__name__)
 
 
-def get_raw_datasets(sample_sheet, sample_name=None, from_s3=None, meta_only=False):
+def get_raw_datasets(sample_sheet, sample_name=None, from_s3=None, meta_only=False, workers=None, min_beads=None,
+                     idat_cache=None):
     """Generates a collection of RawDataset instances for the samples in a sample sheet.
 
     Arguments:
@@ -27,9 +29,15 @@ def get_raw_datasets(sample_sheet, sample_name=None, from_s3=None, meta_only=Fal
 
     Keyword Arguments:
         sample_name {string} -- Optional: one sample to process from the sample_sheet. (default: {None})
-        from_s3 {zip_reader} -- pass in a S3ZipReader object to extract idat files from a zipfile hosted on s3.
+        from_s3 {zip_reader} -- pass in a S3ZipReader object to extract idat files from a zipfile hosted on s3,
+            or a TarIdatReader to read them from a local tar archive.
         meta_only {True/False} -- doesn't read idat files, only parses the meta data about them.
         (RawMetaDataset is same as RawDataset but has no idat probe values stored in object, because not needed in pipeline)
+        workers {int} -- number of threads used to read IDAT pairs concurrently. File reads and gzip
+            decompression release the GIL, so this helps most on network storage. (default: {None}, serial)
+        min_beads {int} -- mask probes measured on fewer beads than this to NaN. (default: {None})
+        idat_cache {IdatCache} -- load decoded IDATs from this on-disk cache, and add the ones
+            it is missing. Not used with from_s3. (default: {None})
 
     Raises:
         ValueError: If the number of probes between raw datasets differ.
@@ -56,34 +64,117 @@ def get_raw_datasets(sample_sheet, sample_name=None, from_s3=None, meta_only=Fal
         parser = RawMetaDataset
         raw_datasets = [parser(sample) for sample in samples]
     elif from_s3 and not meta_only:
-        parser = RawDataset.from_sample_s3
         zip_reader = from_s3
-        raw_datasets = tqdm([parser(zip_reader, sample) for sample in samples], total=len(samples), desc='Getting raw datasets')
+        parser = lambda sample: RawDataset.from_sample_s3(zip_reader, sample, min_beads=min_beads)
+        raw_datasets = read_samples(parser, samples, workers=workers, desc='Getting raw datasets')
     elif not from_s3 and not meta_only:
-        parser = RawDataset.from_sample
-        raw_datasets = tqdm([parser(sample) for sample in samples], total=len(samples), desc='Getting raw datasets')
+        parser = lambda sample: RawDataset.from_sample(sample, min_beads=min_beads, idat_cache=idat_cache)
+        raw_datasets = read_samples(parser, samples, workers=workers, desc='Getting raw datasets')
 
     if not meta_only:
         # ensure all idat files have same number of probes
-        probe_counts = {
-            dataset.n_snps_read
-            for dataset in raw_datasets
-        }
-
-        if len(probe_counts) != 1:
-            # also explain which samples have which probes -- for splitting samples up
-            probe_sample_counts = Counter([dataset.n_snps_read for dataset in raw_datasets])
-            samples_by_probe_count = {probe_count:[] for probe_count in list(probe_counts)}
-            for dataset in raw_datasets:
-                sample_name = f"{dataset.sample.sentrix_id}_{dataset.sample.sentrix_id}"
-                samples_by_probe_count[dataset.n_snps_read].append(sample_name)
-            LOGGER.error(f'Samples grouped by probe count: {probe_sample_counts.most_common()}')
-            LOGGER.error(f'{samples_by_probe_count}')
-            raise ValueError(f'IDATs with varying number of probes: {probe_counts}')
+        check_probe_counts(raw_datasets)
 
     return raw_datasets
 
 
+def read_samples(parser, samples, workers=None, desc=None):
+    """Applies parser to every sample, on a pool of threads if workers > 1.
+
+    Progress is reported as each sample finishes, and results keep the order of samples.
+    The first exception raised by parser is re-raised after pending reads are cancelled."""
+    samples = list(samples)
+    if not workers or workers <= 1 or len(samples) <= 1:
+        return [parser(sample) for sample in tqdm(samples, total=len(samples), desc=desc)]
+
+    results = [None] * len(samples)
+    with ThreadPoolExecutor(max_workers=min(workers, len(samples))) as executor:
+        futures = {executor.submit(parser, sample): idx for idx, sample in enumerate(samples)}
+        try:
+            for future in tqdm(as_completed(futures), total=len(samples), desc=desc):
+                results[futures[future]] = future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
+
+
+def get_raw_meta_datasets(sample_sheet, sample_name=None, scan_headers=True, from_s3=None):
+    """Generates a collection of RawMetaDataset instances for the samples in a sample sheet,
+    reading only the IDAT headers. Use this to validate a whole sample sheet before loading
+    any intensity data.
+
+    Arguments:
+        sample_sheet {SampleSheet} -- The SampleSheet from which the data originates.
+
+    Keyword Arguments:
+        sample_name {string or list} -- Optional: sample(s) to scan from the sample_sheet. (default: {None})
+        scan_headers {True/False} -- if True, scans the green and red IDAT headers of every sample
+            (offset table, probe count, and barcode/chip type for uncompressed files).
+            If False, only the sample meta data is kept. (default: {True})
+        from_s3 {zip_reader} -- scan IDAT files inside an archive instead, using a S3ZipReader
+            or TarIdatReader. (default: {None})
+
+    Raises:
+        ValueError: If any IDAT file is missing, truncated or not an IDAT,
+            or if the number of probes between samples differ.
+
+    Returns:
+        [RawMetaDataset] -- A list of RawMetaDataset instances.
+    """
+    if not sample_name:
+        samples = sample_sheet.get_samples()
+    elif type(sample_name) is list:
+        samples = [
+            sample_sheet.get_sample(sample)
+            for sample in sample_name
+        ]
+    else:
+        samples = [sample_sheet.get_sample(sample_name)]
+
+    if not scan_headers:
+        return [RawMetaDataset(sample) for sample in samples]
+
+    meta_datasets = []
+    unreadable = {}
+    for sample in tqdm(samples, total=len(samples), desc='Scanning IDAT headers'):
+        try:
+            if from_s3:
+                meta_datasets.append(RawMetaDataset.from_sample_s3(from_s3, sample))
+            else:
+                meta_datasets.append(RawMetaDataset.from_sample(sample))
+        except (OSError, EOFError, ValueError) as e:
+            unreadable[str(sample)] = str(e)
+
+    if unreadable:
+        LOGGER.error(f'Unreadable IDATs: {unreadable}')
+        raise ValueError(f'{len(unreadable)} of {len(samples)} samples have missing, truncated or invalid IDAT files: {unreadable}')
+
+    check_probe_counts(meta_datasets)
+    return meta_datasets
+
+
+def check_probe_counts(datasets):
+    """Raises a ValueError if datasets (RawDataset or scanned RawMetaDataset) do not all have
+    the same number of probes, and logs which samples have which probe counts."""
+    probe_counts = {
+        dataset.n_snps_read
+        for dataset in datasets
+    }
+
+    if len(probe_counts) > 1:
+        # also explain which samples have which probes -- for splitting samples up
+        probe_sample_counts = Counter([dataset.n_snps_read for dataset in datasets])
+        samples_by_probe_count = {probe_count:[] for probe_count in list(probe_counts)}
+        for dataset in datasets:
+            sample_name = f"{dataset.sample.sentrix_id}_{dataset.sample.sentrix_position}"
+            samples_by_probe_count[dataset.n_snps_read].append(sample_name)
+        LOGGER.error(f'Samples grouped by probe count: {probe_sample_counts.most_common()}')
+        LOGGER.error(f'{samples_by_probe_count}')
+        raise ValueError(f'IDATs with varying number of probes: {probe_counts}')
+
+
 def get_array_type(raw_datasets):
     """ provide a list of raw_datasets and it will return the array type by counting probes """
     array_types = {dataset.array_type for dataset in raw_datasets}
@@ -121,35 +212,44 @@ class RawDataset():
         self.array_type = ArrayType.from_probe_count(self.n_snps_read)
 
     @classmethod
-    def from_sample(cls, sample):
+    def from_sample(cls, sample, min_beads=None, idat_cache=None):
+        """Reads both IDAT files of a sample. If min_beads is set, probes measured on fewer
+        beads are masked to NaN in the channel means. If an IdatCache is given, decoded
+        files are loaded from (and saved to) the cache."""
         green_filepath = sample.get_filepath('idat', Channel.GREEN)
-        green_idat = IdatDataset(green_filepath, channel=Channel.GREEN)
-
         red_filepath = sample.get_filepath('idat', Channel.RED)
-        red_idat = IdatDataset(red_filepath, channel=Channel.RED)
+        if idat_cache is not None:
+            green_idat = idat_cache.get_idat(green_filepath, Channel.GREEN, min_beads=min_beads)
+            red_idat = idat_cache.get_idat(red_filepath, Channel.RED, min_beads=min_beads)
+        else:
+            green_idat = IdatDataset(green_filepath, channel=Channel.GREEN, min_beads=min_beads)
+            red_idat = IdatDataset(red_filepath, channel=Channel.RED, min_beads=min_beads)
         return cls(sample, green_idat, red_idat)
 
     @classmethod
-    def from_sample_s3(cls, zip_reader, sample):
+    def from_sample_s3(cls, zip_reader, sample, min_beads=None):
         green_filepath = sample.get_file_s3(zip_reader, 'idat', suffix=Channel.GREEN)
-        green_idat = IdatDataset(green_filepath, channel=Channel.GREEN)
+        green_idat = IdatDataset(green_filepath, channel=Channel.GREEN, min_beads=min_beads)
 
         red_filepath = sample.get_file_s3(zip_reader, 'idat', suffix=Channel.RED)
-        red_idat = IdatDataset(red_filepath, channel=Channel.RED)
+        red_idat = IdatDataset(red_filepath, channel=Channel.RED, min_beads=min_beads)
         return cls(sample, green_idat, red_idat)
 
-    def get_channel_means(self, channel):
+    def get_channel_idat(self, channel):
         if not isinstance(channel, Channel):
             raise TypeError('channel is not a valid Channel')
         if channel is Channel.GREEN:
-            return self.green_idat.probe_means
-        return self.red_idat.probe_means
+            return self.green_idat
+        return self.red_idat
+
+    def get_channel_means(self, channel):
+        return self.get_channel_idat(channel).probe_means
 
     def get_fg_controls(self, manifest, channel):
         #LOGGER.info('Preprocessing %s foreground controls dataset: %s', channel, self.sample)
-        control_probes = manifest.control_data_frame
-        channel_means = self.get_channel_means(channel).astype('float16')
-        return inner_join_data(control_probes, channel_means)
+        control_index = manifest.get_control_index()
+        found, mean_values = manifest.get_subset_means(control_index, self.get_channel_idat(channel))
+        return manifest.control_data_frame.take(control_index.positions[found]).assign(mean_value=mean_values)
 
     def get_oob_controls(self, manifest):
         """ Out-of-bound controls are the mean intensity values for the
@@ -169,36 +269,19 @@ class RawDataset():
         """ this is the step where it appears that illumina_id (internal probe numbers)
         are matched to the AddressA_ID / B_IDs from manifest,
         which allows for 'cgXXXXXXX' probe names to be used later. """
-        probe_details = manifest.get_probe_details(
-            probe_type=ProbeType.ONE,
-            channel=channel,
-        )
         # 2020-03-25: probe_details was returning an empty DataFrame with mouse,
         # because two new probe types existed (IR, IG) -- note that new types results
         # in this null issue and a huber ZeroDivisionError ultimately in CLI.
+        address_columns = [ProbeAddress.A.header_name, ProbeAddress.B.header_name]
+        oob_probes = []
+        for probe_address in (ProbeAddress.A, ProbeAddress.B):
+            subset_index = manifest.get_subset_index(ProbeType.ONE, channel, probe_address)
+            found, mean_values = manifest.get_subset_means(subset_index, idat_dataset)
+            probe_details = manifest.data_frame[address_columns].take(subset_index.positions[found])
+            oob_probes.append(probe_details.assign(mean_value=mean_values))
 
-        probe_details = probe_details[['AddressA_ID', 'AddressB_ID']]
-
-        probe_means = idat_dataset.probe_means
-
-        set_a = probe_details.merge(
-            probe_means,
-            how='inner',
-            left_on='AddressA_ID',
-            right_index=True,
-            suffixes=(False, False),
-        )
-
-        set_b = probe_details.merge(
-            probe_means,
-            how='inner',
-            left_on='AddressB_ID',
-            right_index=True,
-            suffixes=(False, False),
-        )
-
-        oob_probes = set_a.append(set_b) # will contain duplicates for probes that have both red and grn channels (II)
-        return oob_probes
+        # will contain duplicates for probes that have both red and grn channels (II)
+        return pd.concat(oob_probes)
 
     def get_fg_values(self, manifest, channel):
         """ appears to only be used in NOOB function """
@@ -222,16 +305,19 @@ class RawDataset():
         return pd.concat(channel_foregrounds)
 
     def get_subset_means(self, probe_subset, manifest):
-        """apparently, not called anywhere """
-        channel_means_df = self.get_channel_means(probe_subset.data_channel)
-        probe_details = probe_subset.get_probe_details(manifest)
-        column_name = probe_subset.column_name
-
-        merge_df = probe_details[[column_name, 'probe_type']]
-        merge_df = merge_df.reset_index()
-        merge_df = merge_df.set_index(column_name)
-
-        return inner_join_data(channel_means_df, merge_df)
+        """ foreground values of one probe subset, indexed by illumina_id, in IDAT file order """
+        subset_index = manifest.get_subset_index(probe_subset.probe_type, probe_subset.probe_channel, probe_subset.probe_address)
+        found, mean_values = manifest.get_subset_means(
+            subset_index, self.get_channel_idat(probe_subset.data_channel), idat_order=True)
+        probe_details = manifest.data_frame.take(subset_index.positions[found])
+        return pd.DataFrame(
+            data={
+                'mean_value': mean_values,
+                probe_details.index.name: probe_details.index.values,
+                'probe_type': probe_details['probe_type'].values,
+            },
+            index=pd.Index(subset_index.addresses[found], dtype=probe_details[probe_subset.column_name].dtype, name='illumina_id'),
+        )
 
 
 class RawMetaDataset():
@@ -240,11 +326,50 @@ class RawMetaDataset():
     Arguments:
         sample {Sample} -- A Sample parsed from the sample sheet.
 
+    Keyword Arguments:
+        green_header {IdatHeader} -- The scanned header of the sample's GREEN channel IDAT. (default: {None})
+        red_header {IdatHeader} -- The scanned header of the sample's RED channel IDAT. (default: {None})
+
     each Sample contains (at a minimum):
         data_dir=self.data_dir
         sentrix_id=sentrix_id
         sentrix_position=sentrix_position
+
+    Raises:
+        ValueError: If the IDAT file pair have differing number of probes.
     """
 
-    def __init__(self, sample):
+    def __init__(self, sample, green_header=None, red_header=None):
         self.sample = sample
+        self.green_header = green_header
+        self.red_header = red_header
+        self.n_snps_read = None
+        self.array_type = None
+
+        if green_header is not None and red_header is not None:
+            snps_read = {green_header.n_snps_read, red_header.n_snps_read}
+            if len(snps_read) > 1:
+                raise ValueError('IDAT files have a varying number of probes (compared Grn to Red channel)')
+            self.n_snps_read = snps_read.pop()
+            self.array_type = ArrayType.from_probe_count(self.n_snps_read)
+
+    @classmethod
+    def from_sample(cls, sample):
+        """Scans the headers of both IDAT files of a sample, without reading intensities."""
+        green_filepath = sample.get_filepath('idat', Channel.GREEN)
+        green_header = IdatDataset.scan_header(green_filepath, channel=Channel.GREEN)
+
+        red_filepath = sample.get_filepath('idat', Channel.RED)
+        red_header = IdatDataset.scan_header(red_filepath, channel=Channel.RED)
+        return cls(sample, green_header, red_header)
+
+    @classmethod
+    def from_sample_s3(cls, zip_reader, sample):
+        """Scans the headers of both IDAT files of a sample inside an archive. Only the start
+        of each member is decompressed, since the barcode and chip type strings are skipped."""
+        green_file = sample.get_file_s3(zip_reader, 'idat', suffix=Channel.GREEN)
+        green_header = IdatDataset.scan_header(green_file, channel=Channel.GREEN, read_strings=False)
+
+        red_file = sample.get_file_s3(zip_reader, 'idat', suffix=Channel.RED)
+        red_header = IdatDataset.scan_header(red_file, channel=Channel.RED, read_strings=False)
+        return cls(sample, green_header, red_header)
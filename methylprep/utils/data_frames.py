@@ -1,4 +1,7 @@
-__all__ = ['inner_join_data']
+import numpy as np
+
+
+__all__ = ['inner_join_data', 'as_float']
 
 
 def inner_join_data(left_df, right_df, left_on=None, right_on=None):
@@ -30,3 +33,23 @@ def inner_join_data(left_df, right_df, left_on=None, right_on=None):
         right_on=right_on,
         suffixes=(False, False),
     )
+
+
+def as_float(values, dtype='float32'):
+    """Converts integer intensities (such as raw uint16 IDAT means) to floats, so
+    arithmetic on them cannot wrap around. Float inputs are returned unchanged.
+
+    Arguments:
+        values {ndarray, Series or scalar} -- intensity values.
+
+    Keyword Arguments:
+        dtype {string} -- float type used for integer inputs (default: {'float32'})
+
+    Returns:
+        The values, as a float array/Series of the same shape.
+    """
+    if not hasattr(values, 'dtype'):
+        values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.integer):
+        return values.astype(dtype)
+    return values
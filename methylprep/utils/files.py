@@ -1,16 +1,28 @@
 # Lib
+from contextlib import contextmanager
 import gzip
+import hashlib
 import logging
+import os
 from pathlib import Path, PurePath
+import re
 import shutil
-from urllib.request import urlopen
-from urllib.error import URLError
+import tempfile
+import time
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
 import ssl
+try:
+    import fcntl
+except ImportError: # windows
+    fcntl = None
+    import msvcrt
 
 
 __all__ = [
     'download_file',
     'ensure_directory_exists',
+    'file_lock',
     'get_file_object',
     'is_file_like',
     'read_and_reset',
@@ -20,6 +32,10 @@ __all__ = [
 
 LOGGER = logging.getLogger(__name__)
 
+DOWNLOAD_LOCK_TIMEOUT = 3600 # seconds to wait for another process downloading the same file
+PARTIAL_SUFFIX = '.part' # incomplete downloads; resumed by the next attempt
+LOCK_SUFFIX = '.lock'
+
 
 def read_and_reset(inner):
     """Decorator that resets a file-like object back to the original
@@ -71,9 +87,146 @@ def ensure_directory_exists(path_like):
     parent_dir.mkdir(parents=True, exist_ok=True)
 
 
-def download_file(filename, src_url, dest_dir, overwrite=False):
+@contextmanager
+def file_lock(lock_path, timeout=DOWNLOAD_LOCK_TIMEOUT):
+    """Holds an exclusive lock on a file, across processes (and threads), while in the with block.
+    The lock is released by the operating system if the process dies, so it cannot go stale.
+
+    Arguments:
+        lock_path {path-like} -- the lock file. Created if missing, and left in place afterwards.
+
+    Keyword Arguments:
+        timeout {number} -- seconds to wait for the lock (default: {DOWNLOAD_LOCK_TIMEOUT})
+
+    Raises:
+        TimeoutError: The lock was held by another process for longer than timeout.
+    """
+    with open(lock_path, 'a+b') as lock_file:
+        waited = 0
+        while True:
+            try:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                if waited == 0:
+                    LOGGER.info(f'Waiting for another process to release {lock_path}')
+                if waited >= timeout:
+                    raise TimeoutError(f'{lock_path} was locked for more than {timeout} seconds')
+                time.sleep(0.1)
+                waited += 0.1
+        try:
+            yield lock_file
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def get_file_checksum(filepath, algorithm='sha256'):
+    """Returns the hex digest of a file, read in blocks."""
+    digest = hashlib.new(algorithm)
+    with open(filepath, 'rb') as infile:
+        for block in iter(lambda: infile.read(1024 ** 2), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def verify_download(filepath, checksum=None, gzipped=None):
+    """Checks a downloaded file against its sha256 checksum, if one is known. Without one,
+    gzipped files are still fully decompressed, so a truncated or corrupted file fails its gzip CRC.
+    gzipped defaults to whether the file name ends in .gz.
+
+    Raises:
+        ValueError: The file does not match its checksum, or is not a complete gzip file.
+    """
+    if checksum:
+        actual = get_file_checksum(filepath)
+        if actual != checksum.lower():
+            raise ValueError(f'{filepath} has checksum {actual}, not {checksum}')
+    elif gzipped if gzipped is not None else PurePath(filepath).suffix == '.gz':
+        try:
+            with gzip.open(filepath, 'rb') as infile:
+                while infile.read(1024 ** 2):
+                    pass
+        except (OSError, EOFError) as e:
+            raise ValueError(f'{filepath} is not a complete gzip file: {e}')
+
+
+def get_content_length(response):
+    """The Content-Length header of a response, or None if there is none."""
+    headers = getattr(response, 'headers', None)
+    length = headers.get('Content-Length') if headers is not None else None
+    return int(length) if isinstance(length, str) and length.isdigit() else None
+
+
+def fetch_to_file(src_url, partial_path, resume=True, context=None):
+    """Downloads src_url into partial_path, continuing a previous partial download with a
+    Range request if the server supports it.
+
+    Raises:
+        URLError: The download failed, or ended before Content-Length bytes were received.
+            The bytes received are kept, for the next attempt to resume from.
+    """
+    offset = partial_path.stat().st_size if resume and partial_path.exists() else 0
+    request = Request(src_url, headers={'Range': f'bytes={offset}-'}) if offset else src_url
+    try:
+        response = urlopen(request, context=context) if context else urlopen(request)
+    except HTTPError as e:
+        if e.code != 416: # Range Not Satisfiable: the partial file already has every byte
+            raise
+        LOGGER.info(f'{partial_path.name} was already fully downloaded')
+        return
+    with response:
+        content_range = getattr(response, 'headers', {}).get('Content-Range') if offset else None
+        match = re.match(r'bytes (\d+)-', content_range) if isinstance(content_range, str) else None
+        if getattr(response, 'status', None) == 206 and match and int(match.group(1)) == offset:
+            LOGGER.info(f'Resuming download of {partial_path.name} from byte {offset}')
+            mode = 'ab'
+        else:
+            offset = 0
+            mode = 'wb'
+        expected_size = get_content_length(response)
+        with open(partial_path, mode) as out_file:
+            shutil.copyfileobj(response, out_file)
+            received = out_file.tell() - offset
+    if expected_size is not None and received < expected_size:
+        raise URLError(f'download of {src_url} ended after {received} of {expected_size} bytes')
+
+
+def get_lock_path(dest_path):
+    """The lock file download_file holds while downloading dest_path. It is kept in the temp
+    directory, named after a hash of the absolute destination path, so it never clutters the
+    download directory and can stay in place: removing a lock file other processes may be waiting
+    on would let two of them download at once."""
+    digest = hashlib.sha1(str(Path(dest_path).resolve()).encode()).hexdigest()[:16]
+    return Path(tempfile.gettempdir(), f'methylprep_download_{digest}{LOCK_SUFFIX}')
+
+
+def download_file(filename, src_url, dest_dir, overwrite=False, checksum=None, resume=True):
     """download_file now defaults to non-SSL if SSL fails, with warning to user.
-    MacOS doesn't have ceritifi installed by default."""
+    MacOS doesn't have ceritifi installed by default.
+
+    Downloads are safe to run from several processes at once: one process downloads while the
+    others wait on a lock file (in the temp directory, see get_lock_path), then find the finished
+    file. The file is written to <filename>.part and only renamed to filename once complete and
+    verified, so an existing file is never a partial download. An interrupted download is resumed
+    by the next attempt.
+
+    Keyword Arguments:
+        overwrite {boolean} -- download again, even if the file exists. (default: {False})
+        checksum {string} -- sha256 hex digest the file must match. Without one, .gz files are
+            checked for a complete gzip stream. (default: {None})
+        resume {boolean} -- continue a previous partial download, if the server allows ranges. (default: {True})
+
+    Raises:
+        ValueError: The downloaded file does not match its checksum (it is removed).
+    """
     dir_path = make_path_like(dest_dir)
     dest_path = dir_path.joinpath(filename)
 
@@ -84,22 +237,35 @@ def download_file(filename, src_url, dest_dir, overwrite=False):
         LOGGER.info(f'File exists: {dest_path} Set overwrite=True to overwrite the file.')
         #raise FileExistsError(f'File exists: {dest_path}') # -- raising an error here terminates lambda, except that pipeline_s3 catches it.
         return
-    try:
-        with urlopen(src_url) as response:
-            with open(dest_path, 'wb') as out_file:
-                shutil.copyfileobj(response, out_file)
-    except URLError as e:
-        LOGGER.error(e)
-        LOGGER.info("If you got [SSL: CERTIFICATE_VERIFY_FAILED] error and you're using MacOS, go to folder /Applications/Python 3.X and run 'Install Certificates.command' to fix this. It cannot download from https.")
-        # <urlopen error [SSL: CERTIFICATE_VERIFY_FAILED] certificate verify failed: unable to get local issuer certificate (_ssl.c:1056)>
+
+    partial_path = dir_path.joinpath(filename + PARTIAL_SUFFIX)
+    requested_at = time.time()
+    with file_lock(get_lock_path(dest_path)):
+        # another process may have finished the download while this one waited for the lock.
+        if dest_path.exists() and (not overwrite or dest_path.stat().st_mtime > requested_at):
+            LOGGER.info(f'File exists: {dest_path} (downloaded by another process)')
+            return
         try:
-            LOGGER.info("retrying without SSL")
-            context = ssl._create_unverified_context()
-            with urlopen(src_url, context=context) as response:
-                with open(dest_path, 'wb') as out_file:
-                    shutil.copyfileobj(response, out_file)
+            fetch_to_file(src_url, partial_path, resume=resume)
+        except HTTPError:
+            raise
         except URLError as e:
-            raise URLError(e)
+            LOGGER.error(e)
+            LOGGER.info("If you got [SSL: CERTIFICATE_VERIFY_FAILED] error and you're using MacOS, go to folder /Applications/Python 3.X and run 'Install Certificates.command' to fix this. It cannot download from https.")
+            # <urlopen error [SSL: CERTIFICATE_VERIFY_FAILED] certificate verify failed: unable to get local issuer certificate (_ssl.c:1056)>
+            try:
+                LOGGER.info("retrying without SSL")
+                context = ssl._create_unverified_context()
+                fetch_to_file(src_url, partial_path, resume=resume, context=context)
+            except URLError as e:
+                raise URLError(e)
+
+        try:
+            verify_download(partial_path, checksum, gzipped=dest_path.suffix == '.gz')
+        except ValueError:
+            partial_path.unlink()
+            raise
+        os.replace(partial_path, dest_path)
 
 def is_file_like(obj):
     """Check if the object is a file-like object.
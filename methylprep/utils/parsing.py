@@ -1,5 +1,6 @@
 # Lib
 import logging
+import mmap
 import numpy as np
 
 
@@ -159,6 +160,9 @@ def npread(file_like, dtype, n):
     file ends prematurely. This replaces read_results() and runs faster.
     And it provides support for reading gzipped idat files without decompressing.
 
+    If file_like is a memory-mapped file (mmap.mmap), no bytes are copied: the
+    returned array is a read-only view onto the mapped file.
+
     Arguments:
         infile {file-like} -- The binary file to read the select number of bytes.
         dtype {data type} -- used within idat files
@@ -172,6 +176,13 @@ def npread(file_like, dtype, n):
         [list(any)] -- A list of the parsed values.
     """
     dtype=np.dtype(dtype)
+    if isinstance(file_like, mmap.mmap):
+        offset = file_like.tell()
+        if offset + dtype.itemsize*n > len(file_like):
+            raise EOFError('End of file reached before number of results parsed')
+        r=np.frombuffer(file_like, dtype, n, offset)
+        file_like.seek(dtype.itemsize*n, 1)
+        return r
     # np.readfile is not able to read from gzopene-d file
     a=file_like.read(dtype.itemsize*n)
     if len(a) != dtype.itemsize*n:
@@ -0,0 +1,45 @@
+"""Times preprocess_noob_batch against preprocess_noob on each sample, on a synthetic array.
+Not part of the unit tests: with methylprep installed, run `python tests/benchmarks/noob_batch_benchmark.py`."""
+# Lib
+from pathlib import Path
+import sys
+import tempfile
+import time
+import numpy as np
+# App
+from methylprep.processing import SampleDataContainer, preprocess_noob, preprocess_noob_batch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath('processing')))
+from test_raw_dataset import write_random_manifest
+
+
+def best_time(build, func, repeat=3):
+    """ the fastest of repeat runs of func, each on newly built SampleDataContainers """
+    times = []
+    for _ in range(repeat):
+        data_containers = build()
+        start = time.perf_counter()
+        func(data_containers)
+        times.append(time.perf_counter() - start)
+    return min(times), data_containers
+
+
+def main(num_probes=400000, num_samples=16):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        manifest, make_raw_dataset = write_random_manifest(Path(temp_dir, 'manifest.csv'), num_probes)
+    raw_datasets = [make_raw_dataset(seed, f'R{seed + 1:02}C01') for seed in range(num_samples)]
+    build = lambda: [SampleDataContainer(raw_dataset, manifest) for raw_dataset in raw_datasets]
+
+    single, expected = best_time(build, lambda data_containers: [preprocess_noob(data_container) for data_container in data_containers])
+    batch, actual = best_time(build, preprocess_noob_batch)
+    for sample, batched in zip(expected, actual):
+        assert np.array_equal(sample.methylated.noob, batched.methylated.noob, equal_nan=True)
+        assert np.array_equal(sample.unmethylated.noob, batched.unmethylated.noob, equal_nan=True)
+
+    print(f'{num_samples} samples, {num_probes} probes')
+    print(f'{"preprocess_noob":>22}: {single / num_samples * 1000:7.1f} ms per sample')
+    print(f'{"preprocess_noob_batch":>22}: {batch / num_samples * 1000:7.1f} ms per sample ({single / batch:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
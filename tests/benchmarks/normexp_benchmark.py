@@ -0,0 +1,45 @@
+"""Times normexp_signal against the scipy.stats formula it replaced.
+Not part of the unit tests: with methylprep installed, run `python tests/benchmarks/normexp_benchmark.py`."""
+# Lib
+import time
+import numpy as np
+from scipy.stats import norm
+# App
+from methylprep.processing.preprocess import apply_bg_correction, normexp_signal, BackgroundCorrectionParams
+
+
+def scipy_normexp(mean_values, params):
+    """ the normexp correction as computed with scipy.stats distributions before normexp_signal """
+    mu_sf = mean_values - params.bg_mean - (params.bg_mad ** 2) / params.mean_signal
+    signal = mu_sf + (params.bg_mad ** 2) * \
+        np.exp(norm(mu_sf, params.bg_mad).logpdf(0) - norm(mu_sf, params.bg_mad).logsf(0))
+    return np.maximum(signal, 1e-6) + params.offset
+
+
+def best_time(func, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(size=1000000):
+    params = BackgroundCorrectionParams(bg_mean=400.3, bg_mad=120.7, mean_signal=3000.1)
+    values = np.random.default_rng(0).integers(0, 30000, size).astype('float32')
+    out, work = np.empty(size), np.empty(size)
+    p = params
+    timings = {
+        'scipy.stats': best_time(lambda: scipy_normexp(values.astype('float64'), params)),
+        'normexp_signal': best_time(lambda: apply_bg_correction(values, params)),
+        'normexp_signal, preallocated': best_time(
+            lambda: normexp_signal(values, p.bg_mean, p.bg_mad, p.mean_signal, p.offset, out=out, work=work)),
+        'normexp_signal, float32': best_time(lambda: apply_bg_correction(values, params, dtype=np.float32)),
+    }
+    for name, seconds in timings.items():
+        print(f'{name:>30}: {seconds * 1000:7.1f} ms for {size} values')
+
+
+if __name__ == '__main__':
+    main()
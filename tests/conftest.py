@@ -0,0 +1,76 @@
+# Lib
+import gzip
+import struct
+import numpy as np
+import pytest
+
+
+# section codes, see methylprep.files.idat.IdatSectionCode
+NUM_SNPS_READ = 1000
+ILLUMINA_ID = 102
+STD_DEV = 103
+MEAN = 104
+NUM_BEADS = 107
+BARCODE = 402
+CHIP_TYPE = 403
+
+
+def _pack_string(value):
+    encoded = value.encode('utf-8')
+    if len(encoded) > 127:
+        raise ValueError('synthetic IDAT strings must be shorter than 128 bytes')
+    return struct.pack('<B', len(encoded)) + encoded
+
+
+def build_idat_bytes(illumina_ids, means, std_dev=None, n_beads=None,
+                     barcode='200000000001', chip_type='BeadChip 8x5'):
+    """Builds a minimal version 3 IDAT file in memory, laid out the way Illumina scanners
+    write them: header, offset table, then the data sections in ascending order."""
+    illumina_ids = np.asarray(illumina_ids, dtype='<i4')
+    means = np.asarray(means, dtype='<u2')
+    n_snps = len(illumina_ids)
+    if std_dev is None:
+        std_dev = np.full(n_snps, 10, dtype='<u2')
+    if n_beads is None:
+        n_beads = np.full(n_snps, 12, dtype='<u1')
+
+    sections = [
+        (NUM_SNPS_READ, struct.pack('<i', n_snps)),
+        (ILLUMINA_ID, illumina_ids.tobytes()),
+        (STD_DEV, np.asarray(std_dev, dtype='<u2').tobytes()),
+        (MEAN, means.tobytes()),
+        (NUM_BEADS, np.asarray(n_beads, dtype='<u1').tobytes()),
+        (BARCODE, _pack_string(barcode)),
+        (CHIP_TYPE, _pack_string(chip_type)),
+    ]
+    header_size = 16 + len(sections) * 10
+    offsets = []
+    body = b''
+    for code, payload in sections:
+        offsets.append((code, header_size + len(body)))
+        body += payload
+
+    header = b'IDAT' + struct.pack('<q', 3) + struct.pack('<i', len(sections))
+    for code, offset in offsets:
+        header += struct.pack('<Hq', code, offset)
+    return header + body
+
+
+@pytest.fixture
+def make_idat(tmp_path):
+    """Returns a function that writes a synthetic IDAT file and returns its path.
+    Pass compress=True to write a gzipped .idat.gz file instead."""
+
+    def _make_idat(filename, illumina_ids, means, compress=False, **kwargs):
+        content = build_idat_bytes(illumina_ids, means, **kwargs)
+        path = tmp_path.joinpath(filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if compress:
+            path = path.with_name(path.name + '.gz')
+            with gzip.open(path, 'wb') as gz_file:
+                gz_file.write(content)
+        else:
+            path.write_bytes(content)
+        return path
+
+    return _make_idat
@@ -0,0 +1,39 @@
+# Lib
+import tarfile
+import pytest
+# App
+from methylprep.files import IdatDataset, TarIdatReader
+from methylprep.models import Channel
+
+
+def write_tar(path, files, mode='w'):
+    with tarfile.open(path, mode) as archive:
+        for file_path in files:
+            archive.add(file_path, arcname=file_path.name)
+    return path
+
+
+class TestTarIdatReader():
+    def test_reads_gzipped_members_in_memory(self, make_idat, tmp_path):
+        green = make_idat('members/GSM1_200000000001_R01C01_Grn.idat', [1, 2, 3], [10, 20, 30], compress=True)
+        red = make_idat('members/GSM1_200000000001_R01C01_Red.idat', [1, 2, 3], [40, 50, 60], compress=True)
+        reader = TarIdatReader(write_tar(tmp_path.joinpath('GSE1_RAW.tar'), [green, red]))
+        assert sorted(reader.file_names) == [green.name, red.name]
+
+        idat = IdatDataset(reader.get_file(red.name), channel=Channel.RED)
+        assert idat.means.tolist() == [40, 50, 60]
+        idat = IdatDataset(reader.get_file('R01C01_Grn', match_partial=True), channel=Channel.GREEN)
+        assert idat.means.tolist() == [10, 20, 30]
+
+    def test_missing_member_raises(self, make_idat, tmp_path):
+        green = make_idat('members/sample_Grn.idat', [1], [10])
+        reader = TarIdatReader(write_tar(tmp_path.joinpath('raw.tar'), [green]))
+        assert reader.get_file(green.name).read() == green.read_bytes()
+        with pytest.raises(FileNotFoundError):
+            reader.get_file('other_Grn.idat')
+
+    def test_compressed_archives_are_rejected(self, make_idat, tmp_path):
+        green = make_idat('members/sample_Grn.idat', [1], [10])
+        path = write_tar(tmp_path.joinpath('raw.tar.gz'), [green], mode='w:gz')
+        with pytest.raises(ValueError):
+            TarIdatReader(path)
@@ -1,9 +1,11 @@
 # Lib
+import gzip
 from pathlib import Path
+import numpy as np
 import pytest
 
 # App
-from methylprep.files import IdatDataset
+from methylprep.files import IdatDataset, IdatStack
 from methylprep.models import Channel
 
 
@@ -22,3 +24,207 @@ class TestIdatModel(object):
         with pytest.raises(UnicodeDecodeError):
             with open(self.test_idat_file,'r') as f:
                 idat = IdatDataset(f, Channel.GREEN)
+
+
+class TestIdatMemmap():
+    illumina_ids = [10, 11, 12, 13]
+    means = [100, 40000, 65535, 0]
+
+    def test_memmap_matches_default_read(self, make_idat):
+        path = make_idat('sample_Grn.idat', self.illumina_ids, self.means)
+        idat = IdatDataset(path, channel=Channel.GREEN)
+        mapped = IdatDataset(path, channel=Channel.GREEN, memmap=True)
+        assert mapped.n_snps_read == 4
+        assert mapped.barcode == idat.barcode
+        assert list(mapped.illumina_ids) == self.illumina_ids
+        assert list(mapped.means) == self.means
+        assert mapped.probe_means.equals(idat.probe_means)
+        assert mapped.probe_means.index.name == 'illumina_id'
+        # raw intensities keep their native type, so values above 32767 survive
+        assert mapped.probe_means['mean_value'].dtype == 'uint16'
+        assert mapped.probe_means['mean_value'].tolist() == self.means
+
+    def test_memmap_arrays_are_read_only_views(self, make_idat):
+        path = make_idat('sample_Grn.idat', self.illumina_ids, self.means)
+        mapped = IdatDataset(path, channel=Channel.GREEN, memmap=True)
+        assert mapped.means.dtype == 'uint16'
+        assert mapped.illumina_ids.dtype == 'int32'
+        assert mapped.std_dev is not None
+        for array in (mapped.illumina_ids, mapped.means, mapped.std_dev, mapped.n_beads):
+            assert not array.flags.writeable
+
+    def test_memmap_falls_back_for_gzip(self, make_idat):
+        path = make_idat('sample_Grn.idat', self.illumina_ids, self.means, compress=True)
+        idat = IdatDataset(path, channel=Channel.GREEN, memmap=True)
+        assert list(idat.means) == self.means
+
+    def test_memmap_truncated_file_raises(self, make_idat):
+        path = make_idat('sample_Grn.idat', self.illumina_ids, self.means)
+        path.write_bytes(path.read_bytes()[:-40])
+        with pytest.raises(EOFError):
+            IdatDataset(path, channel=Channel.GREEN, memmap=True)
+
+
+class SeekRecordingFile():
+    """wraps a file object and records every (from, to) seek, to check how often a
+    gzip stream would have to restart decompression."""
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.seeks = []
+
+    def __iter__(self):
+        return iter(self.file_obj)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file_obj.close()
+
+    def read(self, *args):
+        return self.file_obj.read(*args)
+
+    def tell(self):
+        return self.file_obj.tell()
+
+    def seek(self, offset, whence=0):
+        self.seeks.append((self.file_obj.tell(), offset))
+        return self.file_obj.seek(offset, whence)
+
+
+class TestIdatForwardPass():
+    def test_gzip_sections_read_without_rewinding(self, make_idat):
+        means = list(range(100, 600))
+        path = make_idat('sample_Red.idat', list(range(1000, 1500)), means, compress=True)
+        gz_file = SeekRecordingFile(gzip.open(path, 'rb'))
+        idat = IdatDataset(gz_file, channel=Channel.RED)
+        assert list(idat.means) == means
+        assert idat.barcode == '200000000001'
+        assert idat.chip_type == 'BeadChip 8x5'
+        # the only backward seeks allowed are the header checks resetting to the start.
+        header_size = 100
+        backward = [(start, end) for start, end in gz_file.seeks if end < start]
+        assert all(start < header_size for start, _end in backward)
+
+
+class TestIdatScanHeader():
+    def test_scan_header_reads_counts_and_strings(self, make_idat):
+        path = make_idat('sample_Grn.idat', [1, 2, 3], [10, 20, 30], barcode='123456789012')
+        header = IdatDataset.scan_header(path, channel=Channel.GREEN)
+        assert header.n_snps_read == 3
+        assert header.barcode == '123456789012'
+        assert header.chip_type == 'BeadChip 8x5'
+        assert header.channel is Channel.GREEN
+
+    def test_scan_header_skips_strings_for_gzip(self, make_idat):
+        path = make_idat('sample_Grn.idat', [1, 2, 3], [10, 20, 30], compress=True)
+        header = IdatDataset.scan_header(path)
+        assert header.n_snps_read == 3
+        assert header.barcode is None
+        assert IdatDataset.scan_header(path, read_strings=True).barcode == '200000000001'
+
+    def test_scan_header_catches_truncated_file(self, make_idat):
+        path = make_idat('sample_Grn.idat', list(range(100)), list(range(100)))
+        path.write_bytes(path.read_bytes()[:300])
+        with pytest.raises(EOFError):
+            IdatDataset.scan_header(path)
+
+    def test_scan_header_rejects_non_idat(self, tmp_path):
+        path = tmp_path.joinpath('not_an.idat')
+        path.write_bytes(b'NOPE' + bytes(100))
+        with pytest.raises(ValueError):
+            IdatDataset.scan_header(path)
+
+
+class TestIdatStack():
+    def make_pairs(self, make_idat, layouts):
+        green, red = [], []
+        for idx, (ids, green_means, red_means) in enumerate(layouts):
+            green.append(make_idat(f'sample{idx}_Grn.idat', ids, green_means))
+            red.append(make_idat(f'sample{idx}_Red.idat', ids, red_means))
+        return green, red
+
+    def test_stack_sorts_addresses_and_keeps_rows_aligned(self, make_idat):
+        ids = [30, 10, 20]
+        green, red = self.make_pairs(make_idat, [
+            (ids, [3, 1, 2], [300, 100, 200]),
+            (ids, [6, 4, 5], [600, 400, 500]),
+        ])
+        stack = IdatStack(green, red, sample_names=['a', 'b'])
+        assert len(stack) == 2
+        assert stack.addresses.tolist() == [10, 20, 30]
+        assert stack.green.dtype == np.uint16 and stack.green.flags['C_CONTIGUOUS']
+        assert stack.green.tolist() == [[1, 2, 3], [4, 5, 6]]
+        assert stack.red.tolist() == [[100, 200, 300], [400, 500, 600]]
+        assert stack.get_sample_means('b', Channel.RED).tolist() == [400, 500, 600]
+        assert np.shares_memory(stack.get_sample_means(1, Channel.GREEN), stack.green)
+        assert stack.get_positions([20, 99, 30]).tolist() == [1, -1, 2]
+        frame = stack.to_data_frame(Channel.GREEN)
+        assert frame.loc['a', 30] == 3
+
+    def test_stack_matches_single_idat_reader(self, make_idat):
+        ids = [5, 1, 3, 2]
+        green, red = self.make_pairs(make_idat, [(ids, [50, 10, 30, 20], [5, 1, 3, 2])])
+        stack = IdatStack(green, red, memmap=False)
+        idat = IdatDataset(green[0], channel=Channel.GREEN)
+        expected = idat.probe_means.sort_index()['mean_value']
+        assert stack.addresses.tolist() == expected.index.tolist()
+        assert stack.green[0].tolist() == expected.tolist()
+
+    def test_stack_from_idat_datasets_with_bead_mask(self, make_idat):
+        ids = [30, 10, 20]
+        green = make_idat('sample_Grn.idat', ids, [3, 1, 2], n_beads=[9, 1, 9])
+        red = make_idat('sample_Red.idat', ids, [300, 100, 200], n_beads=[1, 9, 9])
+        green_idat = IdatDataset(green, channel=Channel.GREEN, min_beads=3)
+        red_idat = IdatDataset(red, channel=Channel.RED)
+        stack = IdatStack([green_idat, green_idat], [red_idat, red_idat])
+        assert stack.file_positions.tolist() == [1, 2, 0]
+        positions = stack.get_positions([30, 10])
+        # the columns match each IDAT's probe_means, masked probes included
+        expected = green_idat.probe_means['mean_value'].loc[[30, 10]].tolist()
+        np.testing.assert_array_equal(stack.take(Channel.GREEN, positions), [expected, expected])
+        assert stack.take(Channel.RED, positions, dtype=np.float32).tolist() == [[300, 100], [300, 100]]
+        assert stack.green.dtype == np.uint16
+
+    def test_stack_rejects_mismatched_layout(self, make_idat):
+        green, red = self.make_pairs(make_idat, [
+            ([1, 2, 3], [1, 2, 3], [1, 2, 3]),
+            ([1, 2, 4], [1, 2, 3], [1, 2, 3]),
+        ])
+        with pytest.raises(ValueError):
+            IdatStack(green, red)
+
+
+class TestIdatBeadStats():
+    illumina_ids = [10, 11, 12, 13]
+    means = [100, 200, 300, 400]
+    n_beads = [12, 2, 8, 3]
+    std_dev = [5, 6, 7, 8]
+
+    @pytest.mark.parametrize('compress, memmap', [(False, False), (True, False), (False, True)])
+    def test_sections_are_read_on_first_access(self, make_idat, compress, memmap):
+        path = make_idat('sample_Grn.idat', self.illumina_ids, self.means, compress=compress,
+            n_beads=self.n_beads, std_dev=self.std_dev)
+        idat = IdatDataset(path, channel=Channel.GREEN, memmap=memmap)
+        assert idat._IdatDataset__n_beads is None
+        assert idat.n_beads.tolist() == self.n_beads
+        assert idat.std_dev.tolist() == self.std_dev
+
+    def test_file_objects_need_read_bead_stats(self, make_idat):
+        path = make_idat('sample_Grn.idat', self.illumina_ids, self.means, n_beads=self.n_beads)
+        with open(path, 'rb') as idat_file:
+            idat = IdatDataset(idat_file, channel=Channel.GREEN)
+        with pytest.raises(ValueError):
+            idat.n_beads
+        with open(path, 'rb') as idat_file:
+            idat = IdatDataset(idat_file, channel=Channel.GREEN, read_bead_stats=True)
+        assert idat.n_beads.tolist() == self.n_beads
+
+    def test_min_beads_masks_probe_means(self, make_idat):
+        path = make_idat('sample_Grn.idat', self.illumina_ids, self.means, n_beads=self.n_beads)
+        with open(path, 'rb') as idat_file:
+            idat = IdatDataset(idat_file, channel=Channel.GREEN, min_beads=5)
+        probe_means = idat.probe_means['mean_value']
+        assert probe_means.dtype == 'float32'
+        assert probe_means.isna().tolist() == [False, True, False, True]
+        assert probe_means.loc[12] == 300
@@ -0,0 +1,69 @@
+# Lib
+from concurrent.futures import ThreadPoolExecutor
+import os
+from unittest import mock
+import numpy as np
+# App
+from methylprep.files import IdatCache, IdatDataset
+from methylprep.models import Channel
+
+
+class TestIdatCache():
+    illumina_ids = [30, 10, 20]
+    means = [300, 40000, 200]
+
+    def test_second_read_is_a_memory_mapped_hit(self, make_idat, tmp_path):
+        path = make_idat('sample_Grn.idat', self.illumina_ids, self.means, n_beads=[1, 9, 9])
+        cache = IdatCache(tmp_path.joinpath('cache'))
+        first = cache.get_idat(path, Channel.GREEN)
+        second = cache.get_idat(path, Channel.GREEN, min_beads=3)
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert isinstance(second.means, np.memmap)
+        assert second.means.tolist() == self.means
+        assert second.barcode == first.barcode
+        assert second.probe_means.equals(IdatDataset(path, channel=Channel.GREEN, min_beads=3).probe_means)
+        # bead stats are still read from the original file
+        assert second.n_beads.tolist() == [1, 9, 9]
+
+    def test_changed_file_is_decoded_again(self, make_idat, tmp_path):
+        path = make_idat('sample_Grn.idat', self.illumina_ids, self.means)
+        cache = IdatCache(tmp_path.joinpath('cache'))
+        cache.get_idat(path, Channel.GREEN)
+        make_idat('sample_Grn.idat', self.illumina_ids, [1, 2, 3])
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        assert cache.get_idat(path, Channel.GREEN).means.tolist() == [1, 2, 3]
+        assert cache.misses == 2
+
+    def test_least_recently_used_entries_are_evicted(self, make_idat, tmp_path):
+        paths = [make_idat(f'sample{idx}_Grn.idat', self.illumina_ids, self.means) for idx in range(3)]
+        cache = IdatCache(tmp_path.joinpath('cache'))
+        cache.get_idat(paths[0], Channel.GREEN)
+        entry_size = cache.get_size()
+        cache.max_size = 2 * entry_size
+        os.utime(cache.cache_dir.joinpath(f'{cache.get_key(paths[0])}.json'), (1, 1))
+        cache.get_idat(paths[1], Channel.GREEN)
+        cache.get_idat(paths[2], Channel.GREEN)
+        assert cache.get_size() <= 2 * entry_size
+        assert not cache.cache_dir.joinpath(f'{cache.get_key(paths[0])}.json').exists()
+        assert cache.cache_dir.joinpath(f'{cache.get_key(paths[2])}.json').exists()
+
+    def test_evicts_only_past_max_size(self, make_idat, tmp_path):
+        paths = [make_idat(f'sample{idx}_Grn.idat', self.illumina_ids, self.means) for idx in range(4)]
+        cache = IdatCache(tmp_path.joinpath('cache'))
+        with mock.patch.object(IdatCache, 'evict', autospec=True, side_effect=IdatCache.evict) as evict:
+            cache.get_idat(paths[0], Channel.GREEN)
+            cache.max_size = 2 * cache.get_size()
+            cache.get_idat(paths[1], Channel.GREEN)
+            assert evict.call_count == 0
+            cache.get_idat(paths[2], Channel.GREEN)
+            cache.get_idat(paths[3], Channel.GREEN)
+            assert evict.call_count == 2
+        assert cache.get_size() <= cache.max_size
+
+    def test_counters_with_threads(self, make_idat, tmp_path):
+        paths = [make_idat(f'sample{idx}_Grn.idat', self.illumina_ids, self.means) for idx in range(4)]
+        cache = IdatCache(tmp_path.joinpath('cache'))
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(lambda path: cache.get_idat(path, Channel.GREEN), paths * 25))
+        assert cache.hits + cache.misses == 100
@@ -1,6 +1,13 @@
+# Lib
+from contextlib import contextmanager
+from io import BytesIO
+from unittest import mock
+import numpy as np
+import pandas as pd
+import pytest
 # App
 from methylprep.files import manifests
-from methylprep.models import ArrayType
+from methylprep.models import ArrayType, ProbeType
 from pathlib import Path
 
 
@@ -28,5 +35,321 @@ class TestManifestConstants():
             }
         for array_type, filepath in files.items():
             man = manifests.Manifest(array_type, filepath)
-            if ArrayType(array_type).num_controls != man._Manifest__control_data_frame.shape[0]:
-                raise AssertionError(f'Control probes found ({man._Manifest__control_data_frame.shape[0]}) in file ({filepath}) does not match expected number: {ArrayType(array_type).num_controls}')
+            if ArrayType(array_type).num_controls != man.control_data_frame.shape[0]:
+                raise AssertionError(f'Control probes found ({man.control_data_frame.shape[0]}) in file ({filepath}) does not match expected number: {ArrayType(array_type).num_controls}')
+
+
+MANIFEST_LINES = [
+    'Illumina, Inc.,,,,,,,,,',
+    '[Heading],,,,,,,,,,',
+    '[Assay],,,,,,,,,,',
+    'IlmnID,Name,AddressA_ID,AddressB_ID,Infinium_Design_Type,Color_Channel,Genome_Build,CHR,MAPINFO,Strand,Probe_Type',
+    'cg001,cg001,10,,II,,37,1,100,F,cg',
+    'cg002,cg002,11,12,I,Grn,37,1,200,R,mu',
+    'uk003,uk003,13,14,I,Red,37,2,50,F,cg',
+    'rs01,rs01,15,,II,,37,3,70,F,rs',
+    'rp02,rp02,16,17,I,Red,37,3,90,R,rp',
+    'ch01,ch01,18,,II,,37,X,10,F,ch',
+    '[Controls],,,,,,,,,,',
+    '100,STAINING,Red,DNP (High),,,,,,,',
+    '101,NORM_A,Red,NORM_A_1,,,,,,,',
+    '102,NEGATIVE,Red,Negative 1,,,,,,,',
+]
+
+
+def write_synthetic_manifest(tmp_path, line_end='\n'):
+    path = tmp_path.joinpath('manifest.csv')
+    path.write_bytes((line_end.join(MANIFEST_LINES) + line_end).encode())
+    return path
+
+
+@contextmanager
+def synthetic_array_sizes():
+    with mock.patch.object(ArrayType, 'num_probes', new_callable=mock.PropertyMock, return_value=7), \
+        mock.patch.object(ArrayType, 'num_controls', new_callable=mock.PropertyMock, return_value=3):
+        yield
+
+
+def read_synthetic_manifest(path, array_type, **kwargs):
+    with synthetic_array_sizes():
+        return manifests.Manifest(array_type, path, **kwargs)
+
+
+class TestManifestSections():
+    @pytest.mark.parametrize('line_end', ['\n', '\r\n'])
+    def test_sections_match_separate_csv_reads(self, tmp_path, line_end):
+        path = write_synthetic_manifest(tmp_path, line_end)
+        manifest = read_synthetic_manifest(path, ArrayType.ILLUMINA_MOUSE)
+        assert manifest.data_frame.index.tolist() == ['cg001', 'cg002', 'uk003', 'rs01', 'rp02', 'ch01']
+        assert manifest.data_frame['AddressB_ID'].dtype == 'Int64'
+        assert manifest.data_frame.loc['rs01', 'probe_type'] == 'SnpII'
+
+        # the sections parsed from the single read match what separate read_csv calls
+        # over the whole file (as the manifest was parsed before) return.
+        with open(path, 'rb') as manifest_file:
+            manifests.Manifest.seek_to_start(manifest_file)
+            data = manifest_file.read()
+        controls = pd.read_csv(BytesIO(data), comment='[', header=None, index_col=0, names=manifests.CONTROL_COLUMNS,
+            nrows=3, skiprows=7, usecols=range(len(manifests.CONTROL_COLUMNS)))
+        assert manifest.control_data_frame.equals(controls)
+        whole_file = pd.read_csv(BytesIO(data), low_memory=False)
+        snps = whole_file[whole_file['IlmnID'].str.startswith('rs', na=False)]
+        assert manifest.snp_data_frame['IlmnID'].tolist() == snps['IlmnID'].tolist() == ['rs01']
+        assert manifest.snp_data_frame.index.tolist() == snps.index.tolist()
+        mouse = whole_file[whole_file['Probe_Type'].isin(['rp', 'mu']) | whole_file['IlmnID'].str.startswith('uk', na=False)]
+        assert manifest.mouse_data_frame['IlmnID'].tolist() == mouse['IlmnID'].tolist() == ['cg002', 'uk003', 'rp02']
+        assert manifest.mouse_data_frame.index.tolist() == mouse.index.tolist()
+
+    def test_mouse_section_only_for_mouse_arrays(self, tmp_path):
+        manifest = read_synthetic_manifest(write_synthetic_manifest(tmp_path), ArrayType.ILLUMINA_450K)
+        assert manifest.mouse_data_frame.empty
+        assert 'Probe_Type' not in manifest.data_frame.columns
+
+
+class TestLazySections():
+    def read_eagerly(self, path, array_type):
+        """ file objects cannot be read twice, so every section is parsed up front """
+        with open(path, 'rb') as manifest_file:
+            manifest = read_synthetic_manifest(manifest_file, array_type)
+        assert manifest_file.closed
+        return manifest
+
+    def test_sections_parsed_on_first_use(self, tmp_path):
+        path = write_synthetic_manifest(tmp_path)
+        expected = self.read_eagerly(path, ArrayType.ILLUMINA_MOUSE)
+        with synthetic_array_sizes(), \
+            mock.patch.object(manifests.Manifest, 'read_manifest_data', autospec=True, side_effect=manifests.Manifest.read_manifest_data) as read_data, \
+            mock.patch.object(manifests.Manifest, 'read_control_probes', autospec=True, side_effect=manifests.Manifest.read_control_probes) as read_controls:
+            manifest = manifests.Manifest(ArrayType.ILLUMINA_MOUSE, path, use_cache=False)
+            assert read_data.call_count == 1
+            assert read_controls.call_count == 0
+            pd.testing.assert_frame_equal(manifest.data_frame, expected.data_frame)
+
+            pd.testing.assert_frame_equal(manifest.control_data_frame, expected.control_data_frame)
+            # the second read parsed the other sections too
+            pd.testing.assert_frame_equal(manifest.snp_data_frame, expected.snp_data_frame)
+            pd.testing.assert_frame_equal(manifest.mouse_data_frame, expected.mouse_data_frame)
+            assert manifest.control_data_frame is manifest.control_data_frame
+            assert read_data.call_count == 2
+            assert read_controls.call_count == 1
+
+    def test_sections_loaded_from_cache_on_first_use(self, tmp_path):
+        path = write_synthetic_manifest(tmp_path)
+        expected = self.read_eagerly(path, ArrayType.ILLUMINA_450K)
+        read_synthetic_manifest(path, ArrayType.ILLUMINA_450K) # writes the cache
+        with synthetic_array_sizes(), \
+            mock.patch.object(manifests.Manifest, 'read_manifest_data', side_effect=AssertionError('manifest was parsed')), \
+            mock.patch.object(manifests.ManifestCache, 'read_frame', autospec=True, side_effect=manifests.ManifestCache.read_frame) as read_frame:
+            manifest = manifests.Manifest(ArrayType.ILLUMINA_450K, path)
+            assert [call.args[1] for call in read_frame.call_args_list] == ['probes']
+            pd.testing.assert_frame_equal(manifest.control_data_frame, expected.control_data_frame)
+            assert manifest.mouse_data_frame.empty
+            assert [call.args[1] for call in read_frame.call_args_list] == ['probes', 'controls']
+
+    def test_unknown_section(self, tmp_path):
+        manifest = read_synthetic_manifest(write_synthetic_manifest(tmp_path), ArrayType.ILLUMINA_450K)
+        with pytest.raises(ValueError):
+            manifest.get_section('probes')
+
+
+class TestManifestCache():
+    def assert_same_manifest(self, left, right):
+        pd.testing.assert_frame_equal(left.data_frame, right.data_frame)
+        pd.testing.assert_frame_equal(left.control_data_frame, right.control_data_frame)
+        pd.testing.assert_frame_equal(left.snp_data_frame, right.snp_data_frame)
+        pd.testing.assert_frame_equal(left.mouse_data_frame, right.mouse_data_frame)
+
+    @pytest.mark.parametrize('array_type', [ArrayType.ILLUMINA_MOUSE, ArrayType.ILLUMINA_450K])
+    def test_cached_manifest_matches_parsed(self, tmp_path, array_type):
+        path = write_synthetic_manifest(tmp_path)
+        parsed = read_synthetic_manifest(path, array_type)
+        assert tmp_path.joinpath('manifest.csv.parsed', 'meta.json').exists()
+
+        # the sections are loaded lazily, so they are compared while the array sizes are the same.
+        with synthetic_array_sizes(), \
+            mock.patch.object(manifests.Manifest, 'read_manifest_data', side_effect=AssertionError('manifest was parsed')):
+            cached = manifests.Manifest(array_type, path)
+            self.assert_same_manifest(parsed, cached)
+
+    def test_changed_manifest_is_parsed_again(self, tmp_path):
+        path = write_synthetic_manifest(tmp_path)
+        read_synthetic_manifest(path, ArrayType.ILLUMINA_450K)
+        path.write_bytes(path.read_bytes().replace(b'cg001,cg001,10,,II,,37,1,100', b'cg001,cg001,10,,II,,37,1,101'))
+        manifest = read_synthetic_manifest(path, ArrayType.ILLUMINA_450K)
+        assert manifest.data_frame.loc['cg001', 'MAPINFO'] == '101'
+        # and the rebuilt cache has the new value
+        manifest = read_synthetic_manifest(path, ArrayType.ILLUMINA_450K)
+        assert manifest.data_frame.loc['cg001', 'MAPINFO'] == '101'
+
+    def test_other_array_type_is_parsed_again(self, tmp_path):
+        path = write_synthetic_manifest(tmp_path)
+        read_synthetic_manifest(path, ArrayType.ILLUMINA_450K)
+        manifest = read_synthetic_manifest(path, ArrayType.ILLUMINA_MOUSE)
+        assert 'Probe_Type' in manifest.data_frame.columns
+        assert not manifest.mouse_data_frame.empty
+
+    def test_file_objects_and_use_cache_false_are_not_cached(self, tmp_path):
+        path = write_synthetic_manifest(tmp_path)
+        with open(path, 'rb') as manifest_file:
+            read_synthetic_manifest(manifest_file, ArrayType.ILLUMINA_450K)
+        read_synthetic_manifest(path, ArrayType.ILLUMINA_450K, use_cache=False)
+        assert not tmp_path.joinpath('manifest.csv.parsed').exists()
+
+    def test_unwritable_folder_still_loads(self, tmp_path):
+        path = write_synthetic_manifest(tmp_path)
+        with mock.patch('pathlib.Path.mkdir', side_effect=PermissionError('read-only')):
+            manifest = read_synthetic_manifest(path, ArrayType.ILLUMINA_450K)
+        assert len(manifest.data_frame) == 6
+        assert list(tmp_path.iterdir()) == [path]
+
+
+class TestManifestRegistry():
+    def get_manifest(self, registry, path, array_type=ArrayType.ILLUMINA_450K):
+        with mock.patch.object(ArrayType, 'num_probes', new_callable=mock.PropertyMock, return_value=7), \
+            mock.patch.object(ArrayType, 'num_controls', new_callable=mock.PropertyMock, return_value=3):
+            return registry.get(array_type, path)
+
+    def test_returns_shared_manifest(self, tmp_path):
+        registry = manifests.ManifestRegistry()
+        path = write_synthetic_manifest(tmp_path)
+        manifest = self.get_manifest(registry, path)
+        assert self.get_manifest(registry, str(path)) is manifest
+        assert self.get_manifest(registry, path, ArrayType.ILLUMINA_MOUSE) is not manifest
+        assert len(registry) == 2
+
+    def test_changed_manifest_is_loaded_again(self, tmp_path):
+        registry = manifests.ManifestRegistry()
+        path = write_synthetic_manifest(tmp_path)
+        manifest = self.get_manifest(registry, path)
+        path.write_bytes(path.read_bytes().replace(b',37,1,100,', b',37,1,101,'))
+        reloaded = self.get_manifest(registry, path)
+        assert reloaded is not manifest
+        assert reloaded.data_frame.loc['cg001', 'MAPINFO'] == '101'
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        registry = manifests.ManifestRegistry(max_size=2)
+        paths = []
+        for name in ('a', 'b', 'c'):
+            tmp_path.joinpath(name).mkdir()
+            paths.append(write_synthetic_manifest(tmp_path.joinpath(name)))
+        first = self.get_manifest(registry, paths[0])
+        second = self.get_manifest(registry, paths[1])
+        assert self.get_manifest(registry, paths[0]) is first # now most recently used
+        self.get_manifest(registry, paths[2])
+        assert len(registry) == 2
+        assert self.get_manifest(registry, paths[0]) is first
+        assert self.get_manifest(registry, paths[1]) is not second
+
+    def test_file_objects_are_not_registered(self, tmp_path):
+        registry = manifests.ManifestRegistry()
+        with open(write_synthetic_manifest(tmp_path), 'rb') as manifest_file:
+            self.get_manifest(registry, manifest_file)
+        assert len(registry) == 0
+
+    def test_compact_manifest_is_registered_separately(self, tmp_path):
+        registry = manifests.ManifestRegistry()
+        path = write_synthetic_manifest(tmp_path)
+        manifest = self.get_manifest(registry, path)
+        with mock.patch.object(ArrayType, 'num_probes', new_callable=mock.PropertyMock, return_value=7), \
+            mock.patch.object(ArrayType, 'num_controls', new_callable=mock.PropertyMock, return_value=3):
+            compact = registry.get(ArrayType.ILLUMINA_450K, path, compact=True)
+        assert compact is not manifest
+        assert compact.compact and not manifest.compact
+
+
+class TestCompactManifest():
+    def test_column_types(self, tmp_path):
+        manifest = read_synthetic_manifest(write_synthetic_manifest(tmp_path), ArrayType.ILLUMINA_MOUSE, compact=True)
+        data_frame = manifest.data_frame
+        for column in ('Infinium_Design_Type', 'Color_Channel', 'CHR', 'Strand', 'Probe_Type'):
+            assert isinstance(data_frame[column].dtype, pd.CategoricalDtype)
+        for column in ('AddressA_ID', 'AddressB_ID', 'MAPINFO'):
+            assert data_frame[column].dtype == np.int32
+        assert data_frame['probe_type'].cat.codes.dtype == np.int8
+        assert data_frame.loc['cg001', 'AddressB_ID'] == manifests.MISSING_VALUE
+        assert data_frame.loc['cg001', 'MAPINFO'] == 100
+
+    def test_same_values_as_default_manifest(self, tmp_path):
+        path = write_synthetic_manifest(tmp_path)
+        manifest = read_synthetic_manifest(path, ArrayType.ILLUMINA_MOUSE, use_cache=False)
+        compact = read_synthetic_manifest(path, ArrayType.ILLUMINA_MOUSE, use_cache=False, compact=True)
+        expected = manifest.data_frame
+        actual = compact.data_frame
+        assert actual['probe_type'].astype(str).tolist() == expected['probe_type'].tolist()
+        assert actual['CHR'].astype(str).tolist() == expected['CHR'].astype(str).tolist()
+        expected_b = pd.to_numeric(expected['AddressB_ID']).fillna(manifests.MISSING_VALUE).astype(int)
+        assert actual['AddressB_ID'].tolist() == expected_b.tolist()
+        pd.testing.assert_frame_equal(compact.control_data_frame, manifest.control_data_frame)
+
+    def test_cached_compact_manifest_matches_parsed(self, tmp_path):
+        path = write_synthetic_manifest(tmp_path)
+        parsed = read_synthetic_manifest(path, ArrayType.ILLUMINA_450K, use_cache=False, compact=True)
+        read_synthetic_manifest(path, ArrayType.ILLUMINA_450K) # writes the cache
+        with mock.patch.object(manifests.Manifest, 'read_manifest_data', side_effect=AssertionError('manifest was parsed')):
+            cached = read_synthetic_manifest(path, ArrayType.ILLUMINA_450K, compact=True)
+        pd.testing.assert_frame_equal(parsed.data_frame, cached.data_frame)
+
+    def test_smaller_in_memory(self, tmp_path):
+        lines = MANIFEST_LINES[:4] + [
+            f'cg{idx:06},cg{idx:06},{idx},{idx + 1 if idx % 2 else ""},{"I" if idx % 2 else "II"},{"Red" if idx % 2 else ""},37,{idx % 22 + 1},{idx * 10},F,cg'
+            for idx in range(2000)
+        ] + MANIFEST_LINES[-4:]
+        path = tmp_path.joinpath('manifest.csv')
+        path.write_text('\n'.join(lines) + '\n')
+        with mock.patch.object(ArrayType, 'num_probes', new_callable=mock.PropertyMock, return_value=2001), \
+            mock.patch.object(ArrayType, 'num_controls', new_callable=mock.PropertyMock, return_value=3):
+            manifest = manifests.Manifest(ArrayType.ILLUMINA_450K, path, use_cache=False)
+            compact = manifests.Manifest(ArrayType.ILLUMINA_450K, path, use_cache=False, compact=True)
+        assert len(compact.data_frame) == 2000
+        assert compact.data_frame.memory_usage(deep=True).sum() < manifest.data_frame.memory_usage(deep=True).sum() / 2
+
+
+class TestGenomicIndex():
+    @pytest.fixture(params=[False, True], ids=['default', 'compact'])
+    def manifest(self, request, tmp_path):
+        return read_synthetic_manifest(write_synthetic_manifest(tmp_path), ArrayType.ILLUMINA_MOUSE, compact=request.param)
+
+    def test_index_sorted_by_position(self, manifest):
+        genomic_index = manifest.get_genomic_index()
+        assert sorted(genomic_index) == ['1', '2', '3', 'X']
+        assert genomic_index['3'].positions.tolist() == [70, 90]
+        assert genomic_index['3'].probes.tolist() == ['rs01', 'rp02']
+        assert manifest.get_genomic_index() is genomic_index
+        with pytest.raises(ValueError):
+            genomic_index['1'].positions[0] = 0
+
+    def test_probes_in_region(self, manifest):
+        assert manifest.probes_in_region('1', 100, 200).tolist() == ['cg001', 'cg002']
+        assert manifest.probes_in_region('chr1', 101, 200).tolist() == ['cg002']
+        assert manifest.probes_in_region(3, 1, 80).tolist() == ['rs01']
+        assert manifest.probes_in_region('chrx', 1, 10).tolist() == ['ch01']
+        assert manifest.probes_in_region('1', 300, 400).empty
+        assert manifest.probes_in_region('Y', 1, 1000).empty
+
+    def test_probes_in_regions(self, manifest):
+        # overlapping regions list each probe once
+        regions = [('chr3', 60, 95), ('chr3', 80, 100), ('chr1', 150, 250), ('chrY', 1, 100), ('chr2', 60, 40)]
+        assert manifest.probes_in_regions(regions).tolist() == ['rs01', 'rp02', 'cg002']
+        regions = pd.DataFrame({'chrom': ['1', 'X'], 'start': [1, 1], 'end': [100, 10]})
+        assert manifest.probes_in_regions(regions).tolist() == ['cg001', 'ch01']
+        assert manifest.probes_in_regions([]).empty
+
+    def test_probes_in_bed_file(self, manifest, tmp_path):
+        # BED regions are 0-based and exclude their end
+        bed = tmp_path.joinpath('panel.bed')
+        bed.write_text('track name=panel\nchr1\t99\t100\tfirst\nchr1\t199\t200\nchr2\t50\t60\n')
+        assert manifest.probes_in_regions(bed).tolist() == ['cg001', 'cg002']
+        assert manifest.probes_in_regions(str(bed)).tolist() == ['cg001', 'cg002']
+
+
+class TestManifestProbeTypes():
+    @pytest.mark.parametrize('array_type', list(manifests.ARRAY_TYPE_MANIFEST_FILENAMES))
+    def test_probe_types_match_per_row_classification(self, array_type):
+        """ runs on each manifest that has been downloaded to the manifest folder; skipped otherwise. """
+        filepath = Path(manifests.MANIFEST_DIR_PATH, manifests.ARRAY_TYPE_MANIFEST_FILENAMES[array_type]).expanduser()
+        if not filepath.exists():
+            pytest.skip(f'{filepath.name} has not been downloaded')
+        manifest = manifests.Manifest(array_type, filepath, use_cache=False)
+        get_probe_type = np.vectorize(lambda name, infinium_type: ProbeType.from_manifest_values(name, infinium_type).value)
+        expected = get_probe_type(manifest.data_frame.index.values, manifest.data_frame['Infinium_Design_Type'].values)
+        assert manifest.data_frame['probe_type'].tolist() == expected.tolist()
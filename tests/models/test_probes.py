@@ -1,4 +1,5 @@
 # LIb
+import numpy as np
 import pytest
 # App
 from methylprep.models import Probe, ProbeType
@@ -62,3 +63,13 @@ class TestProbeTypeFromManifestValues():
     def test_type2_is_snp_returns_type2snp(self):
         results = ProbeType.from_manifest_values(self.snp_name, 'II')
         assert results is ProbeType.SNP_TWO
+
+
+class TestProbeTypeFromManifestColumns():
+    def test_matches_from_manifest_values(self):
+        names = ['cg1234', 'ch.1.123', 'rs1234', 'ctl_1', 'neg_2', 'BSC_3', 'NON_4', 'mu567', 'rp890', 'uk12', 'Rs1', '']
+        infinium_types = ['I', 'II', 'IR', 'IG', 'random', '', np.nan]
+        names, infinium_types = zip(*[(name, infinium_type) for name in names for infinium_type in infinium_types])
+        expected = [ProbeType.from_manifest_values(name, infinium_type).value for name, infinium_type in zip(names, infinium_types)]
+        results = ProbeType.from_manifest_columns(np.array(names), np.array(infinium_types, dtype=object))
+        assert results.tolist() == expected
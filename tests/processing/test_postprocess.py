@@ -0,0 +1,160 @@
+# Lib
+from io import BytesIO
+import pickle
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+# App
+from methylprep.models import Channel, Sample
+from methylprep.files import IdatDataset
+from methylprep.processing import RawDataset, SampleDataContainer
+from methylprep.processing.postprocess import calculate_beta_value, calculate_m_value, consolidate_control_snp, one_sample_control_snp
+from methylprep.processing.preprocess import huber, apply_bg_correction, normexp_signal, BackgroundCorrectionParams
+from test_raw_dataset import write_subset_manifest
+
+
+class TestRawIntensityKernels():
+    meth = np.array([65535, 40000, 100, 0], dtype=np.uint16)
+    unmeth = np.array([65535, 30000, 200, 0], dtype=np.uint16)
+
+    def test_beta_value_does_not_overflow_uint16(self):
+        betas = calculate_beta_value(self.meth, self.unmeth)
+        expected = calculate_beta_value(self.meth.astype('float32'), self.unmeth.astype('float32'))
+        np.testing.assert_array_equal(betas, expected)
+        assert 0.49 < betas[0] < 0.5
+
+    def test_m_value_does_not_overflow_uint16(self):
+        m_values = calculate_m_value(self.meth, self.unmeth)
+        expected = calculate_m_value(self.meth.astype('float32'), self.unmeth.astype('float32'))
+        np.testing.assert_array_equal(m_values, expected)
+
+    def test_noob_kernels_match_float32_inputs(self):
+        values = np.array([300, 450, 520, 610, 35000, 800, 1200], dtype=np.uint16)
+        assert huber(values) == huber(values.astype('float32'))
+        params = BackgroundCorrectionParams(bg_mean=400.0, bg_mad=100.0, mean_signal=2000.0)
+        np.testing.assert_array_equal(
+            apply_bg_correction(values, params),
+            apply_bg_correction(values.astype('float32'), params),
+        )
+
+    def test_huber_ignores_masked_probes(self):
+        values = np.array([300, 450, 520, 610, 35000, 800, 1200], dtype='float32')
+        masked = np.append(values, [np.nan, np.nan])
+        assert huber(masked) == huber(values)
+
+
+class TestControlSnpMinBeads():
+    illumina_ids = np.arange(10, 55010, dtype=np.int32) # 55000 probes: a 27k array
+
+    def make_container(self, make_idat, manifest, min_beads):
+        # STAINING control 40 and SNP probe rs01 (address 22) are on too few beads
+        n_beads = np.where(np.isin(self.illumina_ids, [22, 40]), 1, 12)
+        idats = []
+        for channel, offset in ((Channel.GREEN, 1000), (Channel.RED, 2000)):
+            means = (offset + self.illumina_ids) % 60000
+            path = make_idat(f'200000000001_R01C01_{channel.value}.idat', self.illumina_ids, means, n_beads=n_beads)
+            idats.append(IdatDataset(path, channel=channel, min_beads=min_beads))
+        return SampleDataContainer(RawDataset(Sample('.', '200000000001', 'R01C01'), *idats), manifest)
+
+    def test_min_beads_with_save_control(self, make_idat, tmp_path):
+        manifest = write_subset_manifest(tmp_path.joinpath('manifest.csv'))
+        container = self.make_container(make_idat, manifest, min_beads=3)
+        control_df = one_sample_control_snp(container)
+        columns = ['Mean_Value_Green', 'Mean_Value_Red', 'snp_meth', 'snp_unmeth']
+        assert (control_df[columns].dtypes == 'Int32').all()
+        assert control_df.loc[40, 'Mean_Value_Red'] is pd.NA and control_df.loc['rs01', 'snp_meth'] is pd.NA
+        assert control_df.loc[41, 'Mean_Value_Red'] == 2041
+
+        consolidated = BytesIO()
+        consolidate_control_snp([container], consolidated)
+        saved = pickle.loads(consolidated.getvalue())['200000000001_R01C01']
+        pd.testing.assert_frame_equal(saved[columns], control_df[columns])
+
+        # without min_beads, the probes on one bead keep their values
+        control_df = one_sample_control_snp(self.make_container(make_idat, manifest, min_beads=None))
+        assert control_df.loc[40, 'Mean_Value_Red'] == 2040 and control_df.loc['rs01', 'snp_meth'] == 1022
+
+
+class TestHuber():
+    # MASS::huber(chem) gives mu 3.206724, s 0.526323
+    chem = [2.90, 3.10, 3.40, 3.40, 3.70, 3.70, 2.80, 2.50, 2.40, 2.40, 2.70, 2.20,
+            5.28, 3.37, 3.03, 3.03, 28.95, 3.77, 3.40, 2.20, 3.50, 3.60, 3.70, 3.70]
+
+    def test_matches_mass_huber(self):
+        mu, s = huber(self.chem)
+        assert abs(mu - 3.206724) < 1e-6
+        assert abs(s - 0.526323) < 1e-6
+
+    def test_matrix_rows_match_vectors(self):
+        rng = np.random.default_rng(0)
+        matrix = rng.gamma(2, 400, (3, 5000)).astype('float32')
+        matrix[1, ::7] = np.nan # masked probes
+        matrix[2, 4000:] = np.nan # a sample with fewer probes, padded
+        mu, s = huber(matrix)
+        for idx, row in enumerate(matrix):
+            assert (mu[idx], s[idx]) == huber(row)
+            np.testing.assert_allclose((mu[idx], s[idx]), huber(row[~np.isnan(row)]), rtol=1e-12)
+
+    def test_constant_rows(self):
+        mu, s = huber(np.array([[0, 0, 0], [5, 5, 5], [1, 2, 4]], dtype='float32'))
+        assert mu[:2].tolist() == [0, 5]
+        assert s[:2].tolist() == [0, 0]
+        assert (mu[2], s[2]) == huber([1, 2, 4])
+
+
+def scipy_normexp(mean_values, params):
+    """ the normexp correction as computed with scipy.stats distributions before normexp_signal """
+    mu_sf = mean_values - params.bg_mean - (params.bg_mad ** 2) / params.mean_signal
+    signal = mu_sf + (params.bg_mad ** 2) * \
+        np.exp(norm(mu_sf, params.bg_mad).logpdf(0) - norm(mu_sf, params.bg_mad).logsf(0))
+    return np.maximum(signal, 1e-6) + params.offset
+
+
+class TestNormexpKernel():
+    params = BackgroundCorrectionParams(bg_mean=400.3, bg_mad=120.7, mean_signal=3000.1)
+    # includes intensities far below the background, where the signal is at the 1e-6 floor
+    values = np.concatenate([np.zeros(3), np.random.default_rng(0).integers(0, 30000, 100000)]).astype('float32')
+
+    def test_matches_scipy_distributions(self):
+        expected = scipy_normexp(self.values.astype('float64'), self.params)
+        np.testing.assert_allclose(apply_bg_correction(self.values, self.params), expected, rtol=1e-12)
+        # far in the lower tail, where the scipy.stats formula still holds
+        low = np.array([-5000, -1000, 0, 100], dtype='float64')
+        np.testing.assert_allclose(apply_bg_correction(low, self.params), scipy_normexp(low, self.params), rtol=1e-10)
+
+    def test_float32_error(self):
+        expected = apply_bg_correction(self.values, self.params)
+        actual = apply_bg_correction(self.values, self.params, dtype=np.float32)
+        assert actual.dtype == np.float32
+        np.testing.assert_allclose(actual, expected, rtol=2e-6)
+        # background as bright as the foreground: every value is deep in the lower tail
+        params = BackgroundCorrectionParams(bg_mean=4293.2, bg_mad=3011.2, mean_signal=10)
+        np.testing.assert_allclose(
+            apply_bg_correction(self.values, params, dtype=np.float32), apply_bg_correction(self.values, params), rtol=2e-6)
+
+    def test_change_from_float32_parameters(self):
+        # before normexp_signal, mu_sf was computed in the precision of the (float32) intensities;
+        # the signal moves less than mu_sf, so results differ by at most its float32 rounding error.
+        for params in (self.params, BackgroundCorrectionParams(bg_mean=4293.2, bg_mad=3011.2, mean_signal=10)):
+            bg_mean, sigma_squared_over_alpha = np.float32(params.bg_mean), np.float32(params.bg_mad ** 2 / params.mean_signal)
+            mu_sf = (self.values - bg_mean - sigma_squared_over_alpha).astype('float64')
+            old = np.maximum(mu_sf + params.bg_mad ** 2 * np.exp(
+                norm(mu_sf, params.bg_mad).logpdf(0) - norm(mu_sf, params.bg_mad).logsf(0)), 1e-6) + params.offset
+            bound = 2.0 ** -23 * (np.abs(self.values) + params.bg_mean + params.bg_mad ** 2 / params.mean_signal)
+            assert np.all(np.abs(apply_bg_correction(self.values, params) - old) <= bound)
+
+    def test_matrix_with_one_parameter_per_row(self):
+        matrix = np.stack([self.values, self.values[::-1]])
+        params = BackgroundCorrectionParams(
+            np.array([[400.3], [250.0]]), np.array([[120.7], [60.2]]), np.array([[3000.1], [900.0]]))
+        corrected = apply_bg_correction(matrix, params)
+        for idx, row in enumerate(matrix):
+            row_params = BackgroundCorrectionParams(params.bg_mean[idx, 0], params.bg_mad[idx, 0], params.mean_signal[idx, 0])
+            np.testing.assert_array_equal(corrected[idx], apply_bg_correction(row, row_params))
+
+    def test_writes_to_preallocated_buffers(self):
+        out, work = np.empty(len(self.values)), np.empty(len(self.values))
+        p = self.params
+        result = normexp_signal(self.values, p.bg_mean, p.bg_mad, p.mean_signal, p.offset, out=out, work=work)
+        assert result is out
+        np.testing.assert_array_equal(out, apply_bg_correction(self.values, p))
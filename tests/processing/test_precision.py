@@ -0,0 +1,34 @@
+# Lib
+from pathlib import Path
+import numpy as np
+import pytest
+# App
+from methylprep.processing import pipeline
+from methylprep.processing.preprocess import FLOAT32_TOLERANCE
+
+
+def assert_within_float32_tolerance(expected, actual):
+    """ beta and m_values computed in float32 must stay within FLOAT32_TOLERANCE of the float64 ones """
+    assert actual.index.equals(expected.index)
+    for column, tolerance in FLOAT32_TOLERANCE.items():
+        difference = np.abs(actual[column].astype('float64') - expected[column].astype('float64'))
+        assert np.array_equal(difference.isna(), expected[column].isna()), column
+        assert difference.max() <= tolerance, f'{column} differs by {difference.max()} (tolerance {tolerance})'
+
+
+class TestFloat32Precision():
+
+    @pytest.mark.parametrize('test_data_dir', ['docs/example_data/GSE69852', 'docs/example_data/epic_plus'])
+    def test_example_data(self, test_data_dir):
+        """ runs on the example data sets whose IDAT files have been downloaded; skipped otherwise. """
+        if not list(Path(test_data_dir).rglob('*.idat*')):
+            pytest.skip(f'{test_data_dir} has no IDAT files')
+        results = {
+            precision: pipeline.run_pipeline(test_data_dir, bit='float64', meta_data_frame=False, precision=precision)
+            for precision in ('float64', 'float32')
+        }
+        for expected, actual in zip(results['float64'], results['float32']):
+            assert_within_float32_tolerance(
+                expected._SampleDataContainer__data_frame,
+                actual._SampleDataContainer__data_frame,
+            )
@@ -0,0 +1,82 @@
+# Lib
+import numpy as np
+import pandas as pd
+import pytest
+# App
+from methylprep.models import Channel, Sample
+from methylprep.processing import RawDataset, SampleDataContainer, QuantileReference
+from methylprep.files import IdatDataset
+from test_raw_dataset import write_subset_manifest
+
+
+class TestQuantileReference():
+    @pytest.fixture
+    def manifest(self, tmp_path):
+        return write_subset_manifest(tmp_path.joinpath('manifest.csv'))
+
+    @staticmethod
+    def sample_frame(manifest, seed):
+        rng = np.random.default_rng(seed)
+        probes = manifest.data_frame.index
+        return pd.DataFrame({
+            'noob_meth': rng.uniform(0, 20000, len(probes)),
+            'noob_unmeth': rng.uniform(0, 20000, len(probes)),
+        }, index=probes)
+
+    def test_samples_share_the_reference_distribution(self, manifest):
+        reference = QuantileReference(manifest)
+        frames = [self.sample_frame(manifest, seed) for seed in range(3)]
+        ranks = [reference.add(frame) for frame in frames]
+        assert reference.num_samples == 3
+        normalized = [reference.normalize(frame, rank) for frame, rank in zip(frames, ranks)]
+        for name, probes in reference.groups.items():
+            for column in ('noob_meth', 'noob_unmeth'):
+                expected = np.mean([np.sort(frame.loc[probes, column]) for frame in frames], axis=0)
+                for frame, result in zip(frames, normalized):
+                    values = result.loc[probes, column]
+                    np.testing.assert_allclose(np.sort(values), expected, atol=1e-3, rtol=1e-6)
+                    # each probe keeps its rank within the sample
+                    assert values.rank().tolist() == frame.loc[probes, column].rank().tolist()
+
+    def test_missing_values_and_probe_subsets(self, manifest):
+        reference = QuantileReference(manifest)
+        frame = self.sample_frame(manifest, 0)
+        frame.loc['cg02', 'noob_meth'] = np.nan
+        ranks = reference.add(frame)
+        assert np.isnan(ranks.loc['cg02', 'noob_meth'])
+        reference.add(self.sample_frame(manifest, 1))
+        full = reference.normalize(frame, ranks)
+        assert np.isnan(full.loc['cg02', 'noob_meth'])
+        # a subset of the probes (as select_probes leaves) is normalized as it was with every probe
+        subset = reference.normalize(frame.loc[['cg03', 'cg10', 'cg02']], ranks)
+        pd.testing.assert_frame_equal(subset, full.loc[['cg03', 'cg10', 'cg02']])
+
+    def test_empty_reference(self, manifest):
+        with pytest.raises(ValueError):
+            QuantileReference(manifest).get_reference('II', 'noob_meth')
+
+    def test_sample_data_container(self, manifest):
+        rng = np.random.default_rng(0)
+        illumina_ids = np.arange(55000, dtype=np.int32)
+        containers = []
+        for position in ('R01C01', 'R02C01'):
+            raw_dataset = RawDataset(Sample('.', '200000000001', position), *[
+                IdatDataset.from_arrays(channel, illumina_ids, rng.integers(0, 60000, 55000).astype(np.uint16))
+                for channel in (Channel.GREEN, Channel.RED)
+            ])
+            containers.append(SampleDataContainer(raw_dataset, manifest, bit='float64'))
+        reference = QuantileReference(manifest)
+        for container in containers:
+            container.process_all()
+            container.add_to_quantile_reference(reference)
+            container.select_probes(['cg02', 'cg03', 'cg04', 'cg10', 'cg11'])
+        for container in containers:
+            ranks = container.quantile_ranks
+            data_frame = container._SampleDataContainer__data_frame
+            expected = reference.normalize(data_frame, ranks)
+            result = container.quantile_normalize(reference)
+            assert not hasattr(container, 'quantile_ranks')
+            assert result[['noob_meth', 'noob_unmeth', 'beta_value']].notna().all().all()
+            pd.testing.assert_series_equal(result['noob_meth'], expected['noob_meth'])
+            beta = result['noob_meth'] / (result['noob_meth'] + result['noob_unmeth'] + 100)
+            np.testing.assert_allclose(result['beta_value'], beta, atol=1e-3)
@@ -1,8 +1,15 @@
 from io import StringIO
+import pickle
+import tarfile
+from unittest import mock
+import numpy as np
+import pandas as pd
+import pytest
 # App
-from methylprep.models import Channel, Sample, ArrayType, MethylationDataset
-from methylprep.processing import raw_dataset, RawDataset
-from methylprep.files import SampleSheet, Manifest, IdatDataset
+from methylprep.models import Channel, Sample, ArrayType, MethylationDataset, ProbeAddress, ProbeType, FG_PROBE_SUBSETS
+from methylprep.processing import raw_dataset, pipeline, RawDataset, SampleDataContainer, preprocess_noob, preprocess_noob_batch
+from methylprep.processing.preprocess import FLOAT32_TOLERANCE
+from methylprep.files import SampleSheet, Manifest, IdatDataset, TarIdatReader
 from pathlib import Path
 
 # TODO:
@@ -39,3 +46,378 @@ class TestRawDataset():
             raise AssertionError("SNP unmeth failed")
         if unmeth_data.data_frame.shape[0] != 65:
             raise AssertionError("SNP unmeth failed: unexpected number of SNP probes found")
+
+
+def write_sample_sheet(data_dir, sample_ids):
+    lines = ['Sample_Name,Sentrix_ID,Sentrix_Position']
+    for idx, (sentrix_id, sentrix_position) in enumerate(sample_ids, 1):
+        lines.append(f'Sample_{idx},{sentrix_id},{sentrix_position}')
+    path = Path(data_dir, 'samplesheet.csv')
+    path.write_text('\n'.join(lines) + '\n')
+    return SampleSheet(str(path), data_dir)
+
+
+class TestRawMetaDatasets():
+    sample_ids = [('200000000001', 'R01C01'), ('200000000001', 'R02C01')]
+
+    def make_pair(self, make_idat, sentrix_id, sentrix_position, n_probes=55000):
+        # 27k-sized, so ArrayType.from_probe_count recognizes it
+        for channel in ('Grn', 'Red'):
+            make_idat(f'{sentrix_id}/{sentrix_id}_{sentrix_position}_{channel}.idat',
+                list(range(n_probes)), list(range(n_probes)))
+
+    def test_scans_whole_sample_sheet(self, make_idat, tmp_path):
+        for sentrix_id, sentrix_position in self.sample_ids:
+            self.make_pair(make_idat, sentrix_id, sentrix_position)
+        sample_sheet = write_sample_sheet(tmp_path, self.sample_ids)
+        meta_datasets = raw_dataset.get_raw_meta_datasets(sample_sheet)
+        assert len(meta_datasets) == 2
+        assert {dataset.n_snps_read for dataset in meta_datasets} == {55000}
+        assert raw_dataset.get_array_type(meta_datasets) == ArrayType.ILLUMINA_27K
+        assert meta_datasets[0].green_header.channel is Channel.GREEN
+
+    def test_mixed_probe_counts_raise(self, make_idat, tmp_path):
+        self.make_pair(make_idat, *self.sample_ids[0], n_probes=55000)
+        self.make_pair(make_idat, *self.sample_ids[1], n_probes=55001)
+        sample_sheet = write_sample_sheet(tmp_path, self.sample_ids)
+        with pytest.raises(ValueError, match='varying number of probes'):
+            raw_dataset.get_raw_meta_datasets(sample_sheet)
+
+    def test_truncated_and_missing_files_are_all_reported(self, make_idat, tmp_path):
+        self.make_pair(make_idat, *self.sample_ids[0])
+        red = tmp_path.joinpath('200000000001', '200000000001_R01C01_Red.idat')
+        red.write_bytes(red.read_bytes()[:200])
+        sample_sheet = write_sample_sheet(tmp_path, self.sample_ids)
+        with pytest.raises(ValueError, match='2 of 2 samples'):
+            raw_dataset.get_raw_meta_datasets(sample_sheet)
+
+    def test_without_scanning(self, tmp_path):
+        sample_sheet = write_sample_sheet(tmp_path, self.sample_ids)
+        meta_datasets = raw_dataset.get_raw_meta_datasets(sample_sheet, scan_headers=False)
+        assert [dataset.n_snps_read for dataset in meta_datasets] == [None, None]
+
+
+class TestParallelRawDatasets():
+    sample_ids = [('200000000001', f'R0{row}C01') for row in range(1, 5)]
+
+    def test_workers_keep_sample_order(self, make_idat, tmp_path):
+        for offset, (sentrix_id, sentrix_position) in enumerate(self.sample_ids):
+            for channel in ('Grn', 'Red'):
+                make_idat(f'{sentrix_id}/{sentrix_id}_{sentrix_position}_{channel}.idat',
+                    list(range(55000)), [offset] * 55000)
+        sample_sheet = write_sample_sheet(tmp_path, self.sample_ids)
+        serial = raw_dataset.get_raw_datasets(sample_sheet)
+        threaded = raw_dataset.get_raw_datasets(sample_sheet, workers=3)
+        assert [str(dataset.sample) for dataset in threaded] == [str(dataset.sample) for dataset in serial]
+        assert [int(dataset.green_idat.means[0]) for dataset in threaded] == [0, 1, 2, 3]
+
+    def test_worker_errors_are_raised(self):
+        def parser(sample):
+            if sample == 2:
+                raise EOFError('truncated')
+            return sample
+        assert raw_dataset.read_samples(parser, [0, 1], workers=2) == [0, 1]
+        with pytest.raises(EOFError):
+            raw_dataset.read_samples(parser, [0, 1, 2, 3], workers=2)
+
+
+class TestArchiveRawDatasets():
+    sample_ids = [('200000000001', 'R01C01'), ('200000000001', 'R02C01')]
+
+    def test_reads_samples_from_tar_archive(self, make_idat, tmp_path):
+        archive_path = tmp_path.joinpath('GSE1_RAW.tar')
+        with tarfile.open(archive_path, 'w') as archive:
+            for offset, (sentrix_id, sentrix_position) in enumerate(self.sample_ids):
+                for channel in ('Grn', 'Red'):
+                    path = make_idat(f'members/GSM{offset}_{sentrix_id}_{sentrix_position}_{channel}.idat',
+                        list(range(55000)), [offset] * 55000, compress=True)
+                    archive.add(path, arcname=path.name)
+        data_dir = tmp_path.joinpath('data')
+        data_dir.mkdir()
+        sample_sheet = write_sample_sheet(data_dir, self.sample_ids)
+        reader = TarIdatReader(archive_path)
+
+        meta_datasets = raw_dataset.get_raw_meta_datasets(sample_sheet, from_s3=reader)
+        assert raw_dataset.get_array_type(meta_datasets) == ArrayType.ILLUMINA_27K
+        raw_datasets = raw_dataset.get_raw_datasets(sample_sheet, from_s3=reader, workers=2)
+        assert [int(dataset.red_idat.means[0]) for dataset in raw_datasets] == [0, 1]
+
+
+def write_subset_manifest(path, compact=False):
+    """ a small manifest with every probe type, a type I probe missing its AddressB_ID,
+    and probes whose addresses are not in the IDATs (99990+). """
+    rows = [
+        'cg01,10,,II,', 'cg02,11,12,I,Grn', 'cg03,13,14,I,Red', 'cg04,15,,II,', 'cg05,16,17,I,Red',
+        'cg06,99991,,II,', 'cg07,18,99992,I,Grn', 'cg08,19,,I,Grn', 'cg09,20,21,IR,Red', 'rs01,22,,II,',
+        'rs02,23,24,I,Grn', 'rs03,25,26,I,Red', 'ch01,27,,II,', 'cg10,28,29,I,Grn', 'cg11,30,31,I,Red',
+    ]
+    # like the CoreColumns manifests, the header is the first line, so controls start right after the probes
+    lines = ['IlmnID,AddressA_ID,AddressB_ID,Infinium_Design_Type,Color_Channel,Genome_Build,CHR,MAPINFO,Strand']
+    lines += [f'{row},37,1,{idx},F' for idx, row in enumerate(rows)]
+    lines += ['[Controls],,,,', '40,STAINING,Red,DNP (High),', '41,NEGATIVE,Red,Negative 1,', '99993,NEGATIVE,Red,Negative 2,', '42,NORM_A,Red,NORM_A_1,', '43,NORM_C,Green,NORM_C_1,']
+    path.write_text('\n'.join(lines) + '\n')
+    with mock.patch.object(ArrayType, 'num_probes', new_callable=mock.PropertyMock, return_value=len(rows) + 1), \
+        mock.patch.object(ArrayType, 'num_controls', new_callable=mock.PropertyMock, return_value=5):
+        manifest = Manifest(ArrayType.ILLUMINA_27K, path, use_cache=False, compact=compact)
+        # these sections are loaded on first use, which has to happen while the probe counts are mocked
+        manifest.control_data_frame, manifest.snp_data_frame
+        return manifest
+
+
+def write_random_manifest(path, num_probes, num_controls=40):
+    """ a manifest of num_probes cg probes, cycling through type II, type I green and type I red,
+    with negative and normalization controls. Returns the manifest and a function that builds
+    a RawDataset with normexp-like intensities (exponential signal on normal background). """
+    lines = ['IlmnID,AddressA_ID,AddressB_ID,Infinium_Design_Type,Color_Channel,Genome_Build,CHR,MAPINFO,Strand']
+    green, red = [], []
+    for idx in range(num_probes):
+        address = 10000 + 2 * idx
+        design = idx % 3
+        if design == 0:
+            lines.append(f'cg{idx:08},{address},,II,,37,1,{idx},F')
+            green.append(address)
+            red.append(address)
+        else:
+            color = 'Grn' if design == 1 else 'Red'
+            lines.append(f'cg{idx:08},{address},{address + 1},I,{color},37,1,{idx},F')
+            (green if design == 1 else red).extend([address, address + 1])
+    control_types = ['NEGATIVE', 'NORM_A', 'NORM_T', 'NORM_C', 'NORM_G']
+    lines.append('[Controls],,,,')
+    for idx in range(num_controls):
+        control_type = control_types[idx % len(control_types)]
+        lines.append(f'{1000 + idx},{control_type},Red,{control_type}_{idx},')
+        if control_type in ('NORM_A', 'NORM_T'):
+            red.append(1000 + idx)
+        elif control_type in ('NORM_C', 'NORM_G'):
+            green.append(1000 + idx)
+    path.write_text('\n'.join(lines) + '\n')
+    with mock.patch.object(ArrayType, 'num_probes', new_callable=mock.PropertyMock, return_value=num_probes + 1), \
+        mock.patch.object(ArrayType, 'num_controls', new_callable=mock.PropertyMock, return_value=num_controls):
+        manifest = Manifest(ArrayType.ILLUMINA_27K, path, use_cache=False)
+        manifest.control_data_frame, manifest.snp_data_frame
+    illumina_ids = np.arange(1000, 10000 + 2 * num_probes, dtype=np.int32)
+
+    def make_raw_dataset(seed, position='R01C01'):
+        rng = np.random.default_rng(seed)
+        idats = []
+        for channel, foreground in ((Channel.GREEN, green), (Channel.RED, red)):
+            means = rng.normal(400, 120, len(illumina_ids))
+            means[np.asarray(foreground) - 1000] += rng.exponential(3000, len(foreground))
+            idats.append(IdatDataset.from_arrays(channel, illumina_ids, np.clip(means, 0, 65535).astype(np.uint16)))
+        return RawDataset(Sample('.', '200000000001', position), *idats)
+
+    return manifest, make_raw_dataset
+
+
+def old_subset_means(manifest, probe_subset, probe_means):
+    """ the DataFrame merge that MethylationDataset used before probe subset indexes """
+    probe_details = probe_subset.get_probe_details(manifest)
+    probe_details = probe_details[probe_details[probe_subset.column_name].notna()]
+    channel_means = probe_means.assign(Channel=probe_subset.data_channel.value)
+    return probe_details.merge(channel_means, how='inner', left_on=probe_subset.column_name, right_index=True, suffixes=(False, False))
+
+
+class TestProbeSubsetIndexes():
+    @pytest.fixture
+    def data(self, tmp_path):
+        manifest = write_subset_manifest(tmp_path.joinpath('manifest.csv'))
+        rng = np.random.default_rng(0)
+        # shuffled, so IDAT order differs from manifest order
+        illumina_ids = rng.permutation(np.arange(55000, dtype=np.int32))
+        idats = [
+            IdatDataset.from_arrays(channel, illumina_ids, rng.integers(0, 60000, 55000).astype(np.uint16))
+            for channel in (Channel.GREEN, Channel.RED)
+        ]
+        return manifest, RawDataset(Sample('.', '200000000001', 'R01C01'), *idats)
+
+    def test_methylation_subsets_match_merges(self, data):
+        manifest, dataset = data
+        for build in (MethylationDataset.methylated, MethylationDataset.unmethylated,
+                      MethylationDataset.snp_methylated, MethylationDataset.snp_unmethylated):
+            meth_dataset = build(dataset, manifest)
+            for probe_subset, data_frame in meth_dataset.data_frames.items():
+                expected = old_subset_means(manifest, probe_subset, dataset.get_channel_means(probe_subset.data_channel))
+                pd.testing.assert_frame_equal(data_frame, expected)
+        assert 'cg06' not in MethylationDataset.methylated(dataset, manifest).data_frame.index # address not in IDATs
+
+    def test_subset_means_read_idat_arrays(self, data):
+        manifest, dataset = data
+        idat = dataset.green_idat
+        subset_index = manifest.get_subset_index(ProbeType.ONE, Channel.GREEN, ProbeAddress.A)
+        found, means = manifest.get_subset_means(subset_index, idat)
+        assert means.dtype == np.uint16
+        idat.n_beads = np.arange(len(idat.means)) % 5
+        idat.min_beads = 3
+        masked_found, masked = manifest.get_subset_means(subset_index, idat)
+        # the probe_means DataFrame is not built
+        assert idat._IdatDataset__probe_means is None
+        expected = idat.probe_means['mean_value'].reindex(subset_index.addresses[found])
+        np.testing.assert_array_equal(masked_found, found)
+        assert masked.dtype == np.float32 and np.isnan(masked).any()
+        np.testing.assert_array_equal(masked, expected.values)
+
+    def test_fg_values_match_merges(self, data):
+        manifest, dataset = data
+        for channel in (Channel.GREEN, Channel.RED):
+            expected = []
+            for probe_subset in FG_PROBE_SUBSETS[channel]:
+                merge_df = probe_subset.get_probe_details(manifest)[[probe_subset.column_name, 'probe_type']]
+                merge_df = merge_df.reset_index().set_index(probe_subset.column_name)
+                expected.append(dataset.get_channel_means(channel).merge(merge_df, how='inner', left_index=True, right_index=True, suffixes=(False, False)))
+            pd.testing.assert_frame_equal(dataset.get_fg_values(manifest, channel), pd.concat(expected))
+
+    def test_oob_and_controls_match_merges(self, data):
+        manifest, dataset = data
+        for channel, idat in ((Channel.RED, dataset.green_idat), (Channel.GREEN, dataset.red_idat)):
+            probe_details = manifest.get_probe_details(ProbeType.ONE, channel)[['AddressA_ID', 'AddressB_ID']]
+            expected = pd.concat([
+                probe_details.merge(idat.probe_means, how='inner', left_on=column, right_index=True, suffixes=(False, False))
+                for column in ('AddressA_ID', 'AddressB_ID')
+            ])
+            pd.testing.assert_frame_equal(dataset.filter_oob_probes(channel, manifest, idat), expected)
+
+            expected = manifest.control_data_frame.merge(idat.probe_means, how='inner', left_index=True, right_index=True, suffixes=(False, False))
+            pd.testing.assert_frame_equal(dataset.get_fg_controls(manifest, idat.channel), expected)
+            assert 99993 not in dataset.get_fg_controls(manifest, idat.channel).index
+            assert len(expected) == len(manifest.control_data_frame) - 1
+
+    def test_bg_corrected_and_noob_match_merges(self, data):
+        manifest, dataset = data
+        meth_dataset = MethylationDataset.methylated(dataset, manifest)
+        green = dataset.get_fg_values(manifest, Channel.GREEN)
+        green = green.assign(bg_corrected=green['mean_value'] * 2.0)
+        red = dataset.get_fg_values(manifest, Channel.RED)
+        red = red.assign(bg_corrected=red['mean_value'] * 3.0)
+        meth_dataset.set_bg_corrected(green, red)
+        meth_dataset.set_noob(0.5)
+        for probe_subset, data_frame in meth_dataset.data_frames.items():
+            # the merges MethylationDataset used before its values were arrays
+            corrected = red if probe_subset.is_red else green
+            expected = old_subset_means(manifest, probe_subset, dataset.get_channel_means(probe_subset.data_channel))
+            expected = expected.merge(corrected[['bg_corrected']], how='inner', left_on=probe_subset.column_name, right_index=True, suffixes=(False, False))
+            expected = expected.assign(noob=expected['bg_corrected'] * (0.5 if probe_subset.is_red else 1))
+            pd.testing.assert_frame_equal(data_frame, expected)
+        pd.testing.assert_frame_equal(meth_dataset.data_frame, pd.concat(meth_dataset.data_frames.values()))
+        pd.testing.assert_series_equal(meth_dataset.get_column('noob'), meth_dataset.data_frame['noob'])
+
+    def test_pickles_only_its_manifest_rows(self, data):
+        manifest, dataset = data
+        meth_dataset = MethylationDataset.snp_methylated(dataset, manifest)
+        unpickled = pickle.loads(pickle.dumps(meth_dataset))
+        pd.testing.assert_frame_equal(unpickled.data_frame, meth_dataset.data_frame)
+        assert len(unpickled._MethylationDataset__manifest_data_frame) == len(meth_dataset.index) < len(manifest.data_frame)
+
+    def test_compact_manifest_selects_same_probes(self, data, tmp_path):
+        manifest, dataset = data
+        compact = write_subset_manifest(tmp_path.joinpath('compact.csv'), compact=True)
+        for build in (MethylationDataset.methylated, MethylationDataset.unmethylated):
+            expected = build(dataset, manifest).data_frame
+            actual = build(dataset, compact).data_frame
+            assert actual.index.tolist() == expected.index.tolist()
+            assert actual['mean_value'].tolist() == expected['mean_value'].tolist()
+        for channel in (Channel.GREEN, Channel.RED):
+            expected = dataset.get_fg_values(manifest, channel)
+            actual = dataset.get_fg_values(compact, channel)
+            assert actual['mean_value'].tolist() == expected['mean_value'].tolist()
+
+    def test_select_region_probes(self, data):
+        manifest, dataset = data
+        container = SampleDataContainer(dataset, manifest, pval=True)
+        processed = container.process_all()
+        # probe MAPINFO values are their row numbers, all on chromosome 1
+        probes = manifest.probes_in_regions([('chr1', 2, 4), ('1', 13, 20)])
+        assert probes.tolist() == ['cg03', 'cg04', 'cg05', 'cg10', 'cg11']
+        selected = container.select_probes(probes)
+        assert sorted(selected.index) == sorted(set(processed.index) & set(probes))
+        pd.testing.assert_frame_equal(selected, processed.loc[selected.index])
+
+    def test_indexes_are_computed_once_and_read_only(self, data):
+        manifest, dataset = data
+        subset_index = manifest.get_subset_index(ProbeType.TWO, None, ProbeAddress.A)
+        assert manifest.get_subset_index(ProbeType.TWO, None, ProbeAddress.A) is subset_index
+        positions = manifest.get_idat_positions(subset_index, dataset.green_idat)
+        assert manifest.get_idat_positions(subset_index, dataset.red_idat) is positions # same address layout
+        with pytest.raises(ValueError):
+            positions[0] = 0
+        with pytest.raises(ValueError):
+            subset_index.addresses[0] = 0
+
+    def test_views_are_built_once_per_raw_dataset(self, data):
+        manifest, dataset = data
+        container = SampleDataContainer(dataset, manifest, pval=True)
+        processed = container.process_all()
+        # both channels are corrected, with a dye bias factor from the normalization controls
+        assert processed[['noob_meth', 'noob_unmeth', 'beta_value']].notna().all().all()
+        # NOOB reads each table once, and does not add columns to them
+        assert dict(container.view_misses) == {'fg_green': 1, 'fg_red': 1, 'ctrl_green': 1, 'ctrl_red': 1}
+        pd.testing.assert_frame_equal(container.ctrl_red, dataset.get_fg_controls(manifest, Channel.RED))
+        pd.testing.assert_frame_equal(container.fg_green, dataset.get_fg_values(manifest, Channel.GREEN))
+        assert container.fg_green is container.fg_green
+        assert container.view_misses['fg_green'] == 1 and container.view_hits['fg_green'] == 3
+
+        ctrl_green = container.ctrl_green
+        container.raw_dataset = dataset
+        assert container.ctrl_green is not ctrl_green
+        assert container.view_misses['ctrl_green'] == 2
+        del container.raw_dataset
+        assert container._SampleDataContainer__views == {}
+
+    def test_noob_batch_matches_each_sample(self, tmp_path):
+        # 55000 IDAT addresses, so process_all() finds a 27k array
+        manifest, make_raw_dataset = write_random_manifest(tmp_path.joinpath('random.csv'), 23000)
+        raw_datasets = [make_raw_dataset(seed, f'R0{seed + 1}C01') for seed in range(3)]
+        # the third sample's IDATs store the same addresses in another order: a second IdatStack
+        shuffle = np.random.default_rng(3).permutation(raw_datasets[2].green_idat.n_snps_read)
+        raw_datasets[2] = RawDataset(raw_datasets[2].sample, *[
+            IdatDataset.from_arrays(idat.channel, idat.illumina_ids[shuffle], idat.means[shuffle])
+            for idat in (raw_datasets[2].green_idat, raw_datasets[2].red_idat)
+        ])
+        samples = [SampleDataContainer(raw, manifest) for raw in raw_datasets]
+        batch = [SampleDataContainer(raw, manifest) for raw in raw_datasets]
+        for data_container in samples:
+            preprocess_noob(data_container)
+        preprocess_noob_batch(batch)
+        for sample, batched in zip(samples, batch):
+            for meth in ('methylated', 'unmethylated'):
+                dataset = getattr(batched, meth)
+                # both channels are corrected, and red probes are scaled by a dye bias factor
+                assert set(dataset.channel) == {Channel.GREEN.value, Channel.RED.value}
+                assert not np.isnan(dataset.noob).any()
+                red = dataset.channel == Channel.RED.value
+                assert not np.allclose(dataset.noob[red], dataset.bg_corrected[red])
+                np.testing.assert_array_equal(dataset.bg_corrected, getattr(sample, meth).bg_corrected)
+                np.testing.assert_array_equal(dataset.noob, getattr(sample, meth).noob)
+            # preprocess() keeps the batch correction
+            pd.testing.assert_frame_equal(batched.process_all(), sample.process_all())
+        assert not np.array_equal(batch[0].methylated.noob, batch[1].methylated.noob)
+
+    def test_float32_precision(self, tmp_path):
+        manifest, dataset = write_random_manifest(tmp_path.joinpath('random.csv'), 30000)
+        dataset = dataset(0)
+        expected = SampleDataContainer(dataset, manifest, bit='float64').process_all()
+        container = SampleDataContainer(dataset, manifest, bit='float64', precision='float32')
+        actual = container.process_all()
+        assert container.methylated.noob.dtype == np.float32
+        assert len(expected) == 30000
+        for column, tolerance in FLOAT32_TOLERANCE.items():
+            # every probe is compared, in both channels
+            assert expected[column].notna().all() and actual[column].notna().all()
+            assert np.abs(actual[column] - expected[column]).max() <= tolerance
+        with pytest.raises(ValueError):
+            SampleDataContainer(dataset, manifest, precision='float16')
+
+    def test_saved_batch_dtypes(self, data, tmp_path):
+        manifest, dataset = data
+        container = SampleDataContainer(dataset, manifest, retain_uncorrected_probe_intensities=True)
+        processed = container.process_all()
+        pipeline.save_batch_outputs([container], 1, tmp_path, betas=True, save_uncorrected=True)
+        for column in ('meth', 'unmeth'):
+            saved = pd.read_pickle(tmp_path.joinpath(f'{column}_values.pkl'))
+            # raw intensities above 32767 must not wrap to negative values
+            assert saved.dtypes.unique().tolist() == [np.uint16]
+            assert saved.iloc[:, 0].max() > 32767
+            np.testing.assert_array_equal(saved.iloc[:, 0], processed[column])
+        for column in ('noob_meth', 'noob_unmeth'):
+            saved = pd.read_pickle(tmp_path.joinpath(f'{column}_values.pkl'))
+            assert saved.dtypes.unique().tolist() == [np.float32]
+            np.testing.assert_allclose(saved.iloc[:, 0], processed[column], rtol=1e-6)
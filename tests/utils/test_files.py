@@ -1,6 +1,11 @@
 # LIb
+import gzip
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import StringIO, BytesIO
 from pathlib import Path
+import threading
+import time
 from unittest.mock import patch
 import pytest
 # App
@@ -113,3 +118,105 @@ class TestDownloadFile():
         download_file(self.mock_filename, self.mock_src_url, self.tmpdir)
         assert expected_filepath.exists() is True
         assert mock_shutil.copyfileobj.call_count == 1
+
+
+class StandInServer(ThreadingHTTPServer):
+    """ a local stand-in for the manifest bucket: serves one file, with Range support,
+    and can drop the first response halfway or answer slowly. """
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.content = b''
+        self.truncate_first = False
+        self.delay = 0
+        self.requests = []
+        self.url = f'http://127.0.0.1:{self.server_address[1]}/manifest.csv.gz'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get('Range'))
+        time.sleep(server.delay)
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            if start >= len(server.content):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(server.content) - 1}/{len(server.content)}')
+        else:
+            self.send_response(200)
+        body = server.content[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if server.truncate_first and len(server.requests) == 1:
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownloadFromServer():
+    content = gzip.compress(bytes(range(256)) * 4000)
+
+    @pytest.fixture
+    def server(self):
+        server = StandInServer()
+        server.content = self.content
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server
+        server.shutdown()
+        server.server_close()
+
+    def test_downloads_and_renames(self, server, tmp_path):
+        download_file('manifest.csv.gz', server.url, tmp_path, checksum=hashlib.sha256(self.content).hexdigest())
+        assert tmp_path.joinpath('manifest.csv.gz').read_bytes() == self.content
+        assert not tmp_path.joinpath('manifest.csv.gz.part').exists()
+        # the lock file is kept out of the download directory
+        assert sorted(path.name for path in tmp_path.iterdir()) == ['manifest.csv.gz']
+
+    def test_resumes_interrupted_download(self, server, tmp_path):
+        server.truncate_first = True
+        download_file('manifest.csv.gz', server.url, tmp_path)
+        assert server.requests == [None, f'bytes={len(self.content) // 2}-']
+        assert tmp_path.joinpath('manifest.csv.gz').read_bytes() == self.content
+
+    def test_complete_partial_file_is_used(self, server, tmp_path):
+        tmp_path.joinpath('manifest.csv.gz.part').write_bytes(self.content)
+        download_file('manifest.csv.gz', server.url, tmp_path)
+        assert server.requests == [f'bytes={len(self.content)}-']
+        assert tmp_path.joinpath('manifest.csv.gz').read_bytes() == self.content
+
+    def test_checksum_mismatch_is_not_kept(self, server, tmp_path):
+        with pytest.raises(ValueError):
+            download_file('manifest.csv.gz', server.url, tmp_path, checksum='0' * 64)
+        assert not tmp_path.joinpath('manifest.csv.gz').exists()
+        assert not tmp_path.joinpath('manifest.csv.gz.part').exists()
+
+    def test_truncated_gzip_is_not_kept(self, server, tmp_path):
+        server.content = self.content[:-100]
+        with pytest.raises(ValueError):
+            download_file('manifest.csv.gz', server.url, tmp_path)
+        assert not tmp_path.joinpath('manifest.csv.gz').exists()
+
+    def test_concurrent_downloads_fetch_once(self, server, tmp_path):
+        server.delay = 0.3
+        errors = []
+        def download():
+            try:
+                download_file('manifest.csv.gz', server.url, tmp_path)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=download) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert len(server.requests) == 1
+        assert tmp_path.joinpath('manifest.csv.gz').read_bytes() == self.content
+        assert sorted(path.name for path in tmp_path.iterdir()) == ['manifest.csv.gz']